@@ -12,6 +12,7 @@ from loguru import logger
 from app.config import config
 from app.models.exception import HttpException
 from app.router import root_api_router
+from app.services import janitor, mezzanine
 from app.utils import utils
 
 
@@ -75,8 +76,11 @@ app.mount("/", StaticFiles(directory=public_dir, html=True), name="")
 @app.on_event("shutdown")
 def shutdown_event():
     logger.info("shutdown event")
+    janitor.stop()
 
 
 @app.on_event("startup")
 def startup_event():
     logger.info("startup event")
+    janitor.start()
+    mezzanine.start()
@@ -1,10 +1,19 @@
 import glob
+import json
 import os
 import pathlib
 import shutil
 from typing import Union
 
-from fastapi import BackgroundTasks, Depends, Path, Request, UploadFile
+from fastapi import (
+    BackgroundTasks,
+    Depends,
+    Path,
+    Request,
+    UploadFile,
+    WebSocket,
+    WebSocketDisconnect,
+)
 from fastapi.params import File
 from fastapi.responses import FileResponse, StreamingResponse
 from loguru import logger
@@ -14,18 +23,22 @@ from app.controllers import base
 from app.controllers.manager.memory_manager import InMemoryTaskManager
 from app.controllers.manager.redis_manager import RedisTaskManager
 from app.controllers.v1.base import new_router
+from app.models import const
 from app.models.exception import HttpException
 from app.models.schema import (
     AudioRequest,
     BgmRetrieveResponse,
     BgmUploadResponse,
+    StorageStatsResponse,
     SubtitleRequest,
+    TaskCancellationResponse,
     TaskDeletionResponse,
     TaskQueryRequest,
     TaskQueryResponse,
     TaskResponse,
     TaskVideoRequest,
 )
+from app.services import cancellation, clip_index, embedding_store, janitor, mezzanine, search_cache
 from app.services import state as sm
 from app.services import task as tm
 from app.utils import utils
@@ -85,7 +98,7 @@ def create_task(
             "request_id": request_id,
             "params": body.model_dump(),
         }
-        sm.state.update_task(task_id)
+        sm.state.update_task(task_id, queued=True)
         task_manager.add_task(tm.start, task_id=task_id, params=body, stop_at=stop_at)
         logger.success(f"Task created: {utils.to_json(task)}")
         return utils.get_response(200, task)
@@ -156,6 +169,115 @@ def get_task(
     )
 
 
+async def task_events(task_id: str, heartbeat: float = 15):
+    """
+    Yield the current task record, then every event published for the task
+    until it leaves the processing state. Yields None as a heartbeat when
+    nothing happened for `heartbeat` seconds.
+    """
+    # subscribe before reading the snapshot so no transition is missed
+    subscription = await sm.state.subscribe(task_id)
+    try:
+        task = sm.state.get_task(task_id)
+        if not task:
+            return
+        yield {"type": "state", **task}
+        if task.get("state") != const.TASK_STATE_PROCESSING:
+            return
+
+        while True:
+            event = await subscription.get(timeout=heartbeat)
+            yield event
+            if (
+                event
+                and event.get("type") == "state"
+                and event.get("state") != const.TASK_STATE_PROCESSING
+            ):
+                return
+    finally:
+        await subscription.close()
+
+
+@router.get("/tasks/{task_id}/events", summary="Stream task events (Server-Sent Events)")
+async def stream_task_events(
+    request: Request, task_id: str = Path(..., description="Task ID")
+):
+    request_id = base.get_task_id(request)
+    if not sm.state.get_task(task_id):
+        raise HttpException(
+            task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+        )
+
+    async def event_iterator():
+        async for event in task_events(task_id):
+            if await request.is_disconnected():
+                break
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            data = json.dumps(event, ensure_ascii=False)
+            yield f"event: {event.get('type', 'message')}\ndata: {data}\n\n"
+
+    return StreamingResponse(
+        event_iterator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/tasks/{task_id}/ws")
+async def websocket_task_events(websocket: WebSocket, task_id: str):
+    await websocket.accept()
+    if not sm.state.get_task(task_id):
+        await websocket.close(code=4404, reason="task not found")
+        return
+
+    try:
+        async for event in task_events(task_id):
+            # heartbeats are sent as well, a closed connection only shows on send
+            await websocket.send_json(event if event is not None else {"type": "heartbeat"})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+
+def cancel_task(task_id: str) -> dict:
+    """
+    Request cancellation of a processing task and return the latest task
+    record. A running task stays processing until its worker stops.
+    """
+    task = sm.state.get_task(task_id)
+    if task.get("state") != const.TASK_STATE_PROCESSING:
+        return task
+
+    cancellation.cancel(task_id)
+    # read again after the request: a worker clears `queued` before it checks for one
+    task = sm.state.get_task(task_id) or task
+    if task.get("queued"):
+        # still queued, the worker skips it once it is dequeued
+        sm.state.update_task(task_id, state=const.TASK_STATE_CANCELLED)
+        return sm.state.get_task(task_id)
+    return task
+
+
+@router.post(
+    "/tasks/{task_id}/cancel",
+    response_model=TaskCancellationResponse,
+    summary="Cancel a queued or running task",
+)
+def cancel_video(request: Request, task_id: str = Path(..., description="Task ID")):
+    request_id = base.get_task_id(request)
+    if sm.state.get_task(task_id):
+        task = cancel_task(task_id)
+        return utils.get_response(
+            200, {"task_id": task_id, "state": task.get("state")}
+        )
+
+    raise HttpException(
+        task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+    )
+
+
 @router.delete(
     "/tasks/{task_id}",
     response_model=TaskDeletionResponse,
@@ -165,6 +287,16 @@ def delete_video(request: Request, task_id: str = Path(..., description="Task ID
     request_id = base.get_task_id(request)
     task = sm.state.get_task(task_id)
     if task:
+        # stop a running render before removing its files, the client
+        # retries the delete once the worker has stopped
+        task = cancel_task(task_id)
+        if task.get("state") == const.TASK_STATE_PROCESSING:
+            raise HttpException(
+                task_id=task_id,
+                status_code=409,
+                message=f"{request_id}: task is stopping, try again later",
+            )
+
         tasks_dir = utils.task_dir()
         current_task_dir = os.path.join(tasks_dir, task_id)
         if os.path.exists(current_task_dir):
@@ -179,6 +311,20 @@ def delete_video(request: Request, task_id: str = Path(..., description="Task ID
     )
 
 
+@router.get(
+    "/storage/stats",
+    response_model=StorageStatsResponse,
+    summary="Storage clean-up statistics",
+)
+def get_storage_stats(request: Request):
+    stats = janitor.get_stats()
+    stats["search_cache"] = search_cache.get_stats()
+    stats["mezzanine"] = mezzanine.get_stats()
+    stats["embedding_cache"] = embedding_store.get_stats()
+    stats["clip_index"] = clip_index.get_stats()
+    return utils.get_response(200, stats)
+
+
 @router.get(
     "/musics", response_model=BgmRetrieveResponse, summary="Retrieve local BGM files"
 )
@@ -17,6 +17,7 @@ PUNCTUATIONS = [
     "...",
 ]
 
+TASK_STATE_CANCELLED = -2
 TASK_STATE_FAILED = -1
 TASK_STATE_COMPLETE = 1
 TASK_STATE_PROCESSING = 4
@@ -26,3 +26,16 @@ class HttpException(Exception):
 
 class FileNotFoundException(Exception):
     pass
+
+
+class TaskCancelledError(BaseException):
+    """
+    Raised inside a task once it has been cancelled.
+
+    Derives from BaseException (like asyncio.CancelledError) so the broad
+    `except Exception` handlers in the pipeline do not swallow it.
+    """
+
+    def __init__(self, task_id: str = ""):
+        self.task_id = task_id
+        super().__init__(f"task cancelled: {task_id}")
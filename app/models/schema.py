@@ -66,6 +66,10 @@ class MaterialInfo:
     # Image data for similarity comparison
     thumbnail_url: str = ""  # Main thumbnail image
     preview_images: list = None  # List of preview frame URLs
+    # Selected rendition of the source: width, height, size, quality
+    rendition: dict = None
+    # Sampled-frame pHashes of a downloaded clip
+    fingerprint: list = None
 
 
 class VideoParams(BaseModel):
@@ -320,6 +324,85 @@ class TaskDeletionResponse(BaseResponse):
         }
 
 
+class TaskCancellationResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "task_id": "6c85c8cc-a77a-42b9-bc30-947815aa0558",
+                    "state": 4,
+                },
+            },
+        }
+
+
+class StorageStatsResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "runs": 12,
+                    "last_run_at": 1718000000.0,
+                    "last_run_seconds": 0.42,
+                    "files_removed": 310,
+                    "bytes_reclaimed": 5368709120,
+                    "bytes_reclaimed_by_class": {
+                        "finals": 1073741824,
+                        "intermediates": 2147483648,
+                        "metadata": 1048576,
+                        "cache": 2146435072,
+                    },
+                    "cache_bytes": 16106127360,
+                    "mezzanine": {
+                        "enabled": True,
+                        "queued": 40,
+                        "transcoded": 38,
+                        "failed": 0,
+                        "pending": 2,
+                        "bytes_before": 2147483648,
+                        "bytes_after": 805306368,
+                        "seconds": 412.5,
+                    },
+                    "embedding_cache": {
+                        "enabled": True,
+                        "hits": 950,
+                        "misses": 42,
+                        "evicted": 0,
+                        "entries": 1830,
+                    },
+                    "clip_index": {
+                        "enabled": True,
+                        "backend": "ivf",
+                        "entries": 52310,
+                        "indexed": 52310,
+                    },
+                    "search_cache": {
+                        "hits": 120,
+                        "stale_hits": 8,
+                        "misses": 35,
+                        "refreshes": 8,
+                        "errors": 1,
+                        "entries": 412,
+                        "api_keys": [
+                            {
+                                "provider": "pexels",
+                                "key_id": "3f2a9c0d1b4e",
+                                "requests": 43,
+                                "rate_limit": 20000,
+                                "remaining": 19957,
+                                "reset_at": 1718600000.0,
+                            }
+                        ],
+                    },
+                },
+            },
+        }
+
+
 class VideoScriptResponse(BaseResponse):
     class Config:
         json_schema_extra = {
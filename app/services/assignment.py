@@ -0,0 +1,71 @@
+"""
+Global assignment of video clips to script segments.
+
+Every selection slot (a segment of the script, repeated cyclically until the
+audio is covered) is matched to a clip so that the total similarity is
+maximal, instead of picking the best clip slot by slot. A clip may be used
+several times: each clip is expanded into one column per use, and the n-th
+use costs a growing reuse penalty, so clips are only repeated where that
+still beats the alternatives. Pairs scoring below the similarity threshold
+cost an extra penalty, so a slot only gets such a clip when no clip above
+the threshold is left for it. The problem is then a rectangular linear sum
+assignment (Hungarian algorithm).
+"""
+
+from typing import List
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+# penalty of the n-th reuse of a clip while it is within max_video_reuse,
+# the same steps the greedy selection used
+REUSE_PENALTIES = {1: 0.2, 2: 0.4, 3: 0.6}
+# reuses beyond max_video_reuse only happen when there are not enough clips,
+# each further reuse costs a little more to spread them over the clips
+OVERFLOW_PENALTY = 1.0
+OVERFLOW_STEP = 0.1
+# a clip below the similarity threshold is as costly as a reuse beyond the limit
+BELOW_THRESHOLD_PENALTY = 1.0
+
+
+def reuse_penalties(max_video_reuse: int, uses: int) -> np.ndarray:
+    """Penalty of the 0th..(uses-1)th reuse of a clip."""
+    penalties = np.empty(uses, dtype=np.float64)
+    for use in range(uses):
+        if use == 0:
+            penalties[use] = 0.0
+        elif use < max_video_reuse:
+            penalties[use] = REUSE_PENALTIES.get(use, OVERFLOW_PENALTY)
+        else:
+            penalties[use] = OVERFLOW_PENALTY + OVERFLOW_STEP * (use - max_video_reuse)
+    return penalties
+
+
+def assign(scores: np.ndarray, max_video_reuse: int = 2, min_score: float = None) -> List[int]:
+    """
+    Assign a clip to every slot.
+
+    `scores` is a (slots x clips) similarity matrix, returns the clip index
+    of every slot. Clips are reused up to `max_video_reuse` times, and beyond
+    that only if there are more slots than clips allow, so no slot is left
+    without a clip. Pairs scoring below `min_score` are avoided the same way.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    slots, clips = scores.shape
+    if slots == 0:
+        return []
+    if clips == 0:
+        return [-1] * slots
+
+    uses = max(max_video_reuse, -(-slots // clips))
+    penalties = reuse_penalties(max_video_reuse, uses)
+    # column c * uses + u is the u-th use of clip c
+    cost = penalties[None, None, :] - scores[:, :, None]
+    if min_score is not None:
+        cost = cost + np.where(scores < min_score, BELOW_THRESHOLD_PENALTY, 0.0)[:, :, None]
+    cost = cost.reshape(slots, clips * uses)
+    rows, columns = linear_sum_assignment(cost)
+    assignment = [-1] * slots
+    for row, column in zip(rows, columns):
+        assignment[row] = int(column // uses)
+    return assignment
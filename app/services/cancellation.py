@@ -0,0 +1,171 @@
+"""
+Cooperative cancellation of running tasks.
+
+`task.start` activates a CancellationToken for the task it runs; long running
+code calls `check()` between units of work (pipeline stages, clip encoding,
+TTS chunks, downloads) and external processes are started with
+`run_process()` so they can be terminated as soon as the task is cancelled.
+"""
+
+import contextvars
+import subprocess
+import threading
+import time
+
+from loguru import logger
+
+from app.models.exception import TaskCancelledError
+from app.services import state as sm
+
+# how often a token re-checks the state store for a cancel request issued by
+# another process (e.g. an API node in front of a redis-backed worker)
+_REMOTE_CHECK_INTERVAL = 1.0
+
+_current_token = contextvars.ContextVar("cancellation_token", default=None)
+_tokens = {}
+_tokens_lock = threading.Lock()
+
+
+class CancellationToken:
+    def __init__(self, task_id: str):
+        self.task_id = task_id
+        self._event = threading.Event()
+        self._processes = set()
+        self._lock = threading.Lock()
+        self._last_remote_check = 0.0
+
+    @property
+    def cancelled(self) -> bool:
+        if self._event.is_set():
+            return True
+
+        now = time.monotonic()
+        if now - self._last_remote_check >= _REMOTE_CHECK_INTERVAL:
+            self._last_remote_check = now
+            if sm.state.is_cancel_requested(self.task_id):
+                self.cancel()
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+        with self._lock:
+            processes = list(self._processes)
+        for process in processes:
+            _terminate(process)
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise TaskCancelledError(self.task_id)
+
+    def register_process(self, process: subprocess.Popen):
+        with self._lock:
+            self._processes.add(process)
+        # the task may have been cancelled while the process was starting
+        if self._event.is_set():
+            _terminate(process)
+
+    def unregister_process(self, process: subprocess.Popen):
+        with self._lock:
+            self._processes.discard(process)
+
+
+def _terminate(process: subprocess.Popen, timeout: float = 5):
+    if process.poll() is not None:
+        return
+    try:
+        process.terminate()
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    except OSError as e:
+        logger.warning(f"failed to terminate process {process.pid}: {e}")
+
+
+def acquire(task_id: str) -> CancellationToken:
+    """Create (or return) the token of a task running in this process."""
+    with _tokens_lock:
+        token = _tokens.get(task_id)
+        if token is None:
+            token = CancellationToken(task_id)
+            _tokens[task_id] = token
+        return token
+
+
+def release(task_id: str):
+    with _tokens_lock:
+        _tokens.pop(task_id, None)
+
+
+def activate(token: CancellationToken):
+    """Make `token` the current token of this thread/context."""
+    return _current_token.set(token)
+
+
+def deactivate(context_token):
+    _current_token.reset(context_token)
+
+
+def current() -> CancellationToken:
+    return _current_token.get()
+
+
+def check():
+    """Raise TaskCancelledError if the current task has been cancelled."""
+    token = _current_token.get()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def cancel(task_id: str):
+    """
+    Request cancellation of a task. The request is recorded in the state store
+    so that the worker running the task notices it even in another process.
+    """
+    sm.state.request_cancel(task_id)
+    with _tokens_lock:
+        token = _tokens.get(task_id)
+    if token is not None:
+        token.cancel()
+    logger.info(f"cancellation requested for task: {task_id}")
+
+
+def run_process(cmd, poll_interval: float = 0.5, **kwargs) -> subprocess.CompletedProcess:
+    """
+    subprocess.run(cmd, check=True, capture_output=True) that terminates the
+    process when the current task is cancelled.
+    """
+    token = _current_token.get()
+    if token is None:
+        return subprocess.run(cmd, check=True, capture_output=True, **kwargs)
+
+    token.raise_if_cancelled()
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs
+    )
+    token.register_process(process)
+    try:
+        # drain the pipes in the background so a chatty ffmpeg cannot block
+        output = {}
+        reader = threading.Thread(
+            target=lambda: output.update(zip(("stdout", "stderr"), process.communicate()))
+        )
+        reader.daemon = True
+        reader.start()
+        while reader.is_alive():
+            if token.cancelled:
+                _terminate(process)
+                reader.join()
+                raise TaskCancelledError(token.task_id)
+            reader.join(poll_interval)
+    finally:
+        token.unregister_process(process)
+
+    # the process may have been terminated directly by CancellationToken.cancel
+    token.raise_if_cancelled()
+    if process.returncode:
+        raise subprocess.CalledProcessError(
+            process.returncode, cmd, output.get("stdout"), output.get("stderr")
+        )
+    return subprocess.CompletedProcess(
+        cmd, process.returncode, output.get("stdout"), output.get("stderr")
+    )
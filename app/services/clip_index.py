@@ -0,0 +1,395 @@
+"""
+Approximate nearest neighbour index over the clips of the material cache.
+
+Every clip saved by material.save_video is registered with its search term
+(storage/cache/clip_index/entries.db). Embeddings are computed lazily in
+batches on the next query (the embedding store makes repeated terms free) and
+added to a vector index persisted next to the entries, so semantic selection
+can ask for the top-k clips of a segment from the whole material cache
+instead of scoring every clip. The index remembers the last entry and removal
+it has applied, a query only reads the rows registered since.
+
+The index is HNSW (hnswlib) when installed, otherwise a NumPy inverted file
+index: the vectors are bucketed by their closest k-means centroid and a query
+only scans the buckets of its closest centroids. Small indexes are searched
+exhaustively.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+from loguru import logger
+
+from app.config import config
+from app.services import semantic_video
+from app.utils import utils
+
+try:
+    import hnswlib
+
+    HNSW_AVAILABLE = True
+except ImportError:
+    HNSW_AVAILABLE = False
+
+enabled = config.app.get("semantic_index_enabled", True)
+# auto (hnsw if hnswlib is installed, ivf otherwise), hnsw or ivf
+backend = config.app.get("semantic_index_backend", "auto")
+# candidate clips per script segment
+top_k = config.app.get("semantic_index_top_k", 50)
+
+# vectors below which the IVF index is not trained and searched exhaustively
+IVF_MIN_VECTORS = 4096
+IVF_NPROBE = 8
+KMEANS_ITERATIONS = 10
+ENCODE_BATCH = 1024
+
+_local = threading.local()
+_lock = threading.Lock()
+_index = None
+_index_key = None
+# last entry id and removal seq applied to _index
+_cursor = (0, 0)
+
+
+def index_dir() -> str:
+    return utils.storage_dir(os.path.join("cache", "clip_index"), create=True)
+
+
+def _connection() -> sqlite3.Connection:
+    path = os.path.join(index_dir(), "entries.db")
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "path", "") == path:
+        return conn
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # AUTOINCREMENT, ids of removed clips are never reused by the vector index
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS entries ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT UNIQUE, search_term TEXT)"
+    )
+    # removed entries in order, so an index drops them without a full scan
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS removed (seq INTEGER PRIMARY KEY AUTOINCREMENT, entry_id INTEGER)"
+    )
+    conn.commit()
+    _local.conn = conn
+    _local.path = path
+    return conn
+
+
+class IvfIndex:
+    name = "ivf"
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.centroids = None
+        self.lists = np.zeros(0, dtype=np.int32)
+        self.trained_size = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def id_set(self) -> set:
+        return set(self.ids.tolist())
+
+    def _nearest_centroid(self, vectors: np.ndarray) -> np.ndarray:
+        result = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), 8192):
+            result[start : start + 8192] = np.argmax(vectors[start : start + 8192] @ self.centroids.T, axis=1)
+        return result
+
+    def train(self):
+        """Spherical k-means over the indexed vectors."""
+        nlist = max(1, int(np.sqrt(len(self.vectors))))
+        rng = np.random.default_rng(0)
+        centroids = self.vectors[rng.choice(len(self.vectors), nlist, replace=False)].copy()
+        self.centroids = centroids
+        for _ in range(KMEANS_ITERATIONS):
+            lists = self._nearest_centroid(self.vectors)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, lists, self.vectors)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # empty buckets keep their centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+            self.centroids = centroids
+        self.lists = self._nearest_centroid(self.vectors)
+        self.trained_size = len(self.vectors)
+
+    def add(self, ids: np.ndarray, vectors: np.ndarray):
+        self.ids = np.concatenate([self.ids, ids.astype(np.int64)])
+        self.vectors = np.concatenate([self.vectors, vectors.astype(np.float32)])
+        if self.centroids is not None:
+            self.lists = np.concatenate([self.lists, self._nearest_centroid(vectors)])
+        # retrain as the index doubles, the buckets would grow unbalanced otherwise
+        if len(self.ids) >= IVF_MIN_VECTORS and len(self.ids) >= 2 * self.trained_size:
+            self.train()
+
+    def remove(self, ids):
+        keep = ~np.isin(self.ids, np.fromiter(ids, dtype=np.int64))
+        self.ids = self.ids[keep]
+        self.vectors = self.vectors[keep]
+        if self.centroids is not None:
+            self.lists = self.lists[keep]
+
+    def search(self, queries: np.ndarray, k: int) -> List[List[Tuple[int, float]]]:
+        results = []
+        probes = None
+        if self.centroids is not None:
+            probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :IVF_NPROBE]
+        for i, query in enumerate(queries):
+            if probes is None:
+                rows = np.arange(len(self.ids))
+            else:
+                rows = np.flatnonzero(np.isin(self.lists, probes[i]))
+            scores = self.vectors[rows] @ query
+            top = np.argsort(-scores)[:k] if len(scores) <= k else np.argpartition(-scores, k)[:k]
+            top = top[np.argsort(-scores[top])]
+            results.append([(int(self.ids[rows[j]]), float(scores[j])) for j in top])
+        return results
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                ids=self.ids,
+                vectors=self.vectors.astype(np.float16),
+                centroids=self.centroids if self.centroids is not None else np.zeros((0, self.dim)),
+                lists=self.lists,
+                trained_size=self.trained_size,
+            )
+
+    @classmethod
+    def load(cls, path: str, dim: int) -> "IvfIndex":
+        index = cls(dim)
+        with np.load(path) as data:
+            index.ids = data["ids"]
+            index.vectors = data["vectors"].astype(np.float32)
+            index.centroids = data["centroids"] if len(data["centroids"]) else None
+            index.lists = data["lists"]
+            index.trained_size = int(data["trained_size"])
+        return index
+
+
+class HnswIndex:
+    name = "hnsw"
+
+    def __init__(self, dim: int, capacity: int = 1024):
+        self.dim = dim
+        self.index = hnswlib.Index(space="ip", dim=dim)
+        self.index.init_index(max_elements=capacity, ef_construction=200, M=16)
+        self._ids = set()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def id_set(self) -> set:
+        return set(self._ids)
+
+    def add(self, ids: np.ndarray, vectors: np.ndarray):
+        required = self.index.get_current_count() + len(ids)
+        if required > self.index.get_max_elements():
+            self.index.resize_index(max(required, 2 * self.index.get_max_elements()))
+        self.index.add_items(vectors.astype(np.float32), ids.astype(np.int64))
+        self._ids.update(ids.tolist())
+
+    def remove(self, ids):
+        for label in ids:
+            try:
+                self.index.mark_deleted(int(label))
+            except RuntimeError:
+                pass
+            self._ids.discard(label)
+
+    def search(self, queries: np.ndarray, k: int) -> List[List[Tuple[int, float]]]:
+        k = min(k, len(self._ids))
+        if k == 0:
+            return [[] for _ in queries]
+        self.index.set_ef(max(2 * k, 64))
+        labels, distances = self.index.knn_query(queries.astype(np.float32), k=k)
+        # inner product space, the distance is 1 - dot
+        return [
+            [(int(label), 1.0 - float(distance)) for label, distance in zip(row_labels, row_distances)]
+            for row_labels, row_distances in zip(labels, distances)
+        ]
+
+    def save(self, path: str):
+        self.index.save_index(path)
+
+    @classmethod
+    def load(cls, path: str, dim: int) -> "HnswIndex":
+        index = cls.__new__(cls)
+        index.dim = dim
+        index.index = hnswlib.Index(space="ip", dim=dim)
+        index.index.load_index(path)
+        index._ids = set(index.index.get_ids_list())
+        return index
+
+
+def _backend_class():
+    if backend == "hnsw" or (backend == "auto" and HNSW_AVAILABLE):
+        if HNSW_AVAILABLE:
+            return HnswIndex
+        logger.warning("hnswlib is not installed, using the IVF clip index")
+    return IvfIndex
+
+
+def _paths(directory: str, backend_name: str) -> Tuple[str, str]:
+    return os.path.join(directory, f"{backend_name}.index"), os.path.join(directory, f"{backend_name}.json")
+
+
+def _load(directory: str, cls, model: str) -> Tuple[object, Tuple[int, int]]:
+    """The persisted index and its cursor, (None, (0, 0)) if it has to be built."""
+    index_path, meta_path = _paths(directory, cls.name)
+    if not os.path.exists(index_path) or not os.path.exists(meta_path):
+        return None, (0, 0)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("model") != model:
+            logger.info(f"clip index was built with {meta.get('model')}, rebuilding for {model}")
+            return None, (0, 0)
+        if "last_id" not in meta:
+            # saved before the cursor existed
+            return None, (0, 0)
+        return cls.load(index_path, meta["dim"]), (meta["last_id"], meta["last_removed"])
+    except Exception as e:
+        logger.warning(f"failed to load the clip index, rebuilding: {str(e)}")
+        return None, (0, 0)
+
+
+def _save(directory: str, index, model: str, cursor: Tuple[int, int]):
+    index_path, meta_path = _paths(directory, index.name)
+    # other processes may load the index at any time, replace it atomically
+    index.save(f"{index_path}.tmp")
+    os.replace(f"{index_path}.tmp", index_path)
+    with open(f"{meta_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "model": model,
+                "dim": index.dim,
+                "size": len(index),
+                "last_id": cursor[0],
+                "last_removed": cursor[1],
+            },
+            f,
+        )
+    os.replace(f"{meta_path}.tmp", meta_path)
+
+
+def add(video_path: str, search_term: str):
+    """Register a cached clip, its embedding is computed on the next query."""
+    add_many([(video_path, search_term)])
+
+
+def add_many(items: List[Tuple[str, str]]):
+    items = [(path, term) for path, term in items if path and term]
+    if not enabled or not items:
+        return
+    try:
+        conn = _connection()
+        conn.executemany("INSERT OR IGNORE INTO entries (path, search_term) VALUES (?, ?)", items)
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.warning(f"failed to register clips in the clip index: {str(e)}")
+
+
+def remove(video_paths: List[str]):
+    conn = _connection()
+    rows = _select_chunked(conn, "SELECT id FROM entries WHERE path IN ({})", list(video_paths))
+    with conn:
+        conn.executemany("INSERT INTO removed (entry_id) VALUES (?)", rows)
+        conn.executemany("DELETE FROM entries WHERE path = ?", [(path,) for path in video_paths])
+
+
+def sync():
+    """Embed the clips registered since the last sync and drop the ones removed since."""
+    global _index, _index_key, _cursor
+    directory = index_dir()
+    cls = _backend_class()
+    model = semantic_video.model_key()
+    conn = _connection()
+    with _lock:
+        if _index is None or _index_key != (directory, cls.name, model):
+            _index, _cursor = _load(directory, cls, model)
+            _index_key = (directory, cls.name, model)
+        last_id, last_removed = _cursor
+        if _index is None:
+            # a new index starts from the current entries, earlier removals are already gone
+            last_id = 0
+            last_removed = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM removed").fetchone()[0]
+        removed = conn.execute(
+            "SELECT seq, entry_id FROM removed WHERE seq > ? ORDER BY seq", (last_removed,)
+        ).fetchall()
+        pending = conn.execute(
+            "SELECT id, search_term FROM entries WHERE id > ? ORDER BY id", (last_id,)
+        ).fetchall()
+        if not pending and not removed:
+            _cursor = (last_id, last_removed)
+            return
+
+        for start in range(0, len(pending), ENCODE_BATCH):
+            batch = pending[start : start + ENCODE_BATCH]
+            terms = [term for _, term in batch]
+            unique_terms = list(dict.fromkeys(terms))
+            term_vectors = dict(zip(unique_terms, semantic_video.encode_texts(unique_terms)))
+            vectors = np.stack([term_vectors[term] for term in terms])
+            if _index is None:
+                _index = cls(vectors.shape[1])
+            _index.add(np.array([entry_id for entry_id, _ in batch], dtype=np.int64), vectors)
+        # after the additions, a clip may have been added and removed since the last sync
+        if removed and _index is not None:
+            _index.remove({entry_id for _, entry_id in removed})
+        _cursor = (pending[-1][0] if pending else last_id, removed[-1][0] if removed else last_removed)
+        if _index is not None:
+            _save(directory, _index, model, _cursor)
+        logger.info(f"clip index: added {len(pending)} clips, removed {len(removed)}, size {len(_index or [])}")
+
+
+def _select_chunked(conn: sqlite3.Connection, query: str, values: list) -> list:
+    """Run `query` with an `IN ({})` clause over `values`, below the SQLite variable limit."""
+    rows = []
+    for start in range(0, len(values), 500):
+        chunk = values[start : start + 500]
+        rows.extend(conn.execute(query.format(",".join("?" * len(chunk))), chunk))
+    return rows
+
+
+def search(queries: np.ndarray, k: int = 0) -> List[List[Tuple[str, float]]]:
+    """Top-k clips (path, similarity) of every query embedding, best first."""
+    k = k or top_k
+    sync()
+    conn = _connection()
+    with _lock:
+        if _index is None or not len(_index):
+            return [[] for _ in queries]
+        results = _index.search(np.asarray(queries, dtype=np.float32), k)
+    found = list({entry_id for row in results for entry_id, _ in row})
+    paths: Dict[int, str] = dict(_select_chunked(conn, "SELECT id, path FROM entries WHERE id IN ({})", found))
+
+    missing = [path for path in paths.values() if not os.path.exists(path)]
+    if missing:
+        # evicted from the cache, dropped from the vector index on the next sync
+        remove(missing)
+    missing = set(missing)
+    return [
+        [(paths[entry_id], score) for entry_id, score in row if entry_id in paths and paths[entry_id] not in missing]
+        for row in results
+    ]
+
+
+def get_stats() -> dict:
+    stats = {"enabled": enabled, "backend": _backend_class().name}
+    try:
+        stats["entries"] = _connection().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+    except sqlite3.Error as e:
+        logger.warning(f"failed to read clip index stats: {str(e)}")
+    with _lock:
+        stats["indexed"] = len(_index) if _index is not None else 0
+    return stats
@@ -0,0 +1,96 @@
+"""
+Inference backends of the sentence-transformer model.
+
+- torch: the float32 PyTorch model
+- onnx: the model exported to ONNX and run by ONNX Runtime
+- onnx-int8: the ONNX model with int8 dynamic quantization, fastest on CPU
+
+ONNX models are exported on first use and cached under storage/cache/models,
+later loads skip the PyTorch weights. The export needs
+`optimum[onnxruntime]`, if it is missing or fails the torch backend is used.
+
+Run `python -m test.benchmark_embedding_backend` to compare the load time,
+throughput and output parity of the backends on this machine.
+"""
+
+import os
+import platform
+import shutil
+import threading
+from typing import Tuple
+
+from loguru import logger
+from sentence_transformers import SentenceTransformer
+
+from app.config import config
+from app.utils import utils
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+backend = config.app.get("semantic_backend", "torch")
+# arm64, avx2, avx512 or avx512_vnni, empty picks arm64 or avx2 by machine
+quantization = config.app.get("semantic_onnx_quantization", "")
+
+_export_lock = threading.Lock()
+
+
+def models_dir() -> str:
+    return utils.storage_dir(os.path.join("cache", "models"), create=True)
+
+
+def quantization_config() -> str:
+    if quantization:
+        return quantization
+    return "arm64" if platform.machine().lower() in ("arm64", "aarch64") else "avx2"
+
+
+def export_dir(model_name: str) -> str:
+    return os.path.join(models_dir(), model_name.replace("/", "--"))
+
+
+def onnx_file_name(quantized: bool) -> str:
+    return f"onnx/model_qint8_{quantization_config()}.onnx" if quantized else "onnx/model.onnx"
+
+
+def _export(model_name: str, quantized: bool) -> str:
+    """Export (and quantize) the model once, returns the directory of the ONNX model."""
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    target = export_dir(model_name)
+    with _export_lock:
+        if not os.path.exists(os.path.join(target, onnx_file_name(False))):
+            logger.info(f"exporting {model_name} to ONNX, this happens only once")
+            # other processes may export at the same time, publish atomically
+            temp_dir = f"{target}.tmp-{os.getpid()}"
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            SentenceTransformer(model_name, device="cpu", backend="onnx").save_pretrained(temp_dir)
+            try:
+                os.rename(temp_dir, target)
+            except OSError:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+        if quantized and not os.path.exists(os.path.join(target, onnx_file_name(True))):
+            logger.info(f"quantizing {model_name} to int8 ({quantization_config()})")
+            model = SentenceTransformer(target, device="cpu", backend="onnx")
+            export_dynamic_quantized_onnx_model(model, quantization_config(), target)
+    return target
+
+
+def _load_onnx(model_name: str, quantized: bool) -> SentenceTransformer:
+    target = _export(model_name, quantized)
+    return SentenceTransformer(
+        target, device="cpu", backend="onnx", model_kwargs={"file_name": onnx_file_name(quantized)}
+    )
+
+
+def load(model_name: str, name: str = "") -> Tuple[SentenceTransformer, str]:
+    """Load the model with the backend `name` (the configured one by default), returns the model and the backend used."""
+    name = name or backend
+    if name in ("onnx", "onnx-int8"):
+        try:
+            return _load_onnx(model_name, name == "onnx-int8"), name
+        except Exception as e:
+            logger.warning(f"failed to load {model_name} with the {name} backend, using torch: {str(e)}")
+    elif name != "torch":
+        logger.warning(f"unknown semantic backend: {name}, using torch")
+    return SentenceTransformer(model_name, device="cpu"), "torch"
@@ -0,0 +1,174 @@
+"""
+Persistent store of sentence embeddings.
+
+Search terms repeat across tasks ("ocean waves", "city night"), so their
+embeddings are kept in SQLite (storage/cache/embeddings.db) keyed by the
+semantic model and the hash of the text, as float16 blobs. The database is
+shared by all processes and bounded to the most recently used entries.
+Models whose key starts with a prefix passed to set_budget (e.g. the CLIP
+frame vectors of every cached clip) have their own bound, so they do not
+evict the other embeddings.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+from loguru import logger
+
+from app.config import config
+from app.utils import utils
+
+enabled = config.app.get("embedding_cache_enabled", True)
+max_entries = config.app.get("embedding_cache_max_entries", 100000)
+# evict least recently used entries every N writes
+PRUNE_EVERY = 100
+# hits refresh the last use of an entry at most this often
+TOUCH_INTERVAL = 3600
+
+_local = threading.local()
+_lock = threading.Lock()
+_writes = 0
+_stats = {"hits": 0, "misses": 0, "evicted": 0}
+# model key prefix -> max entries of the models with that prefix
+_budgets = {}
+
+
+def db_path() -> str:
+    return os.path.join(utils.storage_dir("cache", create=True), "embeddings.db")
+
+
+def _connection() -> sqlite3.Connection:
+    path = db_path()
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "path", "") == path:
+        return conn
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS embeddings ("
+        "model TEXT, text_hash TEXT, embedding BLOB, last_used REAL, "
+        "PRIMARY KEY (model, text_hash))"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+    conn.commit()
+    _local.conn = conn
+    _local.path = path
+    return conn
+
+
+def set_budget(prefix: str, entries: int):
+    """Bound the models whose key starts with `prefix` to their own `entries`, apart from max_entries."""
+    _budgets[prefix] = entries
+
+
+def text_hash(text: str) -> str:
+    return utils.md5(text)
+
+
+def get_many(model: str, texts: List[str]) -> Dict[str, np.ndarray]:
+    """Stored float32 embeddings of the given texts, missing texts are left out."""
+    hashes = {text_hash(text): text for text in dict.fromkeys(texts)}
+    if not enabled or not hashes:
+        return {}
+    found = {}
+    touch = []
+    now = time.time()
+    try:
+        conn = _connection()
+        keys = list(hashes)
+        # stay below the SQLite variable limit
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            rows = conn.execute(
+                f"SELECT text_hash, embedding, last_used FROM embeddings "
+                f"WHERE model = ? AND text_hash IN ({','.join('?' * len(chunk))})",
+                [model] + chunk,
+            )
+            for key, blob, last_used in rows:
+                found[hashes[key]] = np.frombuffer(blob, dtype=np.float16).astype(np.float32)
+                if now - last_used > TOUCH_INTERVAL:
+                    touch.append((now, model, key))
+        if touch:
+            conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?", touch
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.warning(f"embedding store is unavailable: {str(e)}")
+    with _lock:
+        _stats["hits"] += len(found)
+        _stats["misses"] += len(hashes) - len(found)
+    return found
+
+
+def put_many(model: str, texts: List[str], embeddings: np.ndarray):
+    global _writes
+    if not enabled or not len(texts):
+        return
+    now = time.time()
+    rows = [
+        (model, text_hash(text), np.asarray(vector, dtype=np.float16).tobytes(), now)
+        for text, vector in zip(texts, embeddings)
+    ]
+    try:
+        conn = _connection()
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, text_hash, embedding, last_used) "
+            "VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.warning(f"failed to store embeddings: {str(e)}")
+        return
+    with _lock:
+        before = _writes
+        _writes += len(rows)
+        prune_now = _writes // PRUNE_EVERY != before // PRUNE_EVERY
+    if prune_now:
+        prune()
+
+
+def prune() -> int:
+    """Evict the least recently used entries above max_entries and above each budget."""
+    budgets = dict(_budgets)
+    # (condition, parameters, limit) of every budget and of the remaining models
+    groups = [("substr(model, 1, ?) = ?", [len(prefix), prefix], entries) for prefix, entries in budgets.items()]
+    groups.append((
+        " AND ".join(["substr(model, 1, ?) != ?"] * len(budgets)) or "1",
+        [value for prefix in budgets for value in (len(prefix), prefix)],
+        max_entries,
+    ))
+    evicted = 0
+    try:
+        conn = _connection()
+        for condition, parameters, limit in groups:
+            cursor = conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN ("
+                f"SELECT rowid FROM embeddings WHERE {condition} ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                parameters + [limit],
+            )
+            evicted += cursor.rowcount
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.warning(f"failed to prune embeddings: {str(e)}")
+        return 0
+    with _lock:
+        _stats["evicted"] += evicted
+    return evicted
+
+
+def get_stats() -> dict:
+    with _lock:
+        stats = dict(_stats)
+    stats["enabled"] = enabled
+    try:
+        stats["entries"] = _connection().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    except sqlite3.Error as e:
+        logger.warning(f"failed to read embedding store stats: {str(e)}")
+    return stats
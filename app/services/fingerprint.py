@@ -0,0 +1,110 @@
+"""
+Perceptual fingerprints of video clips.
+
+A fingerprint is the list of 64-bit pHashes of a few frames sampled across
+the clip, stored as hex strings in the `_metadata.json` sidecar. Two clips
+are near-duplicates when most of the frames of one have a close match
+(small Hamming distance) among the frames of the other, which also catches
+the same footage re-encoded, resized or served by another provider.
+"""
+
+import subprocess
+from typing import Iterable, List, Optional
+
+import numpy as np
+from loguru import logger
+
+from app.config import config
+from app.services import cancellation, semantic_video
+
+# maximum Hamming distance (of 64 bits) between matching frames, 0 disables
+# the near-duplicate detection
+threshold = config.app.get("material_dedup_threshold", 10)
+SAMPLES = 5
+HASH_SIZE = 8
+FRAME_SIZE = 32
+MIN_FRAME_STD = 4.0
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] *= 1 / np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+
+_DCT = _dct_matrix(FRAME_SIZE)
+
+
+def phash(frame: np.ndarray) -> int:
+    """pHash of a 32x32 grayscale frame: signs of the low 8x8 DCT frequencies against their median."""
+    coefficients = _DCT @ frame.astype(np.float64) @ _DCT.T
+    low = coefficients[:HASH_SIZE, :HASH_SIZE].flatten()
+    bits = low[1:] > np.median(low[1:])
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def sample_frames(video_path: str, duration: float, samples: int = SAMPLES) -> List[np.ndarray]:
+    """Decode `samples` frames spread over the clip as 32x32 grayscale arrays."""
+    frames = []
+    for i in range(samples):
+        timestamp = duration * (i + 0.5) / samples
+        cmd = [
+            "ffmpeg", "-v", "error", "-ss", f"{timestamp:.3f}", "-i", video_path,
+            "-frames:v", "1", "-vf", f"scale={FRAME_SIZE}:{FRAME_SIZE},format=gray",
+            "-f", "rawvideo", "-",
+        ]
+        try:
+            result = cancellation.run_process(cmd)
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"failed to sample frame at {timestamp:.1f}s of {video_path}: {e}")
+            continue
+        data = result.stdout
+        if len(data) >= FRAME_SIZE * FRAME_SIZE:
+            frame = np.frombuffer(data[: FRAME_SIZE * FRAME_SIZE], dtype=np.uint8)
+            frames.append(frame.reshape(FRAME_SIZE, FRAME_SIZE))
+    return frames
+
+
+def compute(video_path: str, duration: float) -> List[str]:
+    """Fingerprint of a clip, empty if no frame could be decoded."""
+    if duration <= 0:
+        return []
+    return [
+        f"{phash(frame):016x}"
+        for frame in sample_frames(video_path, duration)
+        # flat frames (fades, black frames) carry no information and would
+        # match each other across unrelated clips
+        if frame.std() >= MIN_FRAME_STD
+    ]
+
+
+def load(video_path: str) -> List[str]:
+    """Fingerprint stored in the metadata sidecar of a clip."""
+    metadata = semantic_video.load_video_metadata(video_path) or {}
+    return metadata.get("fingerprint") or []
+
+
+def distance(a: List[str], b: List[str]) -> Optional[float]:
+    """
+    Median over the frames of `a` of the Hamming distance to the closest
+    frame of `b`, None if either fingerprint is empty.
+    """
+    if not a or not b:
+        return None
+    hashes_b = [int(h, 16) for h in b]
+    closest = [min(bin(int(h, 16) ^ other).count("1") for other in hashes_b) for h in a]
+    return float(np.median(closest))
+
+
+def is_duplicate(fp: List[str], others: Iterable[List[str]]) -> bool:
+    if not threshold or not fp:
+        return False
+    for other in others:
+        d = distance(fp, other)
+        if d is not None and d <= threshold:
+            return True
+    return False
@@ -0,0 +1,176 @@
+"""
+CLIP embeddings of frames sampled from the cached clips themselves.
+
+Thumbnails and preview images are remote (a download per scoring) and do
+not exist for every provider or for local material. Instead, a few frames
+spread over each clip are decoded locally with ffmpeg and embedded with CLIP
+once; the vectors are kept in the embedding store under the clip path and
+the sampled timestamps (the middle of each shot when the shots of the clip
+are known) in the `frame_times` entry of the metadata sidecar. The frame
+vectors have their own bound in the store (clip_frame_cache_max_entries).
+Image similarity is then a matrix product in memory. A clip whose vectors
+were pruned from the store is indexed again on its next use.
+"""
+
+import contextvars
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+from app.config import config
+from app.services import cancellation, embedding_store, image_similarity, material, semantic_video, shots
+
+enabled = config.app.get("clip_frame_embeddings_enabled", True)
+samples = config.app.get("clip_frame_samples", 8)
+# frame vectors are bounded apart from the sentence and thumbnail embeddings
+max_entries = config.app.get("clip_frame_cache_max_entries", 200000)
+# CLIP input resolution, frames are center-cropped to a square like its processor does
+FRAME_SIZE = 224
+INDEX_WORKERS = 4
+
+
+MODEL_KEY_PREFIX = "clip-frame:"
+embedding_store.set_budget(MODEL_KEY_PREFIX, max_entries)
+
+
+def _model_key(model_name: str) -> str:
+    return f"{MODEL_KEY_PREFIX}{model_name}"
+
+
+def _frame_key(video_path: str, timestamp: float) -> str:
+    # the file size tells a replaced local file from the one that was indexed
+    return f"{os.path.abspath(video_path)}:{os.path.getsize(video_path)}@{timestamp:.2f}"
+
+
+def frame_times(duration: float, count: int = 0) -> List[float]:
+    """`count` timestamps spread evenly over a clip of `duration` seconds."""
+    count = count or samples
+    if duration <= 0:
+        return []
+    return [round(duration * (i + 0.5) / count, 2) for i in range(count)]
+
+
+def sample_frame(video_path: str, timestamp: float) -> Optional[Image.Image]:
+    """Decode the frame at `timestamp` as a FRAME_SIZE square RGB image, None on failure."""
+    cmd = [
+        "ffmpeg", "-v", "error", "-ss", f"{timestamp:.3f}", "-i", video_path,
+        "-frames:v", "1",
+        "-vf", f"scale={FRAME_SIZE}:{FRAME_SIZE}:force_original_aspect_ratio=increase,crop={FRAME_SIZE}:{FRAME_SIZE}",
+        "-pix_fmt", "rgb24", "-f", "rawvideo", "-",
+    ]
+    try:
+        data = cancellation.run_process(cmd).stdout
+    except subprocess.CalledProcessError as e:
+        logger.warning(f"failed to sample frame at {timestamp:.1f}s of {video_path}: {e}")
+        return None
+    size = FRAME_SIZE * FRAME_SIZE * 3
+    if len(data) < size:
+        return None
+    return Image.fromarray(np.frombuffer(data[:size], dtype=np.uint8).reshape(FRAME_SIZE, FRAME_SIZE, 3))
+
+
+def _load(video_metadata: Dict, model_name: str) -> Optional[np.ndarray]:
+    """Stored frame embeddings of a clip, None unless all of its frames are indexed."""
+    times = video_metadata.get("frame_times")
+    video_path = video_metadata.get("video_path", "")
+    if not times or not os.path.exists(video_path):
+        return None
+    keys = [_frame_key(video_path, t) for t in times]
+    stored = embedding_store.get_many(_model_key(model_name), keys)
+    if len(stored) < len(keys):
+        return None
+    return np.stack([stored[key] for key in keys])
+
+
+def _sample(video_metadata: Dict) -> List[Tuple[float, Image.Image]]:
+    video_path = video_metadata["video_path"]
+    # one frame per shot if the shots are known, else spread over the clip
+    times = (
+        video_metadata.get("frame_times")
+        or shots.sample_times(video_metadata.get("shots") or [], samples)
+        or frame_times(material.probe_video(video_path) or 0.0)
+    )
+    frames = [(t, sample_frame(video_path, t)) for t in times]
+    return [(t, frame) for t, frame in frames if frame is not None]
+
+
+def _save(video_metadata: Dict, times: List[float]):
+    video_metadata["frame_times"] = times
+    video_path = video_metadata["video_path"]
+    metadata = semantic_video.load_video_metadata(video_path)
+    if metadata is not None and metadata.get("frame_times") != times:
+        semantic_video.update_video_metadata(video_path, frame_times=times)
+
+
+def index(video_metadata: List[Dict], model_name: str = "clip-vit-base-patch32") -> Dict[str, np.ndarray]:
+    """
+    Frame embeddings (frames x dim) of every clip by video path. Clips that
+    are not indexed yet are sampled concurrently and encoded in batches;
+    clips without a local file or without a decodable frame are left out.
+    """
+    embeddings = {}
+    missing = []
+    for v in video_metadata:
+        path = v.get("video_path", "")
+        if not path or path in embeddings:
+            continue
+        vectors = _load(v, model_name)
+        if vectors is not None:
+            embeddings[path] = vectors
+        elif os.path.exists(path):
+            missing.append(v)
+    if not missing:
+        return embeddings
+
+    # the decoders run in the task's context, so they stop when it is cancelled
+    with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, _sample, v) for v in missing]
+        sampled = [future.result() for future in futures]
+    frames = [(v, t, image) for v, clip_frames in zip(missing, sampled) for t, image in clip_frames]
+    vectors = []
+    for start in range(0, len(frames), image_similarity.IMAGE_BATCH_SIZE):
+        batch = [image for _, _, image in frames[start : start + image_similarity.IMAGE_BATCH_SIZE]]
+        vectors.extend(image_similarity.encode_clip_images(batch, model_name))
+
+    by_clip: Dict[str, list] = {}
+    for (v, t, _), vector in zip(frames, vectors):
+        by_clip.setdefault(v["video_path"], []).append((t, vector))
+    for v in missing:
+        path = v["video_path"]
+        if path not in by_clip:
+            logger.warning(f"no frame could be decoded from {path}, using its thumbnails")
+            continue
+        times = [t for t, _ in by_clip[path]]
+        embeddings[path] = np.stack([vector for _, vector in by_clip[path]])
+        embedding_store.put_many(
+            _model_key(model_name), [_frame_key(path, t) for t in times], embeddings[path]
+        )
+        _save(v, times)
+    logger.info(f"🎞️  Indexed {len(by_clip)} clips, {len(frames)} frames")
+    return embeddings
+
+
+def shot_scores(
+    video_path: str, shot_list: List[List[float]], text: str, model_name: str = "clip-vit-base-patch32"
+) -> Optional[List[Optional[float]]]:
+    """
+    Cosine similarity of `text` to the best sampled frame of every shot,
+    None for shots without a sampled frame; None if the clip has no frames.
+    """
+    metadata = semantic_video.load_video_metadata(video_path)
+    if not metadata:
+        return None
+    vectors = index([metadata], model_name).get(video_path)
+    if vectors is None:
+        return None
+    similarities = vectors @ image_similarity.text_embeddings([text], model_name)[text]
+    scores = []
+    for start, end in shot_list:
+        inside = [float(s) for t, s in zip(metadata["frame_times"], similarities) if start <= t < end]
+        scores.append(max(inside) if inside else None)
+    return scores
@@ -11,17 +11,20 @@ import time
 import gc
 import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor
 try:
     import psutil  # For memory monitoring
     PSUTIL_AVAILABLE = True
 except ImportError:
     PSUTIL_AVAILABLE = False
+from collections import OrderedDict
 from typing import List, Dict, Optional
 from PIL import Image
 import io
 import numpy as np
 from loguru import logger
 from app.config import config
+from app.services import embedding_store, model_server
 
 # Suppress transformers warnings about slow processors
 warnings.filterwarnings("ignore", message=".*slow.*processor.*")
@@ -34,10 +37,78 @@ _model_load_fails = 0  # Track model loading failures
 _max_load_retries = 3  # Maximum retries before giving up
 _force_cpu_only = True  # Force CPU-only mode to avoid GPU issues
 
+class EmbeddingLRU:
+    """Thread-safe LRU cache of embedding vectors, bounded by their size in bytes"""
+    
+    # dict entry, key and array object overhead, roughly
+    ENTRY_OVERHEAD = 200
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _size(self, key: str, vector: np.ndarray) -> int:
+        return vector.nbytes + len(key) + self.ENTRY_OVERHEAD
+    
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+    
+    def put(self, key: str, vector: np.ndarray):
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._size(key, self._entries.pop(key))
+            self._entries[key] = vector
+            self.bytes += self._size(key, vector)
+            while self.bytes > self.max_bytes and self._entries:
+                old_key, old_vector = self._entries.popitem(last=False)
+                self.bytes -= self._size(old_key, old_vector)
+                self.evictions += 1
+    
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
 # Add embedding cache to avoid reprocessing same images/text
-_image_embedding_cache = {}
-_text_embedding_cache = {}
-_cache_max_size = 100  # Limit cache size to prevent memory issues
+_image_embedding_cache = EmbeddingLRU(config.app.get("clip_image_cache_mb", 64) * 1024 * 1024)
+_text_embedding_cache = EmbeddingLRU(config.app.get("clip_text_cache_mb", 16) * 1024 * 1024)
+# Image embeddings are also kept on disk (the embedding store) keyed by the image URL hash
+_persistent_image_cache = config.app.get("clip_image_cache_persistent", True)
+_persistent_stats = {'hits': 0, 'misses': 0}
+_persistent_stats_lock = threading.Lock()
 _caching_enabled = True  # Can be disabled for testing or if memory is limited
 
 # Rate limiting to prevent memory issues
@@ -45,6 +116,8 @@ _last_inference_time = 0
 _inference_count = 0
 INFERENCE_DELAY = 0.15  # Slightly increased delay for stability
 MAX_BATCH_SIZE = 10    # Process in smaller batches
+IMAGE_BATCH_SIZE = 32  # Images per CLIP forward pass of similarity_matrix
+FETCH_WORKERS = 8      # Concurrent thumbnail downloads of similarity_matrix
 
 def check_image_similarity_dependencies() -> bool:
     """Check if image similarity dependencies are available"""
@@ -186,6 +259,192 @@ def load_clip_model(model_name: str = "clip-vit-base-patch32"):
         
         raise
 
+def _normalized(features) -> np.ndarray:
+    import torch
+    
+    # transformers 5 returns the projected features as pooler_output
+    if not torch.is_tensor(features):
+        features = features.pooler_output
+    features = features / features.norm(p=2, dim=-1, keepdim=True)
+    return features.detach().cpu().numpy().astype(np.float32)
+
+def encode_clip_texts(texts: List[str], model_name: str = "clip-vit-base-patch32") -> np.ndarray:
+    """L2-normalized CLIP embeddings of texts, from the model server if enabled"""
+    if model_server.available():
+        try:
+            return model_server.embed_clip_texts(texts, model_name)
+        except Exception as e:
+            safe_log("warning", f"⚠️  {e}")
+    import torch
+    
+    model, processor = load_clip_model(model_name)
+    with torch.no_grad():
+        inputs = processor(text=texts, return_tensors="pt", padding=True, truncation=True)
+        return _normalized(model.get_text_features(**inputs))
+
+def encode_clip_images(images: List[Image.Image], model_name: str = "clip-vit-base-patch32") -> np.ndarray:
+    """L2-normalized CLIP embeddings of images, from the model server if enabled"""
+    if model_server.available():
+        try:
+            return model_server.embed_clip_images(images, model_name)
+        except Exception as e:
+            safe_log("warning", f"⚠️  {e}")
+    import torch
+    
+    model, processor = load_clip_model(model_name)
+    with torch.no_grad():
+        inputs = processor(images=images, return_tensors="pt")
+        return _normalized(model.get_image_features(**inputs))
+
+def fetch_image(image_url: str, max_bytes: int = 10 * 1024 * 1024, max_side: int = 512) -> Optional[Image.Image]:
+    """Download an image with size limits, downscaled for CLIP; None on failure"""
+    try:
+        with requests.get(
+            image_url,
+            timeout=(5, 10),
+            stream=True,
+            headers={'User-Agent': 'Mozilla/5.0 (compatible; ImageBot/1.0)'},
+        ) as response:
+            response.raise_for_status()
+            image_data = b""
+            for chunk in response.iter_content(chunk_size=65536):
+                image_data += chunk
+                if len(image_data) > max_bytes:
+                    safe_log("warning", f"Image exceeds {max_bytes} bytes, skipping: {image_url}")
+                    return None
+        image = Image.open(io.BytesIO(image_data)).convert('RGB')
+        if max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        return image
+    except Exception as e:
+        safe_log("warning", f"Failed to fetch image {image_url}: {e}")
+        return None
+
+def _video_image_urls(video_metadata: Dict) -> List[str]:
+    image_urls = []
+    if video_metadata.get('thumbnail_url'):
+        image_urls.append(video_metadata['thumbnail_url'])
+    if video_metadata.get('preview_images'):
+        image_urls.extend(video_metadata['preview_images'])
+    return select_representative_images(image_urls, max_images=1)
+
+def _persistent_model_key(model_name: str) -> str:
+    return f"clip-image:{model_name}"
+
+def _cached_image_embeddings(image_urls: List[str], model_name: str) -> Dict[str, np.ndarray]:
+    """Image embeddings from the memory cache, then from the persistent tier"""
+    if not _caching_enabled:
+        return {}
+    embeddings = {}
+    missing = []
+    for url in dict.fromkeys(image_urls):
+        vector = _image_embedding_cache.get(f"{model_name}:{url}")
+        if vector is not None:
+            embeddings[url] = vector
+        else:
+            missing.append(url)
+    if missing and _persistent_image_cache:
+        stored = embedding_store.get_many(_persistent_model_key(model_name), missing)
+        with _persistent_stats_lock:
+            _persistent_stats['hits'] += len(stored)
+            _persistent_stats['misses'] += len(missing) - len(stored)
+        for url, vector in stored.items():
+            _image_embedding_cache.put(f"{model_name}:{url}", vector)
+            embeddings[url] = vector
+    return embeddings
+
+def _cache_image_embeddings(image_urls: List[str], vectors: np.ndarray, model_name: str):
+    if not _caching_enabled:
+        return
+    for url, vector in zip(image_urls, vectors):
+        _image_embedding_cache.put(f"{model_name}:{url}", vector)
+    if _persistent_image_cache:
+        embedding_store.put_many(_persistent_model_key(model_name), image_urls, vectors)
+
+def _image_embeddings(image_urls: List[str], model_name: str) -> Dict[str, np.ndarray]:
+    """Embeddings of image URLs: cached ones, the rest fetched concurrently and encoded in batches"""
+    embeddings = _cached_image_embeddings(image_urls, model_name)
+    missing = [url for url in dict.fromkeys(image_urls) if url not in embeddings]
+    if not missing:
+        return embeddings
+    
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        images = list(executor.map(fetch_image, missing))
+    fetched = [(url, image) for url, image in zip(missing, images) if image is not None]
+    for start in range(0, len(fetched), IMAGE_BATCH_SIZE):
+        batch = fetched[start:start + IMAGE_BATCH_SIZE]
+        vectors = encode_clip_images([image for _, image in batch], model_name)
+        embeddings.update(zip([url for url, _ in batch], vectors))
+        _cache_image_embeddings([url for url, _ in batch], vectors, model_name)
+    return embeddings
+
+def text_embeddings(texts: List[str], model_name: str) -> Dict[str, np.ndarray]:
+    embeddings = {}
+    missing = []
+    for text in dict.fromkeys(texts):
+        cached = _text_embedding_cache.get(f"{model_name}:{text}") if _caching_enabled else None
+        if cached is not None:
+            embeddings[text] = cached
+        else:
+            missing.append(text)
+    if missing:
+        for text, vector in zip(missing, encode_clip_texts(missing, model_name)):
+            embeddings[text] = vector
+            if _caching_enabled:
+                _text_embedding_cache.put(f"{model_name}:{text}", vector)
+    return embeddings
+
+def _frame_embeddings(video_metadata: List[Dict], model_name: str) -> Dict[str, np.ndarray]:
+    """Embeddings of frames sampled from the local clips, by video path"""
+    from app.services import frame_embeddings
+    
+    if not frame_embeddings.enabled:
+        return {}
+    try:
+        return frame_embeddings.index(video_metadata, model_name)
+    except Exception as e:
+        safe_log("warning", f"⚠️  Frame embeddings are unavailable, using thumbnails: {e}")
+        return {}
+
+def similarity_matrix(texts: List[str], video_metadata: List[Dict], model_name: str = "clip-vit-base-patch32") -> np.ndarray:
+    """
+    Image similarity of every text (rows) to every video (columns), on the
+    same 0..1 scale as calculate_video_image_similarity. Videos are scored by
+    the frames sampled from their local clip, or else by their thumbnails,
+    which are fetched concurrently; images and texts are encoded in batches.
+    Videos without any image (or whose image failed to load) score 0.
+    """
+    scores = np.zeros((len(texts), len(video_metadata)), dtype=np.float32)
+    if not IMAGE_SIMILARITY_AVAILABLE or not texts or not video_metadata:
+        return scores
+    
+    frame_embeddings = _frame_embeddings(video_metadata, model_name)
+    video_urls = [
+        [] if v.get('video_path') in frame_embeddings else _video_image_urls(v)
+        for v in video_metadata
+    ]
+    image_embeddings = _image_embeddings([url for urls in video_urls for url in urls], model_name)
+    if not image_embeddings and not frame_embeddings:
+        return scores
+    text_vectors = text_embeddings(texts, model_name)
+    
+    text_matrix = np.stack([text_vectors[text] for text in texts])
+    for j, (v, urls) in enumerate(zip(video_metadata, video_urls)):
+        vectors = frame_embeddings.get(v.get('video_path'))
+        if vectors is None:
+            vectors = [image_embeddings[url] for url in urls if url in image_embeddings]
+            if not vectors:
+                continue
+            vectors = np.stack(vectors)
+        # best matching image of the video, cosine mapped from (-1, 1) to (0, 1)
+        scores[:, j] = ((text_matrix @ vectors.T).max(axis=1) + 1) / 2
+    safe_log(
+        "info",
+        f"🖼️  Image similarity matrix: {len(texts)} texts × {len(video_metadata)} videos, "
+        f"{len(frame_embeddings)} clips by frames, {len(image_embeddings)} images",
+    )
+    return scores
+
 @timeout_wrapper(timeout_seconds=30)  # Re-enable timeout protection
 def calculate_text_image_similarity(text: str, image_url: str, model_name: str = "clip-vit-base-patch32") -> float:
     """Calculate similarity between text and image using CLIP"""
@@ -205,24 +464,15 @@ def calculate_text_image_similarity(text: str, image_url: str, model_name: str =
         
         import torch
         
-        # Check cache first
+        # Check caches first (memory, then the persistent image tier)
         text_cache_key = f"{model_name}:{text}"
-        image_cache_key = f"{model_name}:{image_url}"
+        text_embeds = _text_embedding_cache.get(text_cache_key) if _caching_enabled else None
+        image_embeds = _cached_image_embeddings([image_url], model_name).get(image_url)
         
         # If both embeddings are cached, calculate similarity directly
-        if _caching_enabled and text_cache_key in _text_embedding_cache and image_cache_key in _image_embedding_cache:
-            try:
-                text_embeds = _text_embedding_cache[text_cache_key]
-                image_embeds = _image_embedding_cache[image_cache_key]
-                
-                with torch.no_grad():
-                    similarity = torch.cosine_similarity(text_embeds, image_embeds, dim=-1).item()
-                    similarity = (similarity + 1) / 2  # Convert from (-1, 1) to (0, 1)
-                    
-                return float(similarity)
-            except Exception as cache_error:
-                safe_log("error", f"❌ Error calculating from cache: {cache_error}")
-                # Continue with fresh calculation
+        if text_embeds is not None and image_embeds is not None:
+            # Convert from (-1, 1) to (0, 1)
+            return (float(np.dot(text_embeds, image_embeds)) + 1) / 2
         
         # Rate limiting to prevent overwhelming the system
         current_time = time.time()
@@ -234,38 +484,32 @@ def calculate_text_image_similarity(text: str, image_url: str, model_name: str =
         # Periodic cleanup every 200 inferences - minimal logging
         if _inference_count % 200 == 0:
             try:
-                clear_cache_if_needed()
                 gc.collect()
                 if torch.cuda.is_available():
                     torch.cuda.empty_cache()
             except Exception as cleanup_error:
                 safe_log("error", f"❌ Error during cleanup: {cleanup_error}")
         
-        # Load model - reduced logging
-        try:
-            model, processor = load_clip_model(model_name)
-        except Exception as model_error:
-            safe_log("error", f"❌ Error loading CLIP model: {model_error}")
-            
-            # Try to reset and reload model once
+        # Load model - reduced logging, the model server hosts its own
+        if not model_server.available():
             try:
-                safe_log("warning", "🔄 Attempting model reset and reload...")
-                reset_clip_model()
-                model, processor = load_clip_model(model_name)
-                safe_log("success", "✅ Model reset and reload successful")
-            except Exception as retry_error:
-                safe_log("error", f"❌ Model reset and reload failed: {retry_error}")
-                return 0.0
+                load_clip_model(model_name)
+            except Exception as model_error:
+                safe_log("error", f"❌ Error loading CLIP model: {model_error}")
+                
+                # Try to reset and reload model once
+                try:
+                    safe_log("warning", "🔄 Attempting model reset and reload...")
+                    reset_clip_model()
+                    load_clip_model(model_name)
+                    safe_log("success", "✅ Model reset and reload successful")
+                except Exception as retry_error:
+                    safe_log("error", f"❌ Model reset and reload failed: {retry_error}")
+                    return 0.0
         
         # Download and process image with timeout and size limits (only if not cached)
-        image_embeds = None
         image = None
-        
-        if _caching_enabled and image_cache_key in _image_embedding_cache:
-            image_embeds = _image_embedding_cache[image_cache_key]
-        
-        # Always download image if we don't have cached embeddings or if we need it for processing
-        if image_embeds is None or not _caching_enabled or text_cache_key not in _text_embedding_cache:
+        if image_embeds is None:
             try:
                 # Use shorter timeout and add more robust error handling
                 response = requests.get(
@@ -319,64 +563,22 @@ def calculate_text_image_similarity(text: str, image_url: str, model_name: str =
                 safe_log("error", f"❌ Failed to load image {image_url}: {img_error}")
                 return 0.0
         
-        # Process text (only if not cached)
-        text_embeds = None
-        if _caching_enabled and text_cache_key in _text_embedding_cache:
-            text_embeds = _text_embedding_cache[text_cache_key]
-        
-        # Process inputs with error handling - minimal logging
-        try:
-            if text_embeds is None or image_embeds is None:
-                # We need both text and image for the processor, so we'll process them together
-                # but only cache what we don't have
-                inputs = processor(text=[text], images=image, return_tensors="pt", padding=True)
-                    
-        except AttributeError as attr_error:
-            if "_valid_processor_keys" in str(attr_error):
-                safe_log("warning", f"⚠️  Processor compatibility issue ({attr_error}), reloading model...")
-                # Clear global cache and reload
-                global _clip_model, _clip_processor
-                _clip_model = None
-                _clip_processor = None
-                model, processor = load_clip_model(model_name)
-                inputs = processor(text=[text], images=image, return_tensors="pt", padding=True)
-            else:
-                safe_log("error", f"❌ Attribute error in processor: {attr_error}")
-                raise
-        except Exception as proc_error:
-            safe_log("error", f"❌ Failed to process inputs: {proc_error}")
-            return 0.0
-        
-        # Get embeddings with no_grad to save memory - minimal logging
+        # Get embeddings of what is not cached - minimal logging
         similarity = 0.0
         try:
-            with torch.no_grad():
-                if text_embeds is None or image_embeds is None:
-                    
-                    # Ensure inputs are on the correct device
-                    if _force_cpu_only:
-                        # Move all inputs to CPU explicitly
-                        inputs = {k: v.to("cpu") if hasattr(v, 'to') else v for k, v in inputs.items()}
-                    
-                    outputs = model(**inputs)
-                    
-                    if text_embeds is None:
-                        text_embeds = outputs.text_embeds / outputs.text_embeds.norm(p=2, dim=-1, keepdim=True)
-                        # Cache the text embedding
-                        if _caching_enabled:
-                            _text_embedding_cache[text_cache_key] = text_embeds.clone()
-                        
-                    if image_embeds is None:
-                        image_embeds = outputs.image_embeds / outputs.image_embeds.norm(p=2, dim=-1, keepdim=True)
-                        # Cache the image embedding
-                        if _caching_enabled:
-                            _image_embedding_cache[image_cache_key] = image_embeds.clone()
+            if text_embeds is None:
+                text_embeds = encode_clip_texts([text], model_name)[0]
+                # Cache the text embedding
+                if _caching_enabled:
+                    _text_embedding_cache.put(text_cache_key, text_embeds)
                 
-                # Calculate cosine similarity
-                similarity = torch.cosine_similarity(text_embeds, image_embeds, dim=-1).item()
-                
-                # Convert from (-1, 1) to (0, 1) range
-                similarity = (similarity + 1) / 2
+            if image_embeds is None:
+                image_embeds = encode_clip_images([image], model_name)[0]
+                # Cache the image embedding
+                _cache_image_embeddings([image_url], image_embeds[None, :], model_name)
+            
+            # Calculate cosine similarity, converted from (-1, 1) to (0, 1) range
+            similarity = (float(np.dot(text_embeds, image_embeds)) + 1) / 2
                 
         except Exception as inference_error:
             safe_log("error", f"❌ Failed during model inference: {inference_error}")
@@ -396,14 +598,6 @@ def calculate_text_image_similarity(text: str, image_url: str, model_name: str =
         finally:
             # Aggressive cleanup to prevent memory leaks - no debug logging
             try:
-                if 'inputs' in locals():
-                    del inputs
-                if 'outputs' in locals():
-                    del outputs
-                if 'text_embeds' in locals() and text_cache_key not in _text_embedding_cache:
-                    del text_embeds
-                if 'image_embeds' in locals() and image_cache_key not in _image_embedding_cache:
-                    del image_embeds
                 if 'image' in locals():
                     del image
                 if 'image_data' in locals():
@@ -440,6 +634,12 @@ def calculate_video_image_similarity(text: str, video_metadata: Dict, model_name
     """Calculate similarity between text and video images (thumbnail + preview frames)"""
     if not IMAGE_SIMILARITY_AVAILABLE:
         return 0.0
+    
+    # Frames sampled from the local clip need no download
+    frames = _frame_embeddings([video_metadata], model_name).get(video_metadata.get('video_path'))
+    if frames is not None:
+        text_embeds = text_embeddings([text], model_name)[text]
+        return (float((frames @ text_embeds).max()) + 1) / 2
         
     # Get image URLs from video metadata
     image_urls = []
@@ -530,37 +730,30 @@ def select_representative_images(image_urls: List[str], max_images: int = 1) ->
     return selected[:max_images]
 
 def clear_cache_if_needed():
-    """Clear caches if they exceed maximum size"""
-    global _image_embedding_cache, _text_embedding_cache
-    
-    if len(_image_embedding_cache) > _cache_max_size:
-        # Remove oldest entries (simple FIFO)
-        to_remove = len(_image_embedding_cache) - _cache_max_size + 10  # Remove a few extra
-        for _ in range(to_remove):
-            if _image_embedding_cache:
-                _image_embedding_cache.popitem(last=False)
-    
-    if len(_text_embedding_cache) > _cache_max_size:
-        # Remove oldest entries (simple FIFO)
-        to_remove = len(_text_embedding_cache) - _cache_max_size + 10  # Remove a few extra
-        for _ in range(to_remove):
-            if _text_embedding_cache:
-                _text_embedding_cache.popitem(last=False)
+    """The caches evict least recently used entries on every insert, nothing to do here"""
 
 def clear_all_caches():
-    """Clear all embedding caches"""
-    global _image_embedding_cache, _text_embedding_cache
-    
+    """Clear all in-memory embedding caches, the persistent image tier is kept"""
     logger.info(f"🧹 Clearing all caches (image: {len(_image_embedding_cache)}, text: {len(_text_embedding_cache)})")
     _image_embedding_cache.clear()
     _text_embedding_cache.clear()
 
 def get_cache_stats():
     """Get cache statistics"""
+    with _persistent_stats_lock:
+        persistent_stats = dict(_persistent_stats)
+    persistent_lookups = persistent_stats['hits'] + persistent_stats['misses']
     return {
         'text_cache_size': len(_text_embedding_cache),
         'image_cache_size': len(_image_embedding_cache),
-        'cache_max_size': _cache_max_size,
+        'text_cache': _text_embedding_cache.stats(),
+        'image_cache': _image_embedding_cache.stats(),
+        'persistent_image_cache': {
+            'enabled': _persistent_image_cache,
+            'hits': persistent_stats['hits'],
+            'misses': persistent_stats['misses'],
+            'hit_rate': persistent_stats['hits'] / persistent_lookups if persistent_lookups else 0.0,
+        },
         'caching_enabled': _caching_enabled,
         'inference_count': _inference_count,
         'model_load_fails': _model_load_fails
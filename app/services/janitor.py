@@ -0,0 +1,265 @@
+"""
+Background garbage collection of the storage directory.
+
+Task artifacts are grouped into classes with their own retention period:
+
+- finals:        final-*.mp4 / combined-*.mp4 returned to clients
+- intermediates: temp clips, chunk files and other leftovers of a render
+- metadata:      script.json, audio and subtitle files of a task
+- cache:         downloaded stock footage in cache_videos (plus sidecars)
+
+The user's own `material_directory` is only collected when
+`include_material_directory` is set, since it may hold footage that exists
+nowhere else.
+
+The footage cache is additionally bounded by a disk quota and evicted in
+least-recently-used order (save_video touches a clip whenever it is reused).
+"""
+
+import fnmatch
+import os
+import shutil
+import threading
+import time
+
+from loguru import logger
+
+from app.config import config
+from app.models import const
+from app.services import state as sm
+from app.utils import utils
+
+_cfg = config.janitor
+enabled = _cfg.get("enabled", True)
+interval = _cfg.get("interval", 600)
+
+# retention in hours, 0 keeps the artifacts forever
+retention = {
+    "finals": _cfg.get("finals_retention_hours", 168),
+    "intermediates": _cfg.get("intermediates_retention_hours", 1),
+    "metadata": _cfg.get("metadata_retention_hours", 168),
+    "cache": _cfg.get("cache_retention_hours", 720),
+}
+cache_quota_bytes = int(_cfg.get("cache_quota_gb", 20) * 1024**3)
+include_material_directory = _cfg.get("include_material_directory", False)
+# cached clips used this recently may belong to a running render, never evict them
+MIN_CACHE_AGE = 3600
+
+FINAL_PATTERNS = ["final-*.mp4", "combined-*.mp4"]
+# sidecar files of a cached clip, grouped with it by the clip's file name stem
+METADATA_SUFFIX = "_metadata.json"
+PARTIAL_SUFFIXES = [".part.validator", ".part", ".mezzanine.tmp", ".tmp"]
+INTERMEDIATE_PATTERNS = [
+    "temp-*",
+    "*_c[0-9]*.*",
+    "*_merged_no_bgm.mp4",
+    "*_list.txt",
+    "*_chunk_*",
+    "*.part",
+    "*.part.validator",
+    "*.tmp",
+    "*TEMP_MPY*",
+]
+
+_stats_lock = threading.Lock()
+_stats = {
+    "runs": 0,
+    "last_run_at": 0,
+    "last_run_seconds": 0.0,
+    "files_removed": 0,
+    "bytes_reclaimed": 0,
+    "bytes_reclaimed_by_class": {name: 0 for name in retention},
+    "cache_bytes": 0,
+}
+_stop_event = threading.Event()
+_thread = None
+
+
+def classify(filename: str) -> str:
+    if any(fnmatch.fnmatch(filename, p) for p in INTERMEDIATE_PATTERNS):
+        return "intermediates"
+    if any(fnmatch.fnmatch(filename, p) for p in FINAL_PATTERNS):
+        return "finals"
+    return "metadata"
+
+
+def _expired(file_path: str, artifact_class: str, now: float) -> bool:
+    hours = retention.get(artifact_class, 0)
+    if not hours:
+        return False
+    try:
+        return now - os.path.getmtime(file_path) > hours * 3600
+    except OSError:
+        return False
+
+
+def _remove(file_path: str, artifact_class: str, reclaimed: dict) -> int:
+    try:
+        size = os.path.getsize(file_path)
+        os.remove(file_path)
+    except OSError as e:
+        logger.warning(f"janitor failed to remove {file_path}: {e}")
+        return 0
+    reclaimed[artifact_class] = reclaimed.get(artifact_class, 0) + size
+    reclaimed["_files"] = reclaimed.get("_files", 0) + 1
+    return size
+
+
+def _is_processing(task_id: str) -> bool:
+    try:
+        task = sm.state.get_task(task_id)
+    except Exception as e:
+        logger.warning(f"janitor failed to query task {task_id}: {e}")
+        # be conservative if the state backend is unavailable
+        return True
+    return bool(task) and task.get("state") == const.TASK_STATE_PROCESSING
+
+
+def collect_tasks(now: float, reclaimed: dict):
+    tasks_dir = utils.task_dir()
+    for task_id in os.listdir(tasks_dir):
+        task_path = os.path.join(tasks_dir, task_id)
+        if not os.path.isdir(task_path) or _is_processing(task_id):
+            continue
+
+        for root, _, files in os.walk(task_path):
+            for filename in files:
+                file_path = os.path.join(root, filename)
+                artifact_class = classify(filename)
+                if _expired(file_path, artifact_class, now):
+                    _remove(file_path, artifact_class, reclaimed)
+
+        # drop the task once nothing is left of it
+        if not any(files for _, _, files in os.walk(task_path)):
+            shutil.rmtree(task_path, ignore_errors=True)
+            sm.state.delete_task(task_id)
+            logger.info(f"janitor removed expired task: {task_id}")
+
+
+def collect_temp(now: float, reclaimed: dict):
+    temp_dir = utils.storage_dir("temp")
+    if not os.path.isdir(temp_dir):
+        return
+    for filename in os.listdir(temp_dir):
+        file_path = os.path.join(temp_dir, filename)
+        if os.path.isfile(file_path) and _expired(file_path, "intermediates", now):
+            _remove(file_path, "intermediates", reclaimed)
+
+
+def cache_dirs() -> list:
+    dirs = [utils.storage_dir("cache_videos")]
+    material_directory = config.app.get("material_directory", "").strip()
+    if include_material_directory and material_directory and material_directory != "task":
+        dirs.append(material_directory)
+    return [d for d in dirs if os.path.isdir(d)]
+
+
+def _clip_stem(filename: str) -> str:
+    """vid-1.mp4, vid-1_metadata.json and vid-1.mp4.part all belong to clip vid-1."""
+    for suffix in PARTIAL_SUFFIXES:
+        if filename.endswith(suffix):
+            filename = filename[: -len(suffix)]
+            break
+    if METADATA_SUFFIX in filename:
+        # the sidecar (or its temp file) is named after the clip without its extension
+        return filename[: filename.rindex(METADATA_SUFFIX)]
+    return os.path.splitext(filename)[0]
+
+
+def _cache_entries(cache_dir: str) -> list:
+    """Group cached clips with their sidecar files: [(last_used, size, [paths])]."""
+    groups = {}
+    for filename in os.listdir(cache_dir):
+        file_path = os.path.join(cache_dir, filename)
+        if not os.path.isfile(file_path):
+            continue
+        groups.setdefault(_clip_stem(filename), []).append(file_path)
+
+    entries = []
+    for paths in groups.values():
+        try:
+            last_used = max(os.path.getmtime(p) for p in paths)
+            size = sum(os.path.getsize(p) for p in paths)
+        except OSError:
+            continue
+        entries.append((last_used, size, paths))
+    return entries
+
+
+def collect_cache(now: float, reclaimed: dict):
+    cache_bytes = 0
+    for cache_dir in cache_dirs():
+        entries = sorted(_cache_entries(cache_dir), key=lambda e: e[0])
+        total = sum(size for _, size, _ in entries)
+        hours = retention["cache"]
+        for last_used, size, paths in entries:
+            if now - last_used < MIN_CACHE_AGE:
+                break
+            expired = hours and now - last_used > hours * 3600
+            over_quota = cache_quota_bytes and total > cache_quota_bytes
+            if not expired and not over_quota:
+                # entries are sorted by last use, the rest are newer
+                break
+            for file_path in paths:
+                total -= _remove(file_path, "cache", reclaimed)
+        cache_bytes += total
+
+    with _stats_lock:
+        _stats["cache_bytes"] = cache_bytes
+
+
+def run_once() -> dict:
+    """Run a single collection pass and return the bytes reclaimed per class."""
+    started = time.time()
+    reclaimed = {}
+    for collect in (collect_tasks, collect_temp, collect_cache):
+        try:
+            collect(started, reclaimed)
+        except Exception as e:
+            logger.error(f"janitor {collect.__name__} failed: {e}")
+
+    files_removed = reclaimed.pop("_files", 0)
+    total = sum(reclaimed.values())
+    with _stats_lock:
+        _stats["runs"] += 1
+        _stats["last_run_at"] = started
+        _stats["last_run_seconds"] = round(time.time() - started, 3)
+        _stats["files_removed"] += files_removed
+        _stats["bytes_reclaimed"] += total
+        for artifact_class, size in reclaimed.items():
+            _stats["bytes_reclaimed_by_class"][artifact_class] += size
+
+    if files_removed:
+        logger.info(
+            f"janitor reclaimed {total / 1024 / 1024:.1f} MB from {files_removed} files: {reclaimed}"
+        )
+    return reclaimed
+
+
+def get_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+        stats["bytes_reclaimed_by_class"] = dict(_stats["bytes_reclaimed_by_class"])
+    stats["retention_hours"] = dict(retention)
+    stats["cache_quota_bytes"] = cache_quota_bytes
+    return stats
+
+
+def _loop():
+    while not _stop_event.is_set():
+        run_once()
+        _stop_event.wait(interval)
+
+
+def start():
+    global _thread
+    if not enabled or (_thread and _thread.is_alive()):
+        return
+    _stop_event.clear()
+    _thread = threading.Thread(target=_loop, name="storage-janitor", daemon=True)
+    _thread.start()
+    logger.info(f"storage janitor started, interval: {interval}s, retention: {retention}")
+
+
+def stop():
+    _stop_event.set()
@@ -0,0 +1,332 @@
+"""
+Local footage library.
+
+Clips already downloaded to the material cache (storage/cache_videos and a
+custom material_directory) are indexed into SQLite (storage/cache/library.db)
+with their search term from the `_metadata.json` sidecar, duration and
+resolution. Term queries are answered from the index first and remote
+providers are only asked for the duration the library cannot cover.
+
+A clip matches a search term when the normalized terms are equal, when their
+words overlap enough, or - if enabled - when the sentence embeddings of the
+terms are similar (off by default, it needs the sentence model).
+"""
+
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, List
+
+import numpy as np
+from loguru import logger
+
+from app.config import config
+from app.models.schema import MaterialInfo, VideoAspect, VideoConcatMode
+from app.services import cancellation, fingerprint, material, semantic_video
+from app.utils import utils
+
+enabled = config.app.get("material_library_enabled", True)
+semantic_match = config.app.get("material_library_semantic_match", False)
+min_similarity = config.app.get("material_library_min_similarity", 0.75)
+MIN_WORD_OVERLAP = 0.5
+# clips whose aspect ratio differs more than this from the target are skipped
+MAX_ASPECT_DEVIATION = 0.1
+# seconds between two scans of the material directories
+REFRESH_INTERVAL = 300
+
+_local = threading.local()
+_refresh_lock = threading.Lock()
+_last_refresh = 0.0
+
+
+def db_path() -> str:
+    return os.path.join(utils.storage_dir("cache", create=True), "library.db")
+
+
+def _connection() -> sqlite3.Connection:
+    path = db_path()
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "path", "") == path:
+        return conn
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS clips ("
+        "path TEXT PRIMARY KEY, search_term TEXT, term_key TEXT, "
+        "duration REAL, width INTEGER, height INTEGER, file_size INTEGER, "
+        "metadata_mtime REAL, indexed_at REAL, fingerprint TEXT)"
+    )
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(clips)")]
+    if "fingerprint" not in columns:
+        conn.execute("ALTER TABLE clips ADD COLUMN fingerprint TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS clips_term_key ON clips (term_key)")
+    conn.commit()
+    _local.conn = conn
+    _local.path = path
+    return conn
+
+
+def normalize_term(term: str) -> str:
+    return " ".join(re.findall(r"\w+", (term or "").lower()))
+
+
+def library_dirs() -> List[str]:
+    dirs = [utils.storage_dir("cache_videos")]
+    material_directory = config.app.get("material_directory", "").strip()
+    if material_directory and material_directory != "task" and os.path.isdir(material_directory):
+        dirs.append(material_directory)
+    return [d for d in dirs if os.path.isdir(d)]
+
+
+def refresh(force: bool = False) -> int:
+    """
+    Bring the index up to date with the material directories.
+    Only new or changed clips are probed, returns the number of clips indexed.
+    """
+    global _last_refresh
+    with _refresh_lock:
+        if not force and time.time() - _last_refresh < REFRESH_INTERVAL:
+            return 0
+        conn = _connection()
+        known = {
+            row[0]: (row[1], row[2])
+            for row in conn.execute("SELECT path, file_size, metadata_mtime FROM clips")
+        }
+        seen = set()
+        indexed = 0
+        for video_dir in library_dirs():
+            for entry in os.scandir(video_dir):
+                if not entry.is_file() or not entry.name.endswith(".mp4"):
+                    continue
+                video_path = os.path.join(video_dir, entry.name)
+                seen.add(video_path)
+                metadata_path = semantic_video.get_metadata_path(video_path)
+                metadata_mtime = os.path.getmtime(metadata_path) if os.path.exists(metadata_path) else 0.0
+                # cached clips are immutable, only the sidecar may change
+                file_size = entry.stat().st_size
+                if known.get(video_path) == (file_size, metadata_mtime):
+                    continue
+                if _index_clip(conn, video_path, file_size, metadata_mtime):
+                    indexed += 1
+
+        removed = [path for path in known if path not in seen]
+        conn.executemany("DELETE FROM clips WHERE path = ?", [(path,) for path in removed])
+        conn.commit()
+        _last_refresh = time.time()
+        if indexed or removed:
+            logger.info(f"footage library: indexed {indexed} clips, removed {len(removed)}")
+        return indexed
+
+
+def _index_clip(conn, video_path: str, file_size: int, metadata_mtime: float) -> bool:
+    info = material.probe_video_info(video_path)
+    if not info:
+        return False
+    metadata = semantic_video.load_video_metadata(video_path) or {}
+    search_term = metadata.get("search_term", "")
+    conn.execute(
+        "INSERT OR REPLACE INTO clips (path, search_term, term_key, duration, width, height, "
+        "file_size, metadata_mtime, indexed_at, fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            video_path,
+            search_term,
+            normalize_term(search_term),
+            info["duration"],
+            info["width"],
+            info["height"],
+            file_size,
+            metadata_mtime,
+            time.time(),
+            " ".join(metadata.get("fingerprint") or []),
+        ),
+    )
+    return True
+
+
+def _term_embeddings(term_keys: List[str]) -> dict:
+    """Embeddings of the given terms, encoded in one batch (cached by the embedding store)."""
+    term_keys = [k for k in dict.fromkeys(term_keys) if k]
+    return dict(zip(term_keys, semantic_video.encode_texts(term_keys)))
+
+
+def _format_matches(width: int, height: int, video_aspect: VideoAspect, video_quality: str) -> bool:
+    if not width or not height:
+        return True
+    target_width, target_height = VideoAspect(video_aspect).to_resolution(quality=video_quality)
+    target_ratio = target_width / target_height
+    if abs(width / height - target_ratio) / target_ratio > MAX_ASPECT_DEVIATION:
+        return False
+    # clips downloaded for a lower quality are not upscaled for this task
+    return material.rendition_satisfies(width, height, target_width, target_height)
+
+
+def search(
+    search_term: str,
+    minimum_duration: int,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    video_quality: str = "1080p",
+) -> List[MaterialInfo]:
+    """Clips of the library matching `search_term`, best matches first."""
+    term_key = normalize_term(search_term)
+    if not term_key:
+        return []
+    conn = _connection()
+    rows = [
+        row
+        for row in conn.execute(
+            "SELECT path, search_term, term_key, duration, width, height, fingerprint FROM clips WHERE duration >= ?",
+            (minimum_duration,),
+        )
+        if _format_matches(row[4], row[5], video_aspect, video_quality)
+    ]
+
+    words = set(term_key.split())
+    scores = {}
+    for row in rows:
+        if row[2] == term_key:
+            scores[row[0]] = 1.0
+            continue
+        clip_words = set(row[2].split())
+        if clip_words:
+            overlap = len(words & clip_words) / len(words | clip_words)
+            if overlap >= MIN_WORD_OVERLAP:
+                scores[row[0]] = overlap
+
+    if semantic_match and rows:
+        try:
+            embeddings = _term_embeddings([term_key] + [row[2] for row in rows])
+            query = embeddings[term_key]
+            for row in rows:
+                if row[0] in scores or row[2] not in embeddings:
+                    continue
+                similarity = float(np.dot(query, embeddings[row[2]]))
+                if similarity >= min_similarity:
+                    scores[row[0]] = similarity
+        except Exception as e:
+            logger.warning(f"semantic library match is unavailable: {str(e)}")
+
+    items = []
+    for row in rows:
+        if row[0] in scores and os.path.exists(row[0]):
+            item = MaterialInfo()
+            item.provider = "library"
+            item.url = row[0]
+            item.duration = row[3]
+            item.search_term = row[1] or search_term
+            item.fingerprint = row[6].split() if row[6] else []
+            items.append((scores[row[0]], item))
+    items.sort(key=lambda x: x[0], reverse=True)
+    return [item for _, item in items]
+
+
+def download_videos(
+    task_id: str,
+    search_terms: List[str],
+    source: str = "pexels",
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    video_contact_mode: VideoConcatMode = VideoConcatMode.random,
+    audio_duration: float = 0.0,
+    max_clip_duration: int = 5,
+    duration_target: Callable[[], float] = None,
+    video_quality: str = "1080p",
+    seen_fingerprints: List[List[str]] = None,
+    exclude_paths: set = None,
+) -> List[str]:
+    """
+    Same contract as material.download_videos, but clips of the local library
+    are used first and only the remaining duration is fetched from `source`.
+    """
+    if not enabled:
+        return material.download_videos(
+            task_id=task_id,
+            search_terms=search_terms,
+            source=source,
+            video_aspect=video_aspect,
+            video_contact_mode=video_contact_mode,
+            audio_duration=audio_duration,
+            max_clip_duration=max_clip_duration,
+            duration_target=duration_target,
+            video_quality=video_quality,
+            seen_fingerprints=seen_fingerprints,
+            exclude_paths=exclude_paths,
+        )
+
+    def _required():
+        return duration_target() if duration_target else audio_duration
+
+    local_by_term = {}
+    try:
+        refresh()
+        for search_term in search_terms:
+            cancellation.check()
+            items = search(search_term, max_clip_duration, video_aspect, video_quality)
+            if video_contact_mode.value == VideoConcatMode.random.value:
+                random.shuffle(items)
+            if items:
+                local_by_term[search_term] = items
+    except sqlite3.Error as e:
+        logger.error(f"footage library is unavailable: {str(e)}")
+
+    # round-robin over the terms, like the remote selection, so every term
+    # is represented before one term contributes a second clip
+    max_videos_per_term = int(audio_duration / max_clip_duration / max(1, len(search_terms))) + 1
+    video_paths = []
+    used = set(exclude_paths or ())
+    fingerprints = list(seen_fingerprints or [])
+    total_duration = 0.0
+    for round_index in range(max_videos_per_term):
+        for items in local_by_term.values():
+            if total_duration > _required():
+                break
+            for item in items[round_index:]:
+                if item.url in used:
+                    continue
+                used.add(item.url)
+                # the same footage cached under another URL or provider
+                if fingerprint.is_duplicate(item.fingerprint, fingerprints):
+                    continue
+                if item.fingerprint:
+                    fingerprints.append(item.fingerprint)
+                video_paths.append(item.url)
+                total_duration += min(max_clip_duration, item.duration)
+                break
+
+    # mark the clips as recently used for the cache eviction of the janitor,
+    # the user's own material directory is left alone
+    cache_dir = os.path.abspath(utils.storage_dir("cache_videos"))
+    for video_path in video_paths:
+        if os.path.dirname(os.path.abspath(video_path)) == cache_dir:
+            os.utime(video_path, None)
+
+    misses = [term for term in search_terms if term not in local_by_term]
+    logger.info(
+        f"footage library: {len(video_paths)} clips, {total_duration:.1f}s of {audio_duration:.1f}s, "
+        f"misses: {misses}"
+    )
+    if total_duration > _required():
+        return video_paths
+
+    # terms without local footage are searched first
+    remote_terms = misses + [term for term in search_terms if term in local_by_term]
+    remote_paths = material.download_videos(
+        task_id=task_id,
+        search_terms=remote_terms,
+        source=source,
+        video_aspect=video_aspect,
+        video_contact_mode=video_contact_mode,
+        audio_duration=_required() - total_duration,
+        max_clip_duration=max_clip_duration,
+        duration_target=lambda: _required() - total_duration,
+        video_quality=video_quality,
+        seen_fingerprints=fingerprints,
+        exclude_paths=used,
+    )
+    for video_path in remote_paths:
+        if video_path not in used:
+            used.add(video_path)
+            video_paths.append(video_path)
+    return video_paths
@@ -1,19 +1,324 @@
+import contextvars
 import os
 import random
-from typing import List
-from urllib.parse import urlencode
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from typing import Callable, List, Optional
+from urllib.parse import urlencode, urlparse
 
 import requests
 from loguru import logger
+from requests.adapters import HTTPAdapter
 from moviepy.video.io.VideoFileClip import VideoFileClip
 
 from app.config import config
 from app.models.schema import MaterialInfo, VideoAspect, VideoConcatMode
 from app.utils import utils
-from app.services import semantic_video
+from app.services import cancellation, clip_index, fingerprint, mezzanine, search_cache, semantic_video, shots
 
 requested_count = 0
 
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
+
+# concurrency of material fetching
+search_workers = config.app.get("material_search_workers", 4)
+download_workers = config.app.get("material_download_workers", 6)
+max_downloads_per_host = config.app.get("material_downloads_per_host", 4)
+# renditions up to 5% smaller than the output frame are accepted
+MAX_UPSCALE = 1.05
+# the "multi" source drops providers that answer slower than this (seconds)
+provider_timeout = config.app.get("material_provider_timeout", 20)
+# concurrent searches per provider
+provider_concurrency = config.app.get("material_provider_concurrency", {})
+# downloads of the same path are serialized by one of these locks
+PATH_LOCK_STRIPES = 64
+
+_session = None
+_session_lock = threading.Lock()
+_host_semaphores = {}
+_path_locks = [threading.Lock() for _ in range(PATH_LOCK_STRIPES)]
+
+
+def get_session() -> requests.Session:
+    """Shared HTTP session, so connections to the providers and CDNs are reused."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            pool_size = max(download_workers, search_workers) * 2
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({"User-Agent": USER_AGENT})
+            session.proxies.update(config.proxy)
+            session.verify = False
+            _session = session
+        return _session
+
+
+def _host_semaphore(url: str) -> threading.BoundedSemaphore:
+    host = urlparse(url).netloc
+    with _session_lock:
+        semaphore = _host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(max_downloads_per_host)
+            _host_semaphores[host] = semaphore
+        return semaphore
+
+
+def _path_lock(file_path: str) -> threading.Lock:
+    # a fixed table: different paths may share a lock, but it never grows
+    return _path_locks[hash(file_path) % PATH_LOCK_STRIPES]
+
+
+def _content_total(r: requests.Response) -> int:
+    """Total size of the remote file from Content-Range or Content-Length, -1 if unknown."""
+    content_range = r.headers.get("Content-Range", "")
+    if "/" in content_range:
+        total = content_range.rsplit("/", 1)[1].strip()
+        if total.isdigit():
+            return int(total)
+    if r.status_code == 200:
+        length = r.headers.get("Content-Length", "")
+        if length.isdigit() and not r.headers.get("Content-Encoding"):
+            return int(length)
+    return -1
+
+
+def download_file(
+    url: str,
+    file_path: str,
+    timeout=(60, 240),
+    chunk_size=1024 * 1024,
+    abort: threading.Event = None,
+) -> int:
+    """
+    Download `url` into `file_path` through a `<file_path>.part` file.
+
+    An existing part file left by an interrupted download is resumed with a
+    Range request, conditional (If-Range) on the ETag or Last-Modified the
+    server sent for it; if the remote file changed, the server answers with
+    the whole file and the download starts over. The size is verified
+    against Content-Length/Content-Range and the part file is renamed into
+    place only when complete, so readers never see a truncated file. Setting `abort` stops the download and keeps
+    the part file for a later resume. Returns the size of the downloaded file.
+    """
+    part_path = f"{file_path}.part"
+    validator_path = f"{part_path}.validator"
+    with _path_lock(file_path), _host_semaphore(url):
+        if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+            return os.path.getsize(file_path)
+
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        validator = _read_validator(validator_path) if offset > 0 else ""
+        # without the validator of the part file, a changed remote file would be spliced into it
+        headers = {"Range": f"bytes={offset}-", "If-Range": validator} if validator else {}
+        with get_session().get(url, headers=headers, stream=True, timeout=timeout) as r:
+            if r.status_code == 416 and validator:
+                # the part file already holds the whole file (or is garbage)
+                total = _content_total(r)
+                if total != offset:
+                    _remove_files(part_path, validator_path)
+                    raise IOError(f"invalid partial download, removed: {part_path}")
+            else:
+                r.raise_for_status()
+                total = _content_total(r)
+                if r.status_code == 206 and validator:
+                    logger.info(f"resuming download at {offset} bytes: {url}")
+                    mode = "ab"
+                else:
+                    # a new download, or the remote file changed since the part file was written
+                    mode = "wb"
+                    _write_validator(validator_path, r)
+                with open(part_path, mode) as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        cancellation.check()
+                        if abort is not None and abort.is_set():
+                            raise InterruptedError(f"download aborted: {url}")
+                        if chunk:
+                            f.write(chunk)
+
+        size = os.path.getsize(part_path)
+        if total >= 0 and size != total:
+            if size > total:
+                _remove_files(part_path, validator_path)
+            raise IOError(
+                f"incomplete download: {size} of {total} bytes, url: {url}"
+            )
+        os.replace(part_path, file_path)
+        _remove_files(validator_path)
+        return size
+
+
+def _read_validator(validator_path: str) -> str:
+    try:
+        with open(validator_path, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def _write_validator(validator_path: str, r: requests.Response):
+    """Keep the strong ETag (or else Last-Modified) of a download for the If-Range of its resume."""
+    etag = r.headers.get("ETag", "")
+    validator = etag if etag and not etag.startswith("W/") else r.headers.get("Last-Modified", "")
+    if validator:
+        with open(validator_path, "w", encoding="utf-8") as f:
+            f.write(validator)
+    else:
+        _remove_files(validator_path)
+
+
+def _remove_files(*paths: str):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def probe_video(file_path: str) -> Optional[float]:
+    """
+    Integrity check of an MP4/MOV file, cheap for files whose headers carry
+    the duration and frame rate; others (e.g. fragmented files) are opened
+    with a decoder as before. Returns the duration in seconds, or None if the
+    file is invalid or has no positive duration and frame rate.
+    """
+    info = probe_video_info(file_path)
+    if not info:
+        return None
+    if info["duration"] > 0 and info["fps"] > 0:
+        return info["duration"]
+    try:
+        clip = VideoFileClip(file_path)
+        duration, fps = clip.duration, clip.fps
+        clip.close()
+    except Exception as e:
+        logger.warning(f"invalid video file: {file_path} => {str(e)}")
+        return None
+    if duration and duration > 0 and fps and fps > 0:
+        return duration
+    return None
+
+
+def probe_video_info(file_path: str) -> Optional[dict]:
+    """
+    Walk the top-level ISO BMFF boxes of a file and require them to tile the
+    file exactly, with both a `moov` and an `mdat` box present.
+    Returns {"duration", "width", "height", "fps"} read from the movie and
+    video track headers (0 when not present), or None if the file is invalid.
+    """
+    try:
+        file_size = os.path.getsize(file_path)
+        boxes = set()
+        info = {"duration": 0.0, "width": 0, "height": 0, "fps": 0.0}
+        with open(file_path, "rb") as f:
+            position = 0
+            while position < file_size:
+                f.seek(position)
+                header = f.read(8)
+                if len(header) < 8:
+                    return None
+                box_size = int.from_bytes(header[:4], "big")
+                box_type = header[4:8]
+                header_size = 8
+                if box_size == 1:
+                    box_size = int.from_bytes(f.read(8), "big")
+                    header_size = 16
+                elif box_size == 0:
+                    box_size = file_size - position
+                if box_size < header_size or position + box_size > file_size:
+                    return None
+                boxes.add(box_type)
+                if box_type == b"moov":
+                    _parse_moov(f, position + header_size, position + box_size, info)
+                position += box_size
+        if b"moov" not in boxes or b"mdat" not in boxes:
+            return None
+        return info
+    except Exception as e:
+        logger.warning(f"failed to probe video: {file_path} => {str(e)}")
+        return None
+
+
+def _child_boxes(f, start: int, end: int):
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        header = f.read(8)
+        box_size = int.from_bytes(header[:4], "big")
+        if box_size < 8 or position + box_size > end:
+            return
+        yield header[4:8], position + 8, position + box_size
+        position += box_size
+
+
+def _find_box(f, start: int, end: int, box_type: bytes) -> Optional[tuple]:
+    for child_type, child_start, child_end in _child_boxes(f, start, end):
+        if child_type == box_type:
+            return child_start, child_end
+    return None
+
+
+def _parse_moov(f, start: int, end: int, info: dict):
+    for box_type, box_start, box_end in _child_boxes(f, start, end):
+        if box_type == b"mvhd":
+            f.seek(box_start)
+            version = f.read(4)[0]
+            if version == 1:
+                f.seek(16, os.SEEK_CUR)
+                timescale = int.from_bytes(f.read(4), "big")
+                duration = int.from_bytes(f.read(8), "big")
+            else:
+                f.seek(8, os.SEEK_CUR)
+                timescale = int.from_bytes(f.read(4), "big")
+                duration = int.from_bytes(f.read(4), "big")
+            info["duration"] = duration / timescale if timescale else 0.0
+        elif box_type == b"trak" and not info["fps"]:
+            _parse_trak(f, box_start, box_end, info)
+
+
+def _parse_trak(f, start: int, end: int, info: dict):
+    """Size and frame rate of the first video track."""
+    boxes = {box_type: (box_start, box_end) for box_type, box_start, box_end in _child_boxes(f, start, end)}
+    mdia = boxes.get(b"mdia")
+    if not mdia or b"tkhd" not in boxes:
+        return
+    mdia_boxes = {box_type: (box_start, box_end) for box_type, box_start, box_end in _child_boxes(f, *mdia)}
+    if b"hdlr" not in mdia_boxes or b"mdhd" not in mdia_boxes:
+        return
+    f.seek(mdia_boxes[b"hdlr"][0] + 8)
+    if f.read(4) != b"vide":
+        return
+
+    # width and height are 16.16 fixed point values ending the box
+    f.seek(boxes[b"tkhd"][1] - 8)
+    info["width"] = int.from_bytes(f.read(4), "big") >> 16
+    info["height"] = int.from_bytes(f.read(4), "big") >> 16
+
+    f.seek(mdia_boxes[b"mdhd"][0])
+    version = f.read(4)[0]
+    if version == 1:
+        f.seek(16, os.SEEK_CUR)
+        timescale = int.from_bytes(f.read(4), "big")
+        duration = int.from_bytes(f.read(8), "big")
+    else:
+        f.seek(8, os.SEEK_CUR)
+        timescale = int.from_bytes(f.read(4), "big")
+        duration = int.from_bytes(f.read(4), "big")
+
+    # frames are counted in the time-to-sample table of the sample table
+    stts = mdia_boxes.get(b"minf")
+    for box_type in (b"stbl", b"stts"):
+        stts = _find_box(f, *stts, box_type) if stts else None
+    if not stts or not timescale or not duration:
+        return
+    f.seek(stts[0] + 4)
+    entry_count = int.from_bytes(f.read(4), "big")
+    frames = 0
+    for _ in range(min(entry_count, (stts[1] - stts[0] - 8) // 8)):
+        frames += int.from_bytes(f.read(4), "big")
+        f.seek(4, os.SEEK_CUR)
+    info["fps"] = frames * timescale / duration
+
 
 def get_api_key(cfg_key: str):
     api_keys = config.app.get(cfg_key)
@@ -27,42 +332,86 @@ def get_api_key(cfg_key: str):
     if isinstance(api_keys, str):
         return api_keys
 
+    # rotate through the keys, skipping those whose rate limit is exhausted
     global requested_count
-    requested_count += 1
+    provider = cfg_key.replace("_api_keys", "")
+    for _ in range(len(api_keys)):
+        requested_count += 1
+        api_key = api_keys[requested_count % len(api_keys)]
+        if not search_cache.is_exhausted(provider, api_key):
+            return api_key
+    logger.warning(f"all {cfg_key} are rate limited")
     return api_keys[requested_count % len(api_keys)]
 
 
+def rendition_satisfies(width: int, height: int, target_width: int, target_height: int) -> bool:
+    """
+    A rendition satisfies the target when it covers the output frame without
+    being upscaled (clips are scaled to fill the frame and cropped).
+    """
+    if not width or not height:
+        return False
+    scale = max(target_width / width, target_height / height)
+    return scale <= MAX_UPSCALE
+
+
+def select_rendition(renditions: List[dict], target_width: int, target_height: int) -> Optional[dict]:
+    """
+    Pick the smallest rendition that satisfies the target resolution.
+    `renditions` are dicts with at least `width` and `height`, and optionally
+    the file `size` in bytes. Returns None if no rendition is large enough.
+    """
+    candidates = [
+        r
+        for r in renditions
+        if rendition_satisfies(int(r.get("width") or 0), int(r.get("height") or 0), target_width, target_height)
+    ]
+    if not candidates:
+        return None
+    return min(
+        candidates,
+        key=lambda r: (int(r["width"]) * int(r["height"]), int(r.get("size") or 0)),
+    )
+
+
+def _rendition_info(rendition: dict) -> dict:
+    return {
+        key: rendition[key]
+        for key in ("width", "height", "size", "quality", "fps")
+        if rendition.get(key) is not None
+    }
+
+
 def search_videos_pexels(
     search_term: str,
     minimum_duration: int,
     video_aspect: VideoAspect = VideoAspect.portrait,
+    video_quality: str = "1080p",
 ) -> List[MaterialInfo]:
     aspect = VideoAspect(video_aspect)
     video_orientation = aspect.name
-    video_width, video_height = aspect.to_resolution()
-    api_key = get_api_key("pexels_api_keys")
-    headers = {
-        "Authorization": api_key,
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
-    }
+    video_width, video_height = aspect.to_resolution(quality=video_quality)
     # Build URL
     params = {"query": search_term, "per_page": 20, "orientation": video_orientation}
     query_url = f"https://api.pexels.com/videos/search?{urlencode(params)}"
-    logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
 
-    try:
-        r = requests.get(
+    def _fetch():
+        api_key = get_api_key("pexels_api_keys")
+        logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
+        r = get_session().get(
             query_url,
-            headers=headers,
-            proxies=config.proxy,
-            verify=False,
+            headers={"Authorization": api_key},
             timeout=(30, 60),
         )
+        search_cache.record_usage("pexels", api_key, r.status_code, r.headers)
         response = r.json()
-        video_items = []
         if "videos" not in response:
-            logger.error(f"search videos failed: {response}")
-            return video_items
+            raise ValueError(response)
+        return response
+
+    try:
+        response = search_cache.lookup("pexels", params, _fetch)
+        video_items = []
         videos = response["videos"]
         # loop through each video in the result
         for v in videos:
@@ -70,26 +419,27 @@ def search_videos_pexels(
             # check if video has desired minimum duration
             if duration < minimum_duration:
                 continue
-            video_files = v["video_files"]
-            # loop through each url to determine the best quality
-            for video in video_files:
-                w = int(video["width"])
-                h = int(video["height"])
-                if w == video_width and h == video_height:
-                    item = MaterialInfo()
-                    item.provider = "pexels"
-                    item.url = video["link"]
-                    item.duration = duration
-                    
-                    # Capture image data for similarity comparison
-                    if "image" in v:
-                        item.thumbnail_url = v["image"]
-                    
-                    if "video_pictures" in v:
-                        item.preview_images = [pic["picture"] for pic in v["video_pictures"]]
-                    
-                    video_items.append(item)
-                    break
+            # the smallest mp4 rendition that is large enough for the output
+            video_files = [
+                f for f in v["video_files"] if f.get("file_type", "video/mp4") == "video/mp4"
+            ]
+            video = select_rendition(video_files, video_width, video_height)
+            if not video:
+                continue
+            item = MaterialInfo()
+            item.provider = "pexels"
+            item.url = video["link"]
+            item.duration = duration
+            item.rendition = _rendition_info(video)
+
+            # Capture image data for similarity comparison
+            if "image" in v:
+                item.thumbnail_url = v["image"]
+
+            if "video_pictures" in v:
+                item.preview_images = [pic["picture"] for pic in v["video_pictures"]]
+
+            video_items.append(item)
         return video_items
     except Exception as e:
         logger.error(f"search videos failed: {str(e)}")
@@ -101,31 +451,33 @@ def search_videos_pixabay(
     search_term: str,
     minimum_duration: int,
     video_aspect: VideoAspect = VideoAspect.portrait,
+    video_quality: str = "1080p",
 ) -> List[MaterialInfo]:
     aspect = VideoAspect(video_aspect)
 
-    video_width, video_height = aspect.to_resolution()
+    video_width, video_height = aspect.to_resolution(quality=video_quality)
 
-    api_key = get_api_key("pixabay_api_keys")
     # Build URL
     params = {
         "q": search_term,
         "video_type": "all",  # Accepted values: "all", "film", "animation"
         "per_page": 50,
-        "key": api_key,
     }
-    query_url = f"https://pixabay.com/api/videos/?{urlencode(params)}"
-    logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
 
-    try:
-        r = requests.get(
-            query_url, proxies=config.proxy, verify=False, timeout=(30, 60)
-        )
+    def _fetch():
+        api_key = get_api_key("pixabay_api_keys")
+        query_url = f"https://pixabay.com/api/videos/?{urlencode({**params, 'key': api_key})}"
+        logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
+        r = get_session().get(query_url, timeout=(30, 60))
+        search_cache.record_usage("pixabay", api_key, r.status_code, r.headers)
         response = r.json()
-        video_items = []
         if "hits" not in response:
-            logger.error(f"search videos failed: {response}")
-            return video_items
+            raise ValueError(response)
+        return response
+
+    try:
+        response = search_cache.lookup("pixabay", params, _fetch)
+        video_items = []
         videos = response["hits"]
         # loop through each video in the result
         for v in videos:
@@ -133,19 +485,21 @@ def search_videos_pixabay(
             # check if video has desired minimum duration
             if duration < minimum_duration:
                 continue
-            video_files = v["videos"]
-            # loop through each url to determine the best quality
-            for video_type in video_files:
-                video = video_files[video_type]
-                w = int(video["width"])
-                # h = int(video["height"])
-                if w >= video_width:
-                    item = MaterialInfo()
-                    item.provider = "pixabay"
-                    item.url = video["url"]
-                    item.duration = duration
-                    video_items.append(item)
-                    break
+            # large, medium, small and tiny renditions
+            video_files = [
+                dict(video, quality=video_type)
+                for video_type, video in v["videos"].items()
+                if video.get("url")
+            ]
+            video = select_rendition(video_files, video_width, video_height)
+            if not video:
+                continue
+            item = MaterialInfo()
+            item.provider = "pixabay"
+            item.url = video["url"]
+            item.duration = duration
+            item.rendition = _rendition_info(video)
+            video_items.append(item)
         return video_items
     except Exception as e:
         logger.error(f"search videos failed: {str(e)}")
@@ -153,72 +507,231 @@ def search_videos_pixabay(
     return []
 
 
-def save_video(video_url: str, save_dir: str = "", search_term: str = "", thumbnail_url: str = "", preview_images: list = None) -> str:
-    if not save_dir:
-        save_dir = utils.storage_dir("cache_videos")
+class VideoProvider:
+    """
+    A stock footage source. `search` has the signature of search_videos_pexels
+    and returns MaterialInfo items, `download` has the signature of save_video
+    (the default) and stores one of them in the material cache.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        search: Callable[..., List[MaterialInfo]],
+        cfg_key: str = "",
+        max_concurrent: int = 4,
+        download: Callable[..., str] = None,
+    ):
+        self.name = name
+        self._search = search
+        self._download = download
+        self.cfg_key = cfg_key
+        self._semaphore = threading.BoundedSemaphore(
+            provider_concurrency.get(name, max_concurrent)
+        )
 
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+    def is_available(self) -> bool:
+        """Configured, and at least one API key still has quota."""
+        if not self.cfg_key:
+            return True
+        api_keys = config.app.get(self.cfg_key)
+        if not api_keys:
+            return False
+        if isinstance(api_keys, str):
+            api_keys = [api_keys]
+        return any(not search_cache.is_exhausted(self.name, key) for key in api_keys)
+
+    def search(self, search_term: str, minimum_duration: int, video_aspect: VideoAspect = VideoAspect.portrait, video_quality: str = "1080p") -> List[MaterialInfo]:
+        with self._semaphore:
+            return self._search(
+                search_term=search_term,
+                minimum_duration=minimum_duration,
+                video_aspect=video_aspect,
+                video_quality=video_quality,
+            )
+
+    def download(self, item: MaterialInfo, save_dir: str = "", abort: threading.Event = None) -> str:
+        """Path of the downloaded clip of `item`, empty if it is not a valid video."""
+        download = self._download or save_video
+        return download(
+            video_url=item.url,
+            save_dir=save_dir,
+            search_term=item.search_term,
+            thumbnail_url=item.thumbnail_url,
+            preview_images=item.preview_images,
+            abort=abort,
+            rendition=item.rendition,
+        )
 
+
+_providers = {}
+_provider_executor = None
+
+
+def register_provider(provider: VideoProvider):
+    _providers[provider.name] = provider
+
+
+def get_provider(name: str) -> VideoProvider:
+    # unknown sources fall back to pexels, as before the registry existed
+    return _providers.get(name) or _providers["pexels"]
+
+
+def search_videos_multi(
+    search_term: str,
+    minimum_duration: int,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    video_quality: str = "1080p",
+) -> List[MaterialInfo]:
+    """
+    Query all available providers concurrently and merge the results,
+    interleaving them by rank. Providers that are rate limited are skipped
+    and providers slower than `provider_timeout` are left out; their searches
+    finish in the background and end up in the search cache.
+    """
+    global _provider_executor
+    providers = [p for p in _providers.values() if p.is_available()]
+    if not providers:
+        logger.error("no video provider is available")
+        return []
+
+    with _session_lock:
+        if _provider_executor is None:
+            _provider_executor = ThreadPoolExecutor(
+                max_workers=max(4, len(_providers) * search_workers),
+                thread_name_prefix="provider-search",
+            )
+    futures = {
+        _provider_executor.submit(
+            contextvars.copy_context().run,
+            provider.search,
+            search_term,
+            minimum_duration,
+            video_aspect,
+            video_quality,
+        ): provider.name
+        for provider in providers
+    }
+    done, not_done = wait(futures, timeout=provider_timeout)
+    for future in not_done:
+        logger.warning(f"provider {futures[future]} timed out searching '{search_term}'")
+
+    results = []
+    for future, name in futures.items():
+        if future in done and not future.exception():
+            results.append(future.result())
+        elif future in done:
+            logger.error(f"provider {name} failed: {future.exception()}")
+
+    # round-robin over the providers keeps the best results of each on top
+    merged = []
+    seen_urls = set()
+    for rank in range(max((len(r) for r in results), default=0)):
+        for items in results:
+            if rank < len(items) and items[rank].url not in seen_urls:
+                seen_urls.add(items[rank].url)
+                merged.append(items[rank])
+    logger.info(
+        f"found {len(merged)} videos for '{search_term}' from {len(results)}/{len(providers)} providers"
+    )
+    return merged
+
+
+def video_path_for(video_url: str, save_dir: str = "") -> str:
+    """Path of the cached clip of `video_url`."""
+    if not save_dir:
+        save_dir = utils.storage_dir("cache_videos")
     url_without_query = video_url.split("?")[0]
     url_hash = utils.md5(url_without_query)
     video_id = f"vid-{url_hash}"
-    video_path = f"{save_dir}/{video_id}.mp4"
+    return f"{save_dir}/{video_id}.mp4"
+
+
+def covered_duration(video_paths: List[str], max_clip_duration: float) -> float:
+    """Seconds of the final video the clips can fill, each clip is cut to at most `max_clip_duration`."""
+    total = 0.0
+    for video_path in video_paths:
+        duration = probe_video(video_path) or 0.0
+        total += min(max_clip_duration, duration)
+    return total
+
+
+def save_video(video_url: str, save_dir: str = "", search_term: str = "", thumbnail_url: str = "", preview_images: list = None, abort: threading.Event = None, rendition: dict = None) -> str:
+    video_path = video_path_for(video_url, save_dir)
+    save_dir = os.path.dirname(video_path)
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
 
     # if video already exists, return the path
     if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
-        logger.info(f"video already exists: {video_path}")
-        # Save metadata if search_term is provided and metadata doesn't exist
-        if search_term and not semantic_video.load_video_metadata(video_path):
-            additional_info = {}
-            if thumbnail_url:
-                additional_info["thumbnail_url"] = thumbnail_url
-            if preview_images:
-                additional_info["preview_images"] = preview_images
-            semantic_video.save_video_metadata(video_path, search_term, additional_info)
-        return video_path
-
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
-    }
+        duration = probe_video(video_path)
+        if duration is not None:
+            logger.info(f"video already exists: {video_path}")
+            # mark the clip as recently used for the cache eviction of the janitor
+            os.utime(video_path, None)
+            metadata = semantic_video.load_video_metadata(video_path)
+            # Save metadata if search_term is provided and metadata doesn't exist
+            if search_term and not metadata:
+                _save_metadata(video_path, search_term, thumbnail_url, preview_images, rendition, duration)
+            elif metadata and "fingerprint" not in metadata and fingerprint.threshold:
+                # clips cached before fingerprints existed
+                metadata["fingerprint"] = fingerprint.compute(video_path, duration)
+                semantic_video.update_video_metadata(video_path, fingerprint=metadata["fingerprint"])
+            if metadata:
+                # clips cached before the clip index existed
+                clip_index.add(video_path, metadata.get("search_term", search_term))
+            return video_path
+        # a truncated file from an older, non-atomic download
+        logger.warning(f"cached video is corrupted, downloading again: {video_path}")
+        os.remove(video_path)
 
     # if video does not exist, download it
-    with open(video_path, "wb") as f:
-        f.write(
-            requests.get(
-                video_url,
-                headers=headers,
-                proxies=config.proxy,
-                verify=False,
-                timeout=(60, 240),
-            ).content
-        )
+    download_file(video_url, video_path, abort=abort)
+
+    duration = probe_video(video_path)
+    if duration is not None:
+        # Save metadata with search term and image data
+        if search_term:
+            _save_metadata(video_path, search_term, thumbnail_url, preview_images, rendition, duration)
+        # normalize the new clip in the background for cheaper renders
+        mezzanine.enqueue(video_path)
+        return video_path
 
-    if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
-        try:
-            clip = VideoFileClip(video_path)
-            duration = clip.duration
-            fps = clip.fps
-            clip.close()
-            if duration > 0 and fps > 0:
-                # Save metadata with search term and image data
-                if search_term:
-                    additional_info = {}
-                    if thumbnail_url:
-                        additional_info["thumbnail_url"] = thumbnail_url
-                    if preview_images:
-                        additional_info["preview_images"] = preview_images
-                    semantic_video.save_video_metadata(video_path, search_term, additional_info)
-                return video_path
-        except Exception as e:
-            try:
-                os.remove(video_path)
-            except Exception:
-                pass
-            logger.warning(f"invalid video file: {video_path} => {str(e)}")
+    try:
+        os.remove(video_path)
+    except Exception:
+        pass
+    logger.warning(f"invalid video file: {video_path}")
     return ""
 
 
+def _save_metadata(video_path: str, search_term: str, thumbnail_url: str = "", preview_images: list = None, rendition: dict = None, duration: float = 0.0):
+    additional_info = {}
+    if fingerprint.threshold:
+        additional_info["fingerprint"] = fingerprint.compute(video_path, duration)
+    if shots.enabled:
+        additional_info["shots"] = shots.detect(video_path, duration)
+    if rendition:
+        additional_info["rendition"] = rendition
+    if thumbnail_url:
+        additional_info["thumbnail_url"] = thumbnail_url
+    if preview_images:
+        additional_info["preview_images"] = preview_images
+    semantic_video.save_video_metadata(video_path, search_term, additional_info)
+    clip_index.add(video_path, search_term)
+
+
+def _is_duplicate(video_path: str, fingerprints: List[List[str]]) -> bool:
+    """Check the clip against `fingerprints` and add its own fingerprint if it is new."""
+    fp = fingerprint.load(video_path)
+    if not fp:
+        return False
+    if fingerprint.is_duplicate(fp, fingerprints):
+        return True
+    fingerprints.append(fp)
+    return False
+
+
 def download_broll_materials(
     task_id: str,
     video_aspect: VideoAspect = VideoAspect.portrait,
@@ -244,23 +757,62 @@ def download_videos(
     video_contact_mode: VideoConcatMode = VideoConcatMode.random,
     audio_duration: float = 0.0,
     max_clip_duration: int = 5,
+    duration_target: Callable[[], float] = None,
+    video_quality: str = "1080p",
+    seen_fingerprints: List[List[str]] = None,
+    exclude_paths: set = None,
 ) -> List[str]:
+    """
+    Search `search_terms` and download clips until they cover `audio_duration`.
+    `duration_target` may refine the required duration while downloading,
+    e.g. once the real audio duration is known; downloads beyond it are
+    cancelled. Clips that are near-duplicates of each other or of
+    `seen_fingerprints`, and clips in `exclude_paths` (clips the caller
+    already has) are not used.
+    """
+    def _required():
+        return duration_target() if duration_target else audio_duration
+
+    material_directory = config.app.get("material_directory", "").strip()
+    if material_directory == "task":
+        material_directory = utils.task_dir(task_id)
+    elif material_directory and not os.path.isdir(material_directory):
+        material_directory = ""
+    exclude_paths = exclude_paths or set()
+
     # Group videos by search term for balanced sampling
     videos_by_term = {}
     found_duration = 0.0
-    search_videos = search_videos_pexels
-    if source == "pixabay":
-        search_videos = search_videos_pixabay
+    if source == "multi":
+        search_videos = search_videos_multi
+    else:
+        search_videos = get_provider(source).search
 
     # Global URL tracking to prevent duplicates across all search terms
     global_video_urls = set()
-    
-    for search_term in search_terms:
-        video_items = search_videos(
-            search_term=search_term,
+
+    # query all search terms concurrently, results are merged in term order
+    # so the de-duplication below stays deterministic
+    def _search(term):
+        cancellation.check()
+        return search_videos(
+            search_term=term,
             minimum_duration=max_clip_duration,
             video_aspect=video_aspect,
+            video_quality=video_quality,
         )
+
+    results_by_term = {}
+    with ThreadPoolExecutor(max_workers=max(1, search_workers)) as executor:
+        futures = {
+            executor.submit(contextvars.copy_context().run, _search, term): term
+            for term in search_terms
+        }
+        for future in as_completed(futures):
+            results_by_term[futures[future]] = future.result()
+
+    for search_term in search_terms:
+        video_items = results_by_term.get(search_term, [])
         logger.info(f"found {len(video_items)} videos for '{search_term}'")
 
         # Filter out duplicates and associate with search term
@@ -269,7 +821,9 @@ def download_videos(
         
         for item in video_items:
             # Check for URL duplicates across all search terms
-            if item.url not in global_video_urls:
+            if exclude_paths and video_path_for(item.url, material_directory) in exclude_paths:
+                duplicates_removed += 1
+            elif item.url not in global_video_urls:
                 item.search_term = search_term
                 unique_videos.append(item)
                 global_video_urls.add(item.url)
@@ -328,43 +882,87 @@ def download_videos(
         percentage = (count / len(valid_video_items)) * 100 if valid_video_items else 0
         logger.info(f"   📹 '{term}': {count} videos ({percentage:.1f}%)")
 
-    video_paths = []
-    material_directory = config.app.get("material_directory", "").strip()
-    if material_directory == "task":
-        material_directory = utils.task_dir(task_id)
-    elif material_directory and not os.path.isdir(material_directory):
-        material_directory = ""
-
     total_duration = 0.0
     downloaded_urls = set()  # Track downloaded URLs to prevent runtime duplicates
-    
-    for item in valid_video_items:
-        try:
-            # Double-check for URL duplicates at download time
-            if item.url in downloaded_urls:
-                logger.warning(f"skipping duplicate URL: {item.url}")
+    fingerprints = list(seen_fingerprints or [])
+    # (index, path) pairs, so the result keeps the selection order
+    saved = []
+
+    def _download(item):
+        cancellation.check()
+        logger.info(f"downloading video: {item.url}")
+        saved_video_path = get_provider(item.provider).download(item, material_directory, abort)
+        if saved_video_path:
+            logger.info(f"video saved: {saved_video_path} (search_term: '{item.search_term}')")
+        return saved_video_path
+
+    # keep at most `download_workers` downloads in flight and stop submitting
+    # as soon as the downloaded clips cover the audio
+    pending_items = []
+    queued_urls = set()
+    for index, item in enumerate(valid_video_items):
+        # Double-check for URL duplicates at download time
+        if item.url in queued_urls:
+            logger.warning(f"skipping duplicate URL: {item.url}")
+            continue
+        queued_urls.add(item.url)
+        pending_items.append((index, item))
+
+    abort = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max(1, download_workers))
+    try:
+        in_flight = {}
+        next_item = 0
+        enough = _required() <= 0
+        while not enough and (in_flight or next_item < len(pending_items)):
+            while next_item < len(pending_items) and len(in_flight) < download_workers:
+                index, item = pending_items[next_item]
+                next_item += 1
+                future = executor.submit(contextvars.copy_context().run, _download, item)
+                in_flight[future] = (index, item)
+            cancellation.check()
+
+            future = next(as_completed(in_flight))
+            index, item = in_flight.pop(future)
+            try:
+                saved_video_path = future.result()
+            except Exception as e:
+                logger.error(f"failed to download video: {utils.to_json(item)} => {str(e)}")
                 continue
-                
-            logger.info(f"downloading video: {item.url}")
-            # Use the search term associated with this specific video item
-            item_search_term = getattr(item, 'search_term', 'unknown')
-            saved_video_path = save_video(
-                video_url=item.url, save_dir=material_directory, search_term=item_search_term, thumbnail_url=item.thumbnail_url, preview_images=item.preview_images
-            )
-            if saved_video_path:
-                logger.info(f"video saved: {saved_video_path} (search_term: '{item_search_term}')")
-                video_paths.append(saved_video_path)
+            if saved_video_path and _is_duplicate(saved_video_path, fingerprints):
+                logger.info(f"skipping near-duplicate footage: {item.url}")
+            elif saved_video_path:
+                saved.append((index, saved_video_path))
                 downloaded_urls.add(item.url)
                 seconds = min(max_clip_duration, item.duration)
                 total_duration += seconds
-                if total_duration > audio_duration:
-                    logger.info(
-                        f"total duration of downloaded videos: {total_duration} seconds, skip downloading more"
-                    )
-                    break
-        except Exception as e:
-            logger.error(f"failed to download video: {utils.to_json(item)} => {str(e)}")
-    
+            if total_duration > _required():
+                logger.info(
+                    f"total duration of downloaded videos: {total_duration} seconds, skip downloading more"
+                )
+                enough = True
+
+        # downloads still running are not needed anymore, their part files
+        # are kept and resumed when the clip is requested again
+        abort.set()
+        for future, (index, item) in in_flight.items():
+            if future.cancel():
+                continue
+            try:
+                saved_video_path = future.result()
+            except InterruptedError:
+                continue
+            except Exception as e:
+                logger.warning(f"failed to download video: {item.url} => {str(e)}")
+                continue
+            if saved_video_path and not _is_duplicate(saved_video_path, fingerprints):
+                saved.append((index, saved_video_path))
+                downloaded_urls.add(item.url)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    video_paths = [path for _, path in sorted(saved)]
+
     # Final diversity report
     logger.success(f"downloaded {len(video_paths)} videos")
     logger.info(f"🎯 Final diversity: {len(downloaded_urls)} unique URLs downloaded")
@@ -372,6 +970,10 @@ def download_videos(
     return video_paths
 
 
+register_provider(VideoProvider("pexels", search_videos_pexels, "pexels_api_keys"))
+register_provider(VideoProvider("pixabay", search_videos_pixabay, "pixabay_api_keys"))
+
+
 if __name__ == "__main__":
     download_videos(
         "test123", ["Money Exchange Medium"], audio_duration=100, source="pixabay"
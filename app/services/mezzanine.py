@@ -0,0 +1,222 @@
+"""
+Background transcoding of cached footage to a mezzanine format.
+
+Stock footage arrives with assorted codecs, frame rates, GOP structures and
+resolutions, so every render paid the decode and scale cost of the source.
+When enabled, each newly downloaded clip is transcoded once in a background
+thread to H.264 at a fixed frame rate, a short GOP (or all-intra) and at most
+the configured output resolution for its orientation, without audio. The
+clip is replaced atomically under the same path, so the cache and the
+footage library are not affected. Clips a render of this process is using
+are never replaced (the renderer may reopen them by path); they are
+transcoded once the last render using them has finished.
+"""
+
+import os
+import queue
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import List
+
+from loguru import logger
+
+from app.config import config
+from app.models.schema import VideoAspect
+from app.services import semantic_video
+from app.utils import utils
+
+enabled = config.app.get("mezzanine_enabled", False)
+quality = config.app.get("mezzanine_quality", "1080p")
+fps = config.app.get("mezzanine_fps", 30)
+# keyframe interval in frames, 1 encodes every frame as a keyframe (all-intra)
+gop = config.app.get("mezzanine_gop", 15)
+crf = config.app.get("mezzanine_crf", 18)
+preset = config.app.get("mezzanine_preset", "veryfast")
+threads = config.app.get("mezzanine_threads", 2)
+
+TEMP_SUFFIX = ".mezzanine.tmp"
+
+_queue = queue.Queue()
+_queued = set()
+# clip path -> number of renders using it, and the clips waiting for them
+_in_use = {}
+_deferred = set()
+_lock = threading.Lock()
+_thread = None
+_stats = {"queued": 0, "transcoded": 0, "deferred": 0, "failed": 0, "bytes_before": 0, "bytes_after": 0, "seconds": 0.0}
+
+
+def profile() -> dict:
+    return {"quality": quality, "fps": fps, "gop": gop, "crf": crf}
+
+
+def is_mezzanine(video_path: str) -> bool:
+    metadata = semantic_video.load_video_metadata(video_path) or {}
+    return metadata.get("mezzanine") == profile()
+
+
+@contextmanager
+def using(video_paths: List[str]):
+    """Keep the clips from being replaced while a render reads them."""
+    paths = [os.path.abspath(p) for p in video_paths]
+    with _lock:
+        for path in paths:
+            _in_use[path] = _in_use.get(path, 0) + 1
+    try:
+        yield
+    finally:
+        released = []
+        with _lock:
+            for path in paths:
+                _in_use[path] -= 1
+                if not _in_use[path]:
+                    del _in_use[path]
+                    if path in _deferred:
+                        _deferred.discard(path)
+                        released.append(path)
+        for path in released:
+            enqueue(path)
+
+
+def _defer_if_in_use(video_path: str) -> bool:
+    """Called with _lock held: transcode the clip again once it is released."""
+    path = os.path.abspath(video_path)
+    if path not in _in_use:
+        return False
+    _deferred.add(path)
+    _stats["deferred"] += 1
+    return True
+
+
+def build_command(video_path: str, output_path: str) -> list:
+    long_side, short_side = VideoAspect.landscape.to_resolution(quality=quality)
+    # fit into long x short (landscape), short x long (portrait) or
+    # short x short (square), never upscale
+    scale = (
+        f"scale=w='min(iw,if(gt(iw,ih),{long_side},{short_side}))'"
+        f":h='min(ih,if(gt(iw,ih),{short_side},if(lt(iw,ih),{long_side},{short_side})))'"
+        f":force_original_aspect_ratio=decrease:force_divisible_by=2"
+    )
+    return [
+        "ffmpeg", "-v", "error", "-y", "-i", video_path, "-an",
+        "-vf", f"{scale},fps={fps}",
+        "-c:v", "libx264", "-preset", preset, "-crf", str(crf),
+        "-g", str(gop), "-keyint_min", str(gop), "-sc_threshold", "0",
+        "-pix_fmt", "yuv420p", "-movflags", "+faststart",
+        "-threads", str(threads), "-f", "mp4", output_path,
+    ]
+
+
+def transcode(video_path: str) -> bool:
+    """
+    Transcode one clip in place, returns False if it was left untouched.
+    A clip in use by a render is deferred until the render has finished.
+    """
+    metadata = semantic_video.load_video_metadata(video_path)
+    # clips without a sidecar could not be marked as done
+    if not os.path.exists(video_path) or metadata is None or metadata.get("mezzanine") == profile():
+        return False
+    with _lock:
+        if _defer_if_in_use(video_path):
+            return False
+    output_path = f"{video_path}{TEMP_SUFFIX}"
+    started = time.time()
+    size_before = os.path.getsize(video_path)
+    try:
+        subprocess.run(build_command(video_path, output_path), check=True, capture_output=True)
+        if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+            raise IOError("empty output")
+        # the clip may have been evicted by the janitor in the meantime
+        if not os.path.exists(video_path):
+            return False
+        # or picked up by a render while it was transcoded
+        with _lock:
+            if _defer_if_in_use(video_path):
+                return False
+            os.replace(output_path, video_path)
+    except Exception as e:
+        stderr = getattr(e, "stderr", b"") or b""
+        logger.warning(f"failed to transcode {video_path}: {e} {stderr.decode(errors='ignore')[-300:]}")
+        with _lock:
+            _stats["failed"] += 1
+        return False
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+    # the sidecar may have gained shots or frames meanwhile, only the profile is merged
+    semantic_video.update_video_metadata(video_path, mezzanine=profile())
+
+    elapsed = time.time() - started
+    with _lock:
+        _stats["transcoded"] += 1
+        _stats["bytes_before"] += size_before
+        _stats["bytes_after"] += os.path.getsize(video_path)
+        _stats["seconds"] += elapsed
+    logger.info(f"transcoded {os.path.basename(video_path)} to mezzanine in {elapsed:.1f}s")
+    return True
+
+
+def _worker():
+    while True:
+        video_path = _queue.get()
+        # a clip released by a render during its transcode can be queued again
+        with _lock:
+            _queued.discard(video_path)
+        try:
+            transcode(video_path)
+        finally:
+            _queue.task_done()
+
+
+def _ensure_worker():
+    global _thread
+    with _lock:
+        if _thread and _thread.is_alive():
+            return
+        _thread = threading.Thread(target=_worker, name="mezzanine-transcoder", daemon=True)
+        _thread.start()
+
+
+def enqueue(video_path: str):
+    """Schedule a cached clip for transcoding, a no-op unless enabled."""
+    if not enabled:
+        return
+    with _lock:
+        if video_path in _queued:
+            return
+        _queued.add(video_path)
+        _stats["queued"] += 1
+    _ensure_worker()
+    _queue.put(video_path)
+
+
+def enqueue_cache(cache_dir: str = ""):
+    """Schedule all clips of the cache that are not transcoded yet."""
+    cache_dir = cache_dir or utils.storage_dir("cache_videos")
+    if not enabled or not os.path.isdir(cache_dir):
+        return
+    for filename in os.listdir(cache_dir):
+        file_path = os.path.join(cache_dir, filename)
+        if filename.endswith(TEMP_SUFFIX):
+            # left over by an interrupted transcode
+            os.remove(file_path)
+        elif filename.endswith(".mp4") and not is_mezzanine(file_path):
+            enqueue(file_path)
+
+
+def start():
+    """Transcode the clips cached before the mezzanine was enabled, in the background."""
+    if enabled:
+        threading.Thread(target=enqueue_cache, name="mezzanine-scan", daemon=True).start()
+
+
+def get_stats() -> dict:
+    with _lock:
+        stats = dict(_stats)
+    stats["enabled"] = enabled
+    stats["pending"] = _queue.qsize()
+    stats["waiting_for_renders"] = len(_deferred)
+    return stats
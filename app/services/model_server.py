@@ -0,0 +1,382 @@
+"""
+Local model server shared by the worker processes of a node.
+
+Every API/webui process used to load its own copy of the sentence
+transformer, CLIP and Whisper. With `model_server_enabled`, the services
+send their inference requests to one server process on localhost that hosts
+each model once:
+
+- POST /embed/text        sentence embeddings (semantic_video.encode_texts)
+- POST /model/text        load the sentence model, returns the backend running it
+- POST /embed/clip_text   CLIP text embeddings
+- POST /embed/clip_image  CLIP image embeddings
+- POST /transcribe        Whisper transcription of a local audio file
+- GET  /health
+
+Embedding requests of concurrent tasks are batched dynamically: the first
+request waits up to `model_server_max_wait_ms` for others, and the collected
+inputs run through the model as one batch. The server is started on demand
+by the first client (`model_server_autostart`) or manually with
+`python -m app.services.model_server`. If it cannot be reached, the services
+fall back to loading the models in-process.
+"""
+
+import base64
+import io
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Callable, List, Tuple
+
+import numpy as np
+import requests
+from loguru import logger
+
+from app.config import config
+from app.utils import utils
+
+enabled = config.app.get("model_server_enabled", False)
+address = config.app.get("model_server_address", "127.0.0.1:8790")
+autostart = config.app.get("model_server_autostart", True)
+max_batch = config.app.get("model_server_max_batch", 64)
+max_wait_ms = config.app.get("model_server_max_wait_ms", 10)
+
+REQUEST_TIMEOUT = 600
+STARTUP_TIMEOUT = 180
+# seconds the services run the models in-process after the server failed
+RETRY_INTERVAL = 60
+
+_start_lock = threading.Lock()
+_unavailable_until = 0.0
+# sentence model -> inference backend the server runs it with
+_text_backends = {}
+
+
+def encode_array(array: np.ndarray) -> dict:
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    return {"shape": list(array.shape), "data": base64.b64encode(array.tobytes()).decode("ascii")}
+
+
+def decode_array(payload: dict) -> np.ndarray:
+    data = np.frombuffer(base64.b64decode(payload["data"]), dtype=np.float32)
+    return data.reshape(payload["shape"])
+
+
+# ---------------------------------------------------------------------------
+# client
+# ---------------------------------------------------------------------------
+
+
+def _url(path: str) -> str:
+    return f"http://{address}{path}"
+
+
+def is_running() -> bool:
+    try:
+        return requests.get(_url("/health"), timeout=2).ok
+    except requests.RequestException:
+        return False
+
+
+def _spawn():
+    log_path = os.path.join(utils.storage_dir("logs", create=True), "model_server.log")
+    logger.info(f"starting the model server on {address}, log: {log_path}")
+    with open(log_path, "ab") as log_file:
+        subprocess.Popen(
+            [sys.executable, "-m", "app.services.model_server"],
+            cwd=utils.root_dir(),
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            # outlive the worker that started it
+            start_new_session=True,
+        )
+
+
+def ensure_running():
+    if is_running():
+        return
+    if not autostart:
+        raise ConnectionError(f"model server is not running on {address}")
+    with _start_lock:
+        if is_running():
+            return
+        # another process may be starting it as well, the loser exits on bind
+        _spawn()
+        deadline = time.time() + STARTUP_TIMEOUT
+        while time.time() < deadline:
+            if is_running():
+                return
+            time.sleep(0.5)
+    raise ConnectionError(f"model server did not start on {address}")
+
+
+def available() -> bool:
+    """Whether requests should go to the model server."""
+    return enabled and time.time() >= _unavailable_until
+
+
+def request(path: str, payload: dict) -> dict:
+    global _unavailable_until
+    try:
+        try:
+            response = requests.post(_url(path), json=payload, timeout=REQUEST_TIMEOUT)
+        except requests.ConnectionError:
+            ensure_running()
+            response = requests.post(_url(path), json=payload, timeout=REQUEST_TIMEOUT)
+    except (requests.ConnectionError, ConnectionError) as e:
+        _unavailable_until = time.time() + RETRY_INTERVAL
+        raise ConnectionError(f"model server is unavailable, using in-process models: {str(e)}")
+    if response.status_code != 200:
+        raise RuntimeError(f"model server error on {path}: {response.text[:300]}")
+    return response.json()
+
+
+def text_backend(model_name: str) -> str:
+    """Backend of the sentence model on the server, the embeddings are keyed by it."""
+    if model_name not in _text_backends:
+        _text_backends[model_name] = request("/model/text", {"model": model_name})["backend"]
+    return _text_backends[model_name]
+
+
+def embed_texts(texts: List[str], model_name: str) -> Tuple[np.ndarray, str]:
+    """Sentence embeddings and the backend that computed them."""
+    result = request("/embed/text", {"model": model_name, "texts": texts})
+    _text_backends[model_name] = result["backend"]
+    return decode_array(result), result["backend"]
+
+
+def embed_clip_texts(texts: List[str], model_name: str) -> np.ndarray:
+    return decode_array(request("/embed/clip_text", {"model": model_name, "texts": texts}))
+
+
+def embed_clip_images(images: list, model_name: str) -> np.ndarray:
+    encoded = []
+    for image in images:
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=95)
+        encoded.append(base64.b64encode(buffer.getvalue()).decode("ascii"))
+    return decode_array(request("/embed/clip_image", {"model": model_name, "images": encoded}))
+
+
+def transcribe(audio_file: str):
+    """Same (segments, info) as WhisperModel.transcribe, as plain attribute objects."""
+    result = request("/transcribe", {"audio_file": os.path.abspath(audio_file)})
+    segments = [
+        SimpleNamespace(
+            start=segment["start"],
+            end=segment["end"],
+            text=segment["text"],
+            words=[SimpleNamespace(**word) for word in segment["words"]],
+        )
+        for segment in result["segments"]
+    ]
+    return segments, SimpleNamespace(**result["info"])
+
+
+# ---------------------------------------------------------------------------
+# server
+# ---------------------------------------------------------------------------
+
+
+class Batcher:
+    """Runs the items of concurrent requests through `fn` as one batch."""
+
+    def __init__(self, fn: Callable[[list], np.ndarray], batch_size: int, wait_seconds: float):
+        self.fn = fn
+        self.batch_size = batch_size
+        self.wait_seconds = wait_seconds
+        self.batches = 0
+        self.items = 0
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, items: list) -> np.ndarray:
+        slot = {"items": items, "done": threading.Event()}
+        self._queue.put(slot)
+        slot["done"].wait()
+        if "error" in slot:
+            raise slot["error"]
+        return slot["result"]
+
+    def _collect(self) -> list:
+        slots = [self._queue.get()]
+        count = len(slots[0]["items"])
+        deadline = time.monotonic() + self.wait_seconds
+        while count < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                slot = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            slots.append(slot)
+            count += len(slot["items"])
+        return slots
+
+    def _run(self):
+        while True:
+            slots = self._collect()
+            try:
+                result = self.fn([item for slot in slots for item in slot["items"]])
+                offset = 0
+                for slot in slots:
+                    slot["result"] = result[offset : offset + len(slot["items"])]
+                    offset += len(slot["items"])
+                self.batches += 1
+                self.items += offset
+            except Exception as e:
+                for slot in slots:
+                    slot["error"] = e
+            finally:
+                for slot in slots:
+                    slot["done"].set()
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+# one model of a kind is resident, requests for another model swap it
+_inference_locks = {"text": threading.Lock(), "clip": threading.Lock(), "whisper": threading.Lock()}
+
+
+def _encode_text(model_name: str, texts: List[str]) -> np.ndarray:
+    from app.services import semantic_video
+
+    with _inference_locks["text"]:
+        semantic_video.load_model(model_name)
+        return semantic_video.encode_texts(texts)
+
+
+def _text_backend(model_name: str) -> str:
+    from app.services import semantic_video
+
+    with _inference_locks["text"]:
+        semantic_video.load_model(model_name)
+        return semantic_video._model_backend
+
+
+def _encode_clip_text(model_name: str, texts: List[str]) -> np.ndarray:
+    from app.services import image_similarity
+
+    with _inference_locks["clip"]:
+        return image_similarity.encode_clip_texts(texts, model_name)
+
+
+def _encode_clip_image(model_name: str, images: List[str]) -> np.ndarray:
+    from PIL import Image
+
+    from app.services import image_similarity
+
+    decoded = [Image.open(io.BytesIO(base64.b64decode(image))).convert("RGB") for image in images]
+    with _inference_locks["clip"]:
+        return image_similarity.encode_clip_images(decoded, model_name)
+
+
+def _batcher(kind: str, model_name: str) -> Batcher:
+    functions = {"text": _encode_text, "clip_text": _encode_clip_text, "clip_image": _encode_clip_image}
+    with _batchers_lock:
+        key = (kind, model_name)
+        if key not in _batchers:
+            fn = functions[kind]
+            _batchers[key] = Batcher(lambda items: fn(model_name, items), max_batch, max_wait_ms / 1000)
+        return _batchers[key]
+
+
+def _transcribe(audio_file: str) -> dict:
+    from app.services import subtitle
+
+    with _inference_locks["whisper"]:
+        segments, info = subtitle.transcribe(audio_file)
+        segments = [
+            {
+                "start": segment.start,
+                "end": segment.end,
+                "text": segment.text,
+                "words": [{"start": w.start, "end": w.end, "word": w.word} for w in segment.words or []],
+            }
+            for segment in segments
+        ]
+    return {
+        "segments": segments,
+        "info": {"language": info.language, "language_probability": info.language_probability},
+    }
+
+
+def get_stats() -> dict:
+    with _batchers_lock:
+        return {
+            f"{kind}:{model_name}": {"batches": b.batches, "items": b.items}
+            for (kind, model_name), b in _batchers.items()
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, {"status": "ok", "pid": os.getpid(), "batches": get_stats()})
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if self.path == "/embed/text":
+                result = encode_array(_batcher("text", payload["model"]).submit(payload["texts"]))
+                result["backend"] = _text_backend(payload["model"])
+            elif self.path == "/model/text":
+                result = {"backend": _text_backend(payload["model"])}
+            elif self.path == "/embed/clip_text":
+                result = encode_array(_batcher("clip_text", payload["model"]).submit(payload["texts"]))
+            elif self.path == "/embed/clip_image":
+                result = encode_array(_batcher("clip_image", payload["model"]).submit(payload["images"]))
+            elif self.path == "/transcribe":
+                result = _transcribe(payload["audio_file"])
+            else:
+                self._reply(404, {"error": "not found"})
+                return
+            self._reply(200, result)
+        except Exception as e:
+            logger.exception(f"model server request {self.path} failed")
+            self._reply(500, {"error": str(e)})
+
+    def log_message(self, format, *args):
+        logger.debug(f"model server: {format % args}")
+
+
+def create_server() -> ThreadingHTTPServer:
+    global enabled
+    # the models of this process are local, never forward to ourselves
+    enabled = False
+    host, port = address.rsplit(":", 1)
+    server = ThreadingHTTPServer((host, int(port)), _Handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve():
+    server = create_server()
+    logger.info(f"model server listening on {address}, pid {os.getpid()}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    # run as app.services.model_server, the module the services import: with
+    # `python -m` this file is __main__, and disabling the client here would
+    # leave it enabled for them, so the server would call itself and deadlock
+    from app.services import model_server
+
+    model_server.serve()
@@ -0,0 +1,88 @@
+"""
+Predictive prefetch of stock footage.
+
+Material fetching used to start only after the script and the search terms
+were generated. The prefetch starts right away with the video subject as the
+only search term, so most of the search and download latency overlaps with
+the LLM. The clips it finds are handed to the material stage, which then
+only fetches the remaining duration for the generated terms.
+"""
+
+import contextvars
+import threading
+from typing import List
+
+from loguru import logger
+
+from app.config import config
+from app.models.exception import TaskCancelledError
+from app.models.schema import VideoParams
+from app.services import library, material
+
+enabled = config.app.get("material_prefetch_enabled", True)
+# seconds of footage fetched for the subject before the terms are known
+prefetch_seconds = config.app.get("material_prefetch_seconds", 30)
+# seconds the material stage waits for a prefetch that is still running
+result_timeout = config.app.get("material_prefetch_timeout", 120)
+
+
+class MaterialPrefetch:
+    def __init__(self, task_id: str, params: VideoParams):
+        self.task_id = task_id
+        self.params = params
+        self.video_paths: List[str] = []
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(self._run,),
+            name=f"prefetch-{task_id}",
+            daemon=True,
+        )
+
+    def start(self):
+        logger.info(f"prefetching materials for subject: {self.params.video_subject}")
+        self._thread.start()
+        return self
+
+    def _target(self) -> float:
+        return 0.0 if self._cancelled.is_set() else prefetch_seconds
+
+    def _run(self):
+        try:
+            self.video_paths = library.download_videos(
+                task_id=self.task_id,
+                search_terms=[self.params.video_subject],
+                source=self.params.video_source,
+                video_aspect=self.params.video_aspect,
+                video_contact_mode=self.params.video_concat_mode,
+                audio_duration=prefetch_seconds,
+                max_clip_duration=self.params.video_clip_duration,
+                duration_target=self._target,
+                video_quality=self.params.video_quality,
+            )
+        except TaskCancelledError:
+            # the task itself notices the cancellation
+            pass
+        except Exception as e:
+            logger.warning(f"failed to prefetch materials: {str(e)}")
+
+    def cancel(self):
+        """Stop downloading, clips that are already complete stay in the cache."""
+        self._cancelled.set()
+
+    def result(self, timeout: float = None) -> List[str]:
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self.cancel()
+            return []
+        return list(self.video_paths)
+
+    def covered_duration(self, video_paths: List[str]) -> float:
+        return material.covered_duration(video_paths, self.params.video_clip_duration)
+
+
+def start(task_id: str, params: VideoParams):
+    """Start prefetching for tasks with a remote video source, returns None otherwise."""
+    if not enabled or params.video_source == "local" or not params.video_subject:
+        return None
+    return MaterialPrefetch(task_id, params).start()
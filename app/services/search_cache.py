@@ -0,0 +1,287 @@
+"""
+Persistent cache of stock footage search responses.
+
+Raw provider responses are stored in SQLite (storage/cache/search.db) keyed
+by provider and query parameters (API keys excluded), so the minimum
+duration and resolution filters still run on every lookup.
+
+- fresh entries (younger than the TTL) are returned without a request
+- stale entries are returned immediately and refreshed in the background
+- expired entries (or misses) are fetched synchronously, and if the
+  provider fails a stale copy is still preferred over no result
+
+The rate limit headers of every provider response are recorded per API key,
+so get_api_key can skip keys whose quota is exhausted until they reset.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from loguru import logger
+
+from app.config import config
+from app.utils import utils
+
+enabled = config.app.get("search_cache_enabled", True)
+ttl = config.app.get("search_cache_ttl_hours", 24) * 3600
+stale_ttl = config.app.get("search_cache_stale_hours", 168) * 3600
+
+# back off for an hour after a 429 without a reset header
+DEFAULT_RESET_SECONDS = 3600
+# purge expired rows every N writes
+PURGE_EVERY = 200
+
+_local = threading.local()
+_lock = threading.Lock()
+_refreshing = set()
+_refresh_executor = None
+_writes = 0
+_stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "errors": 0}
+
+
+def db_path() -> str:
+    return os.path.join(utils.storage_dir("cache", create=True), "search.db")
+
+
+def _connection() -> sqlite3.Connection:
+    path = db_path()
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "path", "") == path:
+        return conn
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS search_cache ("
+        "cache_key TEXT PRIMARY KEY, provider TEXT, query TEXT, "
+        "response TEXT, fetched_at REAL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS api_key_usage ("
+        "provider TEXT, key_id TEXT, requests INTEGER DEFAULT 0, "
+        "rate_limit INTEGER DEFAULT -1, remaining INTEGER DEFAULT -1, "
+        "reset_at REAL DEFAULT 0, updated_at REAL DEFAULT 0, "
+        "PRIMARY KEY (provider, key_id))"
+    )
+    conn.commit()
+    _local.conn = conn
+    _local.path = path
+    return conn
+
+
+def cache_key(provider: str, params: dict) -> str:
+    query = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return utils.md5(f"{provider}:{query}")
+
+
+def key_id(api_key: str) -> str:
+    """API keys are never written to disk, only a short hash of them."""
+    return utils.md5(api_key)[:12]
+
+
+def get(provider: str, params: dict) -> Optional[tuple]:
+    """Return (response, age in seconds) of a cached entry or None."""
+    row = _connection().execute(
+        "SELECT response, fetched_at FROM search_cache WHERE cache_key = ?",
+        (cache_key(provider, params),),
+    ).fetchone()
+    if not row:
+        return None
+    return json.loads(row[0]), time.time() - row[1]
+
+
+def put(provider: str, params: dict, response: dict):
+    global _writes
+    conn = _connection()
+    conn.execute(
+        "INSERT OR REPLACE INTO search_cache (cache_key, provider, query, response, fetched_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (
+            cache_key(provider, params),
+            provider,
+            json.dumps(params, sort_keys=True, ensure_ascii=False),
+            json.dumps(response, ensure_ascii=False),
+            time.time(),
+        ),
+    )
+    conn.commit()
+    with _lock:
+        _writes += 1
+        purge_now = _writes % PURGE_EVERY == 0
+    if purge_now:
+        purge()
+
+
+def purge() -> int:
+    """Delete entries that are too old to be served even as stale."""
+    conn = _connection()
+    cursor = conn.execute(
+        "DELETE FROM search_cache WHERE fetched_at < ?", (time.time() - stale_ttl,)
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+def _count(name: str):
+    with _lock:
+        _stats[name] += 1
+
+
+def _refresh(provider: str, params: dict, fetch: Callable[[], dict], key: str):
+    try:
+        put(provider, params, fetch())
+        _count("refreshes")
+    except Exception as e:
+        _count("errors")
+        logger.warning(f"failed to refresh search cache for {provider} {params}: {str(e)}")
+    finally:
+        with _lock:
+            _refreshing.discard(key)
+
+
+def _schedule_refresh(provider: str, params: dict, fetch: Callable[[], dict]):
+    global _refresh_executor
+    key = cache_key(provider, params)
+    with _lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+        if _refresh_executor is None:
+            _refresh_executor = ThreadPoolExecutor(
+                max_workers=2, thread_name_prefix="search-refresh"
+            )
+    _refresh_executor.submit(_refresh, provider, params, fetch, key)
+
+
+def lookup(provider: str, params: dict, fetch: Callable[[], dict]) -> dict:
+    """
+    Return the provider response for `params`, calling `fetch` only when the
+    cache cannot answer. `fetch` must raise on errors so that failed
+    responses are never cached.
+    """
+    if not enabled:
+        return fetch()
+
+    cached = None
+    try:
+        cached = get(provider, params)
+    except Exception as e:
+        logger.warning(f"failed to read search cache: {str(e)}")
+
+    if cached:
+        response, age = cached
+        if age < ttl:
+            _count("hits")
+            logger.info(f"search cache hit: {provider} {params}")
+            return response
+        if age < stale_ttl:
+            _count("stale_hits")
+            logger.info(f"search cache stale hit, revalidating: {provider} {params}")
+            _schedule_refresh(provider, params, fetch)
+            return response
+
+    _count("misses")
+    try:
+        response = fetch()
+    except Exception:
+        _count("errors")
+        if cached:
+            logger.warning(f"search failed, serving expired cache entry: {provider} {params}")
+            return cached[0]
+        raise
+
+    try:
+        put(provider, params, response)
+    except Exception as e:
+        logger.warning(f"failed to write search cache: {str(e)}")
+    return response
+
+
+def _header_int(headers, name: str) -> int:
+    value = headers.get(name, "")
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return -1
+
+
+def record_usage(provider: str, api_key: str, status_code: int, headers):
+    """
+    Account a request made with `api_key` and the rate limit state reported
+    by the provider (X-Ratelimit-* headers of Pexels and Pixabay).
+    """
+    now = time.time()
+    rate_limit = _header_int(headers, "X-Ratelimit-Limit")
+    remaining = _header_int(headers, "X-Ratelimit-Remaining")
+    reset = _header_int(headers, "X-Ratelimit-Reset")
+    # Pexels reports a unix timestamp, Pixabay the seconds until the reset
+    if reset > 1_000_000_000:
+        reset_at = float(reset)
+    elif reset >= 0:
+        reset_at = now + reset
+    else:
+        reset_at = 0.0
+    if status_code == 429:
+        remaining = 0
+        if reset_at <= now:
+            reset_at = now + DEFAULT_RESET_SECONDS
+
+    try:
+        conn = _connection()
+        conn.execute(
+            "INSERT INTO api_key_usage (provider, key_id, requests, rate_limit, remaining, reset_at, updated_at) "
+            "VALUES (?, ?, 1, ?, ?, ?, ?) "
+            "ON CONFLICT (provider, key_id) DO UPDATE SET requests = requests + 1, "
+            "rate_limit = CASE WHEN excluded.rate_limit >= 0 THEN excluded.rate_limit ELSE rate_limit END, "
+            "remaining = excluded.remaining, reset_at = excluded.reset_at, updated_at = excluded.updated_at",
+            (provider, key_id(api_key), rate_limit, remaining, reset_at, now),
+        )
+        conn.commit()
+    except Exception as e:
+        logger.warning(f"failed to record api key usage: {str(e)}")
+
+    if remaining == 0:
+        logger.warning(
+            f"{provider} api key {key_id(api_key)} exhausted until {time.ctime(reset_at)}"
+        )
+
+
+def is_exhausted(provider: str, api_key: str) -> bool:
+    try:
+        row = _connection().execute(
+            "SELECT remaining, reset_at FROM api_key_usage WHERE provider = ? AND key_id = ?",
+            (provider, key_id(api_key)),
+        ).fetchone()
+    except Exception as e:
+        logger.warning(f"failed to read api key usage: {str(e)}")
+        return False
+    return bool(row) and row[0] == 0 and row[1] > time.time()
+
+
+def get_stats() -> dict:
+    with _lock:
+        stats = dict(_stats)
+    try:
+        conn = _connection()
+        stats["entries"] = conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+        stats["api_keys"] = [
+            {
+                "provider": row[0],
+                "key_id": row[1],
+                "requests": row[2],
+                "rate_limit": row[3],
+                "remaining": row[4],
+                "reset_at": row[5],
+            }
+            for row in conn.execute(
+                "SELECT provider, key_id, requests, rate_limit, remaining, reset_at FROM api_key_usage"
+            )
+        ]
+    except Exception as e:
+        logger.warning(f"failed to read search cache stats: {str(e)}")
+    return stats
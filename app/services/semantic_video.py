@@ -7,21 +7,29 @@ import os
 import json
 import itertools
 import math
+import threading
 from typing import List, Dict, Optional, Tuple
 from loguru import logger
 import re
-from sentence_transformers import SentenceTransformer
+import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
 
 # Import config to check verbose flag
 from app.config import config
+from app.models.schema import VideoAspect
+from app.services import assignment, embedding_backend, embedding_store, model_server
 
 # Global model instance
 _model = None
 _model_name = None
+_model_backend = "torch"
 _model_load_fails = 0
 _max_model_retries = 3
 
+# read-modify-write updates of the same sidecar are serialized by one of these
+METADATA_LOCK_STRIPES = 64
+_metadata_locks = [threading.RLock() for _ in range(METADATA_LOCK_STRIPES)]
+
 try:
     from app.services import image_similarity
     IMAGE_SIMILARITY_AVAILABLE = True
@@ -29,15 +37,20 @@ except ImportError:
     IMAGE_SIMILARITY_AVAILABLE = False
     logger.warning("Image similarity service not available - install transformers, torch, and pillow for image similarity features")
 
-def load_model(model_name: str = "all-mpnet-base-v2"):
-    """Load the semantic search model"""
-    global _model, _model_name, _model_load_fails
+def load_model(model_name: str = "all-mpnet-base-v2", in_process: bool = False):
+    """Load the semantic search model, unless the model server hosts it (or `in_process` is set)"""
+    global _model, _model_name, _model_backend, _model_load_fails
     
     # Check if we've had too many failures
     if _model_load_fails >= _max_model_retries:
         logger.error(f"❌ Maximum model loading retries ({_max_model_retries}) exceeded for semantic model")
         raise Exception(f"Semantic model loading failed {_model_load_fails} times, giving up")
     
+    if _model is None and model_server.available() and not in_process:
+        # Hosted by the model server, see encode_texts
+        _model_name = model_name
+        return _model
+    
     if _model is None or _model_name != model_name:
         try:
             logger.info(f"🤖 Loading semantic search model: {model_name}")
@@ -45,13 +58,13 @@ def load_model(model_name: str = "all-mpnet-base-v2"):
             
             # Force CPU usage to avoid GPU hanging issues
             logger.info("🖥️  Forcing CPU-only mode for SentenceTransformer to avoid GPU issues")
-            _model = SentenceTransformer(model_name, device='cpu')
+            _model, _model_backend = embedding_backend.load(model_name)
             _model_name = model_name
             
             # Reset failure count on successful load
             _model_load_fails = 0
             
-            logger.success(f"✅ Semantic search model loaded successfully: {model_name} (CPU-only)")
+            logger.success(f"✅ Semantic search model loaded successfully: {model_name} (CPU-only, {_model_backend} backend)")
             logger.info(f"🔧 Model max sequence length: {_model.max_seq_length}")
             
         except Exception as e:
@@ -66,6 +79,74 @@ def load_model(model_name: str = "all-mpnet-base-v2"):
     
     return _model
 
+def _key(model_name: str, backend: str) -> str:
+    return model_name if backend == "torch" else f"{model_name}@{backend}"
+
+def _resolve_backend(model_name: str) -> str:
+    """The backend that actually runs the model, the configured one may have fallen back to torch"""
+    if _model is not None and _model_name == model_name:
+        return _model_backend
+    if model_server.available():
+        try:
+            return model_server.text_backend(model_name)
+        except Exception as e:
+            logger.warning(f"⚠️  {e}")
+    load_model(model_name, in_process=True)
+    return _model_backend
+
+def model_key() -> str:
+    """Identifies the embeddings of the model, quantized backends do not reproduce torch exactly"""
+    model_name = _model_name or "all-mpnet-base-v2"
+    return _key(model_name, _resolve_backend(model_name))
+
+def encode_texts(texts: List[str], retry: bool = True) -> np.ndarray:
+    """
+    Encode texts in one batch, rows are L2-normalized embeddings.
+    Embeddings are looked up in the persistent store first, only the missing
+    texts are run through the model. If the backend changed meanwhile, the
+    lookup is retried once with the new one (`retry`).
+    """
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    model_name = _model_name or "all-mpnet-base-v2"
+    backend = _resolve_backend(model_name)
+    stored = embedding_store.get_many(_key(model_name, backend), texts)
+    missing = [t for t in dict.fromkeys(texts) if t not in stored]
+    if missing:
+        embeddings = None
+        used = backend
+        if model_server.available() and not (_model is not None and _model_name == model_name):
+            try:
+                embeddings, used = model_server.embed_texts(missing, model_name)
+            except Exception as e:
+                logger.warning(f"⚠️  {e}")
+        if embeddings is None:
+            model = load_model(model_name, in_process=True)
+            embeddings, used = model.encode(
+                missing, batch_size=32, normalize_embeddings=True, show_progress_bar=False
+            ), _model_backend
+        if used != backend and retry:
+            # the server was restarted with another backend, the stored rows do not match
+            logger.warning(f"⚠️  Semantic backend changed from {backend} to {used}, encoding again")
+            return encode_texts(texts, retry=False)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        # under the backend that encoded them, even if it changed again
+        embedding_store.put_many(_key(model_name, used), missing, embeddings)
+        stored.update(zip(missing, embeddings))
+    return np.stack([stored[t] for t in texts])
+
+def similarity_matrix(sentences: List[str], texts: List[str]) -> np.ndarray:
+    """Cosine similarity of every sentence (rows) to every text (columns), each unique string is encoded once"""
+    sentence_index = {s: i for i, s in enumerate(dict.fromkeys(sentences))}
+    text_index = {t: i for i, t in enumerate(dict.fromkeys(texts))}
+    if not sentence_index or not text_index:
+        return np.zeros((len(sentences), len(texts)), dtype=np.float32)
+    # rows are normalized, so the dot product is the cosine similarity
+    scores = encode_texts(list(sentence_index)) @ encode_texts(list(text_index)).T
+    rows = [sentence_index[s] for s in sentences]
+    columns = [text_index[t] for t in texts]
+    return scores[np.ix_(rows, columns)]
+
 def segment_script_into_sentences(script: str, min_length: int = 25, max_length: int = 150) -> List[str]:
     """Segment script into sentences with minimum and maximum length"""
     logger.info(f"📝 Segmenting script using method: sentences")
@@ -156,7 +237,7 @@ def segment_script_into_sentences(script: str, min_length: int = 25, max_length:
 def calculate_similarity(sentence: str, video_text: str) -> float:
     """Calculate semantic similarity between sentence and video text"""
     try:
-        model = load_model()
+        model = load_model(_model_name or "all-mpnet-base-v2")
         
         # Reduced logging - only log device info once per session
         if not hasattr(calculate_similarity, '_device_logged'):
@@ -180,17 +261,11 @@ def calculate_similarity(sentence: str, video_text: str) -> float:
         if hasattr(model, 'to'):
             model = model.to('cpu')
         
-        # Encode both texts - minimal logging
-        try:
-            sentence_embedding = model.encode([sentence], device='cpu')
-            video_embedding = model.encode([video_text], device='cpu')
-        except Exception as encode_error:
-            logger.warning(f"⚠️ Encoding error, trying without explicit device: {encode_error}")
-            sentence_embedding = model.encode([sentence])
-            video_embedding = model.encode([video_text])
+        # Encode both texts (cached in the embedding store) - minimal logging
+        sentence_embedding, video_embedding = encode_texts([sentence, video_text])
         
         # Calculate cosine similarity
-        similarity = cosine_similarity(sentence_embedding, video_embedding)[0][0]
+        similarity = cosine_similarity([sentence_embedding], [video_embedding])[0][0]
         
         return float(similarity)
         
@@ -209,15 +284,21 @@ def find_best_video_for_sentence(
     max_video_reuse: int = 2,
     enable_image_similarity: bool = False,
     image_similarity_threshold: float = 0.7,
-    image_similarity_model: str = "clip-vit-base-patch32"
+    image_similarity_model: str = "clip-vit-base-patch32",
+    text_similarities: Optional[Dict[str, float]] = None
 ) -> Optional[Dict]:
-    """Find the best video for a given sentence with strong diversity controls"""
+    """
+    Find the best video for a given sentence with strong diversity controls.
+    `text_similarities` maps search terms to their precomputed similarity to
+    the sentence, terms that are missing are encoded one by one.
+    """
     if config.app.get('verbose', False):
         logger.info(f"🔍 Finding best video for sentence: '{sentence[:60]}...'")
         logger.info(f"📊 Analyzing {len(video_metadata)} available videos")
     
     # Calculate all similarities and scores once
     video_scores = []
+    unused_videos_available = any(used_videos.get(v['video_path'], 0) == 0 for v in video_metadata)
     
     for i, video_meta in enumerate(video_metadata, 1):
         try:
@@ -225,7 +306,10 @@ def find_best_video_for_sentence(
             search_term = video_meta.get('search_term', '')
             
             # Calculate text similarity
-            similarity = calculate_similarity(sentence, search_term)
+            if text_similarities is not None and search_term in text_similarities:
+                similarity = text_similarities[search_term]
+            else:
+                similarity = calculate_similarity(sentence, search_term)
             
             # Initialize image similarity
             image_similarity_score = 0.0
@@ -269,9 +353,6 @@ def find_best_video_for_sentence(
             
             # Special handling for max_video_reuse = 1
             if max_video_reuse == 1:
-                # Check if there are any unused videos available
-                unused_videos_available = any(used_videos.get(v['video_path'], 0) == 0 for v in video_metadata)
-                
                 if usage_count == 0:
                     diversity_penalty = 0.0  # No penalty for unused videos
                 elif usage_count >= 1 and unused_videos_available:
@@ -393,6 +474,83 @@ def find_best_video_for_sentence(
     # Return both the video and its detailed scores
     return best_video, selected_video_scores
 
+def _index_candidates(
+    segments: List[str],
+    video_metadata: List[Dict],
+    needed_video_clips: int,
+    video_aspect: Optional[VideoAspect] = None
+) -> List[Dict]:
+    """
+    Add the top-k clips of every segment from the clip index to the pool, so
+    footage cached by earlier tasks anywhere in the material cache is matched
+    too, at a cost that does not grow with the cache. Clips of another
+    orientation than `video_aspect` and near-duplicates of pool clips are left out
+    """
+    from app.services import clip_index, fingerprint, material
+    
+    if not clip_index.enabled:
+        return video_metadata
+    try:
+        clip_index.add_many([(v['video_path'], v.get('search_term', '')) for v in video_metadata])
+        k = max(clip_index.top_k, math.ceil(needed_video_clips / len(segments)) * 2)
+        results = clip_index.search(encode_texts(list(dict.fromkeys(segments))), k)
+    except Exception as e:
+        logger.warning(f"⚠️  Clip index is unavailable, using the {len(video_metadata)} pool videos only: {e}")
+        return video_metadata
+    
+    known = {v['video_path'] for v in video_metadata}
+    fingerprints = [v['fingerprint'] for v in video_metadata if v.get('fingerprint')]
+    target = video_aspect.to_resolution() if video_aspect else None
+    # best matches of all segments first
+    found = sorted((score, path) for row in results for path, score in row)
+    added = []
+    for _, path in reversed(found):
+        if path in known:
+            continue
+        known.add(path)
+        metadata = load_video_metadata(path)
+        if not metadata:
+            continue
+        if target:
+            size = metadata.get('rendition') or material.probe_video_info(path) or {}
+            width, height = size.get('width', 0), size.get('height', 0)
+            if not width or not height or np.sign(width - height) != np.sign(target[0] - target[1]):
+                continue
+        if fingerprint.is_duplicate(metadata.get('fingerprint'), fingerprints):
+            continue
+        if metadata.get('fingerprint'):
+            fingerprints.append(metadata['fingerprint'])
+        metadata['video_path'] = path
+        added.append(metadata)
+    if added:
+        logger.info(f"🗂️  Clip index: {len(added)} cached clips added to {len(video_metadata)} pool videos")
+    return video_metadata + added
+
+def _score_matrix(
+    segments: List[str],
+    video_metadata: List[Dict],
+    text_similarities: Dict[str, Dict[str, float]],
+    enable_image_similarity: bool = False,
+    image_similarity_model: str = "clip-vit-base-patch32"
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Text, image and combined similarity of every segment (rows) to every video (columns)"""
+    text_scores = np.array([
+        [text_similarities[segment].get(v.get('search_term', ''), 0.0) for v in video_metadata]
+        for segment in segments
+    ], dtype=np.float64)
+    image_scores = np.zeros_like(text_scores)
+    if not (enable_image_similarity and IMAGE_SIMILARITY_AVAILABLE):
+        return text_scores, image_scores, text_scores
+    
+    try:
+        image_scores = image_similarity.similarity_matrix(
+            segments, video_metadata, image_similarity_model
+        ).astype(np.float64)
+    except Exception as e:
+        logger.error(f"❌ Failed to calculate the image similarity matrix: {e}")
+    # Weight: 30% text similarity, 70% image similarity
+    return text_scores, image_scores, 0.3 * text_scores + 0.7 * image_scores
+
 def select_videos_for_script(
     script: str,
     video_metadata: List[Dict],
@@ -405,9 +563,18 @@ def select_videos_for_script(
     semantic_model: str = "all-mpnet-base-v2",
     enable_image_similarity: bool = False,
     image_similarity_threshold: float = 0.7,
-    image_similarity_model: str = "clip-vit-base-patch32"
+    image_similarity_model: str = "clip-vit-base-patch32",
+    video_aspect: Optional[VideoAspect] = None
 ) -> List[Dict]:
-    """Select videos for script segments using semantic matching"""
+    """
+    Select videos for script segments using semantic matching.
+
+    Clips below `similarity_threshold` are only used when no better clip is
+    left for a segment. `diversity_threshold` is not used, reuse is
+    controlled by `max_video_reuse` and the growing reuse penalties.
+    Fitting clips of the clip index are added to `video_metadata`, only
+    those of the orientation of `video_aspect` if it is given.
+    """
     
     logger.info("🎬" + "=" * 50 + " SEMANTIC VIDEO SELECTION " + "=" * 50)
     logger.info("🎯 Starting semantic video selection for script")
@@ -444,6 +611,7 @@ def select_videos_for_script(
     # Calculate how many video clips we need to fill the audio duration
     # This is the key fix - we need enough video selections to fill audio duration, not just match script segments
     needed_video_clips = int(audio_duration / max_clip_duration) + (1 if audio_duration % max_clip_duration > 0 else 0)
+    video_metadata = _index_candidates(segments or ["Generic content"], video_metadata, needed_video_clips, video_aspect)
     available_videos = len(video_metadata)
     
     # Handle insufficient videos scenario - NEVER allow blank screen
@@ -498,11 +666,42 @@ def select_videos_for_script(
     # Create video selections - repeat segments cyclically if we need more videos than segments
     video_selections_needed = needed_video_clips
     segment_cycle = itertools.cycle(segments) if segments else []
+    slot_segments = [next(segment_cycle) if segments else "Generic content" for _ in range(video_selections_needed)]
     
-    for i in range(video_selections_needed):
-        # Get the next segment from the cycle
-        segment = next(segment_cycle) if segments else "Generic content"
-        
+    # Embed all segments and search terms in two batches and score every
+    # pair with one matrix product instead of encoding per pair
+    text_similarities = {}
+    search_terms = list(dict.fromkeys(v.get('search_term', '') for v in video_metadata))
+    try:
+        matrix = similarity_matrix(segments or ["Generic content"], search_terms)
+        for segment, row in zip(segments or ["Generic content"], matrix):
+            text_similarities[segment] = {term: float(score) for term, score in zip(search_terms, row)}
+        logger.info(f"🧮 Text similarity matrix: {matrix.shape[0]} segments × {matrix.shape[1]} search terms")
+    except Exception as e:
+        logger.warning(f"⚠️  Batched text similarity failed, scoring pairs one by one: {e}")
+    
+    # Assign clips to all selections at once, maximizing the total similarity
+    # under the reuse limit, the greedy per-selection search is the fallback
+    assigned = None
+    if text_similarities and video_metadata:
+        try:
+            unique_segments = list(dict.fromkeys(slot_segments))
+            text_scores, image_scores, combined_scores = _score_matrix(
+                unique_segments, video_metadata, text_similarities,
+                enable_image_similarity, image_similarity_model
+            )
+            segment_rows = {segment: row for row, segment in enumerate(unique_segments)}
+            rows = [segment_rows[segment] for segment in slot_segments]
+            assigned = assignment.assign(combined_scores[rows], actual_max_reuse, similarity_threshold)
+            logger.info(f"🧩 Assigned {len(assigned)} selections to {len(video_metadata)} videos")
+            below = sum(1 for row, column in zip(rows, assigned) if column >= 0 and combined_scores[row, column] < similarity_threshold)
+            if below:
+                logger.warning(f"⚠️  {below} selections below the similarity threshold ({similarity_threshold}), using anyway")
+        except Exception as e:
+            logger.warning(f"⚠️  Global assignment failed, selecting videos one by one: {e}")
+            assigned = None
+    
+    for i, segment in enumerate(slot_segments):
         if config.app.get('verbose', False):
             logger.info(f"🔄 PROCESSING VIDEO SELECTION {i+1}/{video_selections_needed}")
         else:
@@ -510,17 +709,35 @@ def select_videos_for_script(
             if (i+1) % 10 == 1 or (i+1) == video_selections_needed:
                 logger.info(f"🔄 PROCESSING VIDEO SELECTION {i+1}/{video_selections_needed}")
         
-        best_video, selected_video_scores = find_best_video_for_sentence(
-            segment, 
-            video_metadata, 
-            used_videos,
-            similarity_threshold,
-            diversity_threshold,
-            actual_max_reuse,  # Use calculated actual max reuse
-            enable_image_similarity,
-            image_similarity_threshold,
-            image_similarity_model
-        )
+        if assigned is not None:
+            best_video, selected_video_scores = None, None
+            if assigned[i] >= 0:
+                best_video = video_metadata[assigned[i]]
+                row = rows[i]
+                usage = used_videos.get(best_video['video_path'], 0)
+                penalty = float(assignment.reuse_penalties(actual_max_reuse, usage + 1)[usage])
+                selected_video_scores = {
+                    'video': best_video,
+                    'text_similarity': float(text_scores[row, assigned[i]]),
+                    'image_similarity': float(image_scores[row, assigned[i]]),
+                    'combined_similarity': float(combined_scores[row, assigned[i]]),
+                    'usage': usage,
+                    'penalty': penalty,
+                    'final_score': float(combined_scores[row, assigned[i]]) - penalty
+                }
+        else:
+            best_video, selected_video_scores = find_best_video_for_sentence(
+                segment, 
+                video_metadata, 
+                used_videos,
+                similarity_threshold,
+                diversity_threshold,
+                actual_max_reuse,  # Use calculated actual max reuse
+                enable_image_similarity,
+                image_similarity_threshold,
+                image_similarity_model,
+                text_similarities.get(segment)
+            )
         
         if best_video:
             selected_videos.append({
@@ -612,13 +829,33 @@ def save_video_metadata(video_path: str, search_term: str, additional_info: Dict
         metadata.update(additional_info)
     
     metadata_path = get_metadata_path(video_path)
+    # written next to the sidecar and swapped in, readers never see a partial file
+    temp_path = f"{metadata_path}.{os.getpid()}.{threading.get_ident()}.tmp"
     
     try:
-        with open(metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, indent=2, ensure_ascii=False)
+        with metadata_lock(video_path):
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(metadata, f, indent=2, ensure_ascii=False)
+            os.replace(temp_path, metadata_path)
         logger.debug(f"Saved metadata for {video_path}")
     except Exception as e:
         logger.error(f"Failed to save metadata for {video_path}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def metadata_lock(video_path: str) -> threading.RLock:
+    """Lock of the sidecar of a clip, held while it is read, changed and saved"""
+    return _metadata_locks[hash(os.path.abspath(video_path)) % METADATA_LOCK_STRIPES]
+
+def update_video_metadata(video_path: str, **fields) -> Optional[Dict]:
+    """Merge `fields` into the sidecar of a clip, None if the clip has no sidecar"""
+    with metadata_lock(video_path):
+        metadata = load_video_metadata(video_path)
+        if metadata is None:
+            return None
+        metadata.update(fields)
+        save_video_metadata(video_path, metadata.get("search_term", ""), metadata)
+        return metadata
 
 def load_video_metadata(video_path: str) -> Optional[Dict]:
     """Load metadata for a video file"""
@@ -0,0 +1,199 @@
+"""
+Shot boundaries of video clips.
+
+A clip is decoded once at SAMPLE_FPS into tiny RGB frames, and a cut is
+placed between two consecutive frames whose color histograms and pixels
+both differ strongly (the histogram alone misses cuts between similar
+scenes, the pixel difference alone fires on fast motion). The shots are
+stored as [start, end] seconds in the `shots` entry of the metadata
+sidecar, so every task reuses them; clips without a sidecar (local
+material) are kept in memory by path, size and mtime. combine_videos starts its sub-clips on
+shot boundaries instead of at random or fixed offsets.
+"""
+
+import os
+import random
+import subprocess
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from loguru import logger
+
+from app.config import config
+from app.services import cancellation, semantic_video
+
+enabled = config.app.get("shot_detection_enabled", True)
+# histogram change (0..1) between consecutive frames that counts as a cut
+threshold = config.app.get("shot_detection_threshold", 0.3)
+# mean absolute pixel change (0..1) a cut needs as well
+SAD_THRESHOLD = 0.08
+SAMPLE_FPS = 5
+FRAME_WIDTH = 64
+FRAME_HEIGHT = 36
+HISTOGRAM_BINS = 16
+MIN_SHOT_SECONDS = 1.0
+# shots of clips without a sidecar, least recently used first
+MEMORY_CACHE_ENTRIES = 1024
+
+_memory = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def decode_frames(video_path: str) -> np.ndarray:
+    """All frames of the clip at SAMPLE_FPS, as a (frames, height, width, 3) uint8 array."""
+    cmd = [
+        "ffmpeg", "-v", "error", "-i", video_path, "-an",
+        "-vf", f"fps={SAMPLE_FPS},scale={FRAME_WIDTH}:{FRAME_HEIGHT}",
+        "-pix_fmt", "rgb24", "-f", "rawvideo", "-",
+    ]
+    data = cancellation.run_process(cmd).stdout
+    frame_size = FRAME_WIDTH * FRAME_HEIGHT * 3
+    count = len(data) // frame_size
+    return np.frombuffer(data[: count * frame_size], dtype=np.uint8).reshape(
+        count, FRAME_HEIGHT, FRAME_WIDTH, 3
+    )
+
+
+def frame_differences(frames: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Histogram and pixel change between every pair of consecutive frames,
+    both in 0..1: the total variation distance of the per-channel color
+    histograms, and the mean absolute difference of the pixel values.
+    """
+    count = len(frames)
+    # bin of every pixel and channel, offset per channel and per frame for one bincount
+    bins = (frames.reshape(count, -1, 3) // (256 // HISTOGRAM_BINS)).astype(np.int64)
+    bins += np.arange(3) * HISTOGRAM_BINS
+    bins += np.arange(count)[:, None, None] * 3 * HISTOGRAM_BINS
+    histograms = np.bincount(bins.ravel(), minlength=count * 3 * HISTOGRAM_BINS)
+    histograms = histograms.reshape(count, 3 * HISTOGRAM_BINS) / (frames.shape[1] * frames.shape[2])
+    histogram_change = np.abs(np.diff(histograms, axis=0)).sum(axis=1) / 6
+
+    # per channel, scenes of different colors can have the same luminance
+    pixel_change = np.abs(np.diff(frames.astype(np.int16), axis=0)).mean(axis=(1, 2, 3)) / 255
+    return histogram_change, pixel_change
+
+
+def boundaries(frames: np.ndarray, fps: float = SAMPLE_FPS) -> List[float]:
+    """Timestamps of the first frame of every shot after the first one."""
+    if len(frames) < 2:
+        return []
+    histogram_change, pixel_change = frame_differences(frames)
+    cuts = np.flatnonzero((histogram_change >= threshold) & (pixel_change >= SAD_THRESHOLD)) + 1
+    result = []
+    last = 0
+    for cut in cuts.tolist():
+        # flashes and fast pans fire on consecutive frames, keep shots of a useful length
+        if (cut - last) / fps >= MIN_SHOT_SECONDS:
+            result.append(cut / fps)
+            last = cut
+    return result
+
+
+def detect(video_path: str, duration: float = 0.0) -> List[List[float]]:
+    """Shots of a clip as [start, end] seconds, empty if it could not be decoded."""
+    try:
+        frames = decode_frames(video_path)
+    except subprocess.CalledProcessError as e:
+        logger.warning(f"failed to detect the shots of {video_path}: {e}")
+        return []
+    if not len(frames):
+        return []
+    duration = duration or len(frames) / SAMPLE_FPS
+    edges = [0.0] + [t for t in boundaries(frames) if t < duration] + [duration]
+    return [[round(start, 2), round(end, 2)] for start, end in zip(edges, edges[1:]) if end > start]
+
+
+def _file_key(video_path: str) -> Tuple[str, int, float]:
+    # a replaced local file gets detected again
+    stat = os.stat(video_path)
+    return os.path.abspath(video_path), stat.st_size, stat.st_mtime
+
+
+def ensure(video_path: str, duration: float) -> List[List[float]]:
+    """Shots of a clip from its metadata sidecar, detected and stored on first use."""
+    if not enabled:
+        return []
+    metadata = semantic_video.load_video_metadata(video_path)
+    if metadata and "shots" in metadata:
+        return metadata["shots"]
+    if metadata is not None:
+        shots = detect(video_path, duration)
+        semantic_video.update_video_metadata(video_path, shots=shots)
+        return shots
+
+    try:
+        key = _file_key(video_path)
+    except OSError:
+        return detect(video_path, duration)
+    with _memory_lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            return _memory[key]
+    shots = detect(video_path, duration)
+    with _memory_lock:
+        _memory[key] = shots
+        while len(_memory) > MEMORY_CACHE_ENTRIES:
+            _memory.popitem(last=False)
+    return shots
+
+
+def sample_times(shots: List[List[float]], count: int) -> List[float]:
+    """Midpoints of the `count` longest shots in time order, empty for clips of a single shot."""
+    if len(shots) < 2:
+        return []
+    longest = sorted(shots, key=lambda shot: shot[1] - shot[0], reverse=True)[:count]
+    return sorted(round((start + end) / 2, 2) for start, end in longest)
+
+
+def windows(shots: List[List[float]], duration: float, length: float) -> List[Tuple[float, float]]:
+    """
+    Consecutive non-overlapping sub-clips of `length` seconds. Each one
+    starts on the next shot boundary, or right after the previous one when
+    the current shot is long enough for another full sub-clip. Without shots
+    these are the fixed windows 0..length, length..2*length, ...
+    """
+    starts = [start for start, _ in shots]
+    result = []
+    start = 0.0
+    while start + length <= duration:
+        end = start + length
+        result.append((start, end))
+        following = [s for s in starts if s >= end]
+        if following and following[0] - end < length:
+            start = following[0]
+        else:
+            start = end
+    return result
+
+
+def choose_start(
+    shots: List[List[float]],
+    duration: float,
+    length: float,
+    scores: Optional[Sequence[Optional[float]]] = None,
+    used: Optional[Set[float]] = None,
+) -> float:
+    """
+    Start of a sub-clip of `length` seconds on a shot boundary: the best
+    scoring shot if `scores` are given, else a random one. Shots that hold
+    the whole sub-clip are preferred, and starts in `used` (earlier uses of
+    the clip) are avoided while others are left. Without shots, a random
+    start as before.
+    """
+    latest = max(0.0, duration - length)
+    fitting = [i for i, (start, _) in enumerate(shots) if start <= latest]
+    if not fitting:
+        return random.uniform(0, latest) if latest > 0 else 0.0
+    fitting = [i for i in fitting if shots[i][0] not in (used or ())] or fitting
+
+    def holds(i: int) -> bool:
+        return shots[i][1] - shots[i][0] >= length
+
+    if scores:
+        best = max(fitting, key=lambda i: (scores[i] if scores[i] is not None else -np.inf, holds(i)))
+    else:
+        best = random.choice([i for i in fitting if holds(i)] or fitting)
+    return shots[best][0]
@@ -1,8 +1,228 @@
 import ast
+import asyncio
+import json
+import os
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from enum import Enum
+
+from loguru import logger
 
 from app.config import config
 from app.models import const
+from app.utils import utils
+
+try:
+    import orjson
+
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Version of the task record encoding. Bump it whenever the on-wire layout
+# changes; records written by an older version are still decoded.
+STATE_SCHEMA_VERSION = 1
+_VERSION_FIELD = "_v"
+
+# Field types of a task record. Fields not listed here are stored as-is.
+TASK_SCHEMA = {
+    "task_id": str,
+    "state": int,
+    "progress": int,
+    "script": str,
+    "terms": (list, str),
+    "audio_file": str,
+    "audio_duration": (int, float),
+    "subtitle_path": str,
+    "materials": list,
+    "videos": list,
+    "combined_videos": list,
+    "queued": bool,
+}
+
+
+def _to_primitive(value):
+    """
+    Convert a value into plain JSON data (dict, list, str, int, float, bool, None).
+    Pydantic models and dataclasses such as VideoParams and MaterialInfo are
+    converted into dicts, so both state backends return the same shape.
+    """
+    # str and int enums such as VideoAspect are stored as their plain value
+    if isinstance(value, Enum):
+        return _to_primitive(value.value)
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, dict):
+        return {str(k): _to_primitive(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [_to_primitive(v) for v in value]
+    if hasattr(type(value), "model_fields"):
+        # field by field rather than model_dump, whose serializer warns about
+        # enum fields that hold their plain value (the VideoParams defaults)
+        return _to_primitive({k: getattr(value, k) for k in type(value).model_fields})
+    if hasattr(value, "__dict__"):
+        return _to_primitive(
+            {k: v for k, v in value.__dict__.items() if not k.startswith("_")}
+        )
+    return str(value)
+
+
+def _default(value):
+    primitive = _to_primitive(value)
+    if primitive is value:
+        raise TypeError(f"unsupported type: {type(value)}")
+    return primitive
+
+
+def encode_value(value) -> bytes:
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(value, default=_default)
+    return json.dumps(
+        _to_primitive(value), ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def decode_value(data: bytes):
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def encode_task(fields: dict) -> dict:
+    """Encode a (partial) task record into a mapping of field name to bytes."""
+    encoded = {field: encode_value(value) for field, value in fields.items()}
+    encoded[_VERSION_FIELD] = str(STATE_SCHEMA_VERSION).encode("utf-8")
+    return encoded
+
+
+def decode_task(raw: dict) -> dict:
+    """
+    Decode a task record read back from the store. Records written before the
+    versioned encoding existed are parsed with the legacy literal_eval path.
+    """
+    raw = {
+        (k.decode("utf-8") if isinstance(k, bytes) else k): v for k, v in raw.items()
+    }
+    version = raw.pop(_VERSION_FIELD, None)
+    if version is None:
+        return {k: _legacy_decode_value(v) for k, v in raw.items()}
+
+    task = {}
+    for field, value in raw.items():
+        try:
+            task[field] = decode_value(value)
+        except ValueError:
+            # a field written by an older, unversioned update_task call
+            task[field] = _legacy_decode_value(value)
+    return task
+
+
+def validate_task(task: dict) -> dict:
+    """Coerce the known fields of a task record to their schema types."""
+    for field, expected in TASK_SCHEMA.items():
+        value = task.get(field)
+        if value is None or isinstance(value, expected):
+            continue
+        target = expected[0] if isinstance(expected, tuple) else expected
+        try:
+            task[field] = target(value)
+        except (TypeError, ValueError):
+            pass
+    return task
+
+
+def _legacy_decode_value(value):
+    """
+    Convert the value from byte string to its original data type.
+    """
+    value_str = value.decode("utf-8") if isinstance(value, bytes) else value
+
+    try:
+        # try to convert byte string array to list
+        return ast.literal_eval(value_str)
+    except (ValueError, SyntaxError):
+        pass
+
+    if value_str.isdigit():
+        return int(value_str)
+    return value_str
+
+
+def _state_event(fields: dict) -> dict:
+    return {"type": "state", "time": time.time(), **_to_primitive(fields)}
+
+
+class EventSubscription(ABC):
+    """A stream of events for a single task, consumed from the asyncio loop."""
+
+    @abstractmethod
+    async def get(self, timeout: float = None):
+        """Return the next event, or None if nothing arrived within `timeout`."""
+        pass
+
+    @abstractmethod
+    async def close(self):
+        pass
+
+
+class _QueueSubscription(EventSubscription):
+    def __init__(self, broadcaster, task_id: str, maxsize: int = 100):
+        self._broadcaster = broadcaster
+        self._task_id = task_id
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=maxsize)
+
+    def put_threadsafe(self, event: dict):
+        self._loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event: dict):
+        if self._queue.full():
+            # slow consumer, drop the oldest event rather than blocking publishers
+            self._queue.get_nowait()
+        self._queue.put_nowait(event)
+
+    async def get(self, timeout: float = None):
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def close(self):
+        self._broadcaster.unsubscribe(self._task_id, self)
+
+
+class EventBroadcaster:
+    """In-process fan-out of task events from worker threads to subscribers."""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def publish(self, task_id: str, event: dict):
+        with self._lock:
+            subscribers = list(self._subscribers.get(task_id, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_threadsafe(event)
+            except RuntimeError:
+                # the subscriber's event loop is closed
+                self.unsubscribe(task_id, subscriber)
+
+    def subscribe(self, task_id: str) -> EventSubscription:
+        subscription = _QueueSubscription(self, task_id)
+        with self._lock:
+            self._subscribers.setdefault(task_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, task_id: str, subscription: EventSubscription):
+        with self._lock:
+            subscribers = self._subscribers.get(task_id)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[task_id]
 
 
 # Base class for state management
@@ -11,6 +231,24 @@ class BaseState(ABC):
     def update_task(self, task_id: str, state: int, progress: int = 0, **kwargs):
         pass
 
+    @abstractmethod
+    def publish_event(self, task_id: str, event: dict):
+        """Push an event (stage timing, render progress...) to task subscribers."""
+        pass
+
+    @abstractmethod
+    async def subscribe(self, task_id: str) -> EventSubscription:
+        pass
+
+    @abstractmethod
+    def request_cancel(self, task_id: str):
+        """Flag a task for cancellation without touching its state or progress."""
+        pass
+
+    @abstractmethod
+    def is_cancel_requested(self, task_id: str) -> bool:
+        pass
+
     @abstractmethod
     def get_task(self, task_id: str):
         pass
@@ -22,15 +260,43 @@ class BaseState(ABC):
 
 # Memory state management
 class MemoryState(BaseState):
-    def __init__(self):
-        self._tasks = {}
+    """
+    In-process task store.
+
+    Updates are merged into the existing record. Running tasks always stay in
+    memory; finished tasks are kept in LRU order and, once they exceed
+    `max_finished_tasks` or outlive `finished_ttl` seconds, are spilled to an
+    append-only file that is re-indexed on startup.
+    """
+
+    def __init__(
+        self,
+        max_finished_tasks: int = 1000,
+        finished_ttl: float = 3600,
+        spill_file: str = "",
+    ):
+        self._tasks = OrderedDict()
+        self._finished_at = {}
+        self._max_finished_tasks = max_finished_tasks
+        self._finished_ttl = finished_ttl
+        self._spill_file = spill_file
+        # task_id -> byte offset of the latest record in the spill file
+        self._spilled = OrderedDict()
+        self._lock = threading.RLock()
+        self._events = EventBroadcaster()
+        if self._spill_file:
+            self._reindex_spill_file()
 
     def get_all_tasks(self, page: int, page_size: int):
         start = (page - 1) * page_size
         end = start + page_size
-        tasks = list(self._tasks.values())
-        total = len(tasks)
-        return tasks[start:end], total
+        with self._lock:
+            self._evict()
+            task_ids = [t for t in self._spilled if t not in self._tasks]
+            task_ids.extend(self._tasks.keys())
+            total = len(task_ids)
+            tasks = [self._load_task(task_id) for task_id in task_ids[start:end]]
+        return [task for task in tasks if task], total
 
     def update_task(
         self,
@@ -43,27 +309,175 @@ class MemoryState(BaseState):
         if progress > 100:
             progress = 100
 
-        self._tasks[task_id] = {
-            "task_id": task_id,
-            "state": state,
-            "progress": progress,
-            **kwargs,
-        }
+        with self._lock:
+            task = self._tasks.pop(task_id, None)
+            if task is None:
+                task = self._read_spilled(task_id) or {}
+            fields = {
+                "task_id": task_id,
+                "state": state,
+                "progress": progress,
+                **_to_primitive(kwargs),
+            }
+            task.update(fields)
+            self._tasks[task_id] = validate_task(task)
+
+            if state == const.TASK_STATE_PROCESSING:
+                self._finished_at.pop(task_id, None)
+            else:
+                self._finished_at[task_id] = time.monotonic()
+                self._evict()
+
+        self._events.publish(task_id, _state_event(fields))
+
+    def publish_event(self, task_id: str, event: dict):
+        self._events.publish(task_id, _to_primitive(event))
+
+    async def subscribe(self, task_id: str) -> EventSubscription:
+        return self._events.subscribe(task_id)
+
+    def request_cancel(self, task_id: str):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is not None:
+                task["cancel_requested"] = True
+
+    def is_cancel_requested(self, task_id: str) -> bool:
+        with self._lock:
+            # a task cancelled while queued is finished and may have been spilled
+            task = self._load_task(task_id)
+            return bool(task and task.get("cancel_requested"))
 
     def get_task(self, task_id: str):
-        return self._tasks.get(task_id, None)
+        with self._lock:
+            return self._load_task(task_id)
 
     def delete_task(self, task_id: str):
-        if task_id in self._tasks:
-            del self._tasks[task_id]
+        with self._lock:
+            self._tasks.pop(task_id, None)
+            self._finished_at.pop(task_id, None)
+            if self._spilled.pop(task_id, None) is not None:
+                self._append_spill({"task_id": task_id, "_deleted": True})
+
+    def _load_task(self, task_id: str):
+        task = self._tasks.get(task_id)
+        if task is not None:
+            if task_id in self._finished_at:
+                self._tasks.move_to_end(task_id)
+            # hand out a copy so callers cannot mutate the stored record
+            return dict(task)
+        return self._read_spilled(task_id)
+
+    def _evict(self):
+        if not self._finished_at:
+            return
+
+        now = time.monotonic()
+        finished = [t for t in self._tasks if t in self._finished_at]
+        overflow = len(finished) - self._max_finished_tasks
+        for task_id in finished:
+            expired = now - self._finished_at[task_id] > self._finished_ttl
+            if not expired and overflow <= 0:
+                continue
+            overflow -= 1
+            task = self._tasks.pop(task_id)
+            del self._finished_at[task_id]
+            if self._spill_file:
+                self._spilled[task_id] = self._append_spill(task)
+                self._spilled.move_to_end(task_id)
+
+    def _append_spill(self, record: dict) -> int:
+        os.makedirs(os.path.dirname(self._spill_file), exist_ok=True)
+        with open(self._spill_file, "ab") as f:
+            offset = f.tell()
+            f.write(encode_value(record) + b"\n")
+        return offset
+
+    def _read_spilled(self, task_id: str):
+        offset = self._spilled.get(task_id)
+        if offset is None:
+            return None
+        try:
+            with open(self._spill_file, "rb") as f:
+                f.seek(offset)
+                return validate_task(decode_value(f.readline()))
+        except (OSError, ValueError) as e:
+            logger.warning(f"failed to read spilled task {task_id}: {e}")
+            return None
+
+    def _reindex_spill_file(self):
+        if not os.path.isfile(self._spill_file):
+            return
+
+        records = 0
+        with open(self._spill_file, "rb") as f:
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                try:
+                    record = decode_value(line)
+                except ValueError:
+                    # a torn write from a crashed process, skip it
+                    continue
+                records += 1
+                task_id = record.get("task_id")
+                self._spilled.pop(task_id, None)
+                if not record.get("_deleted"):
+                    self._spilled[task_id] = offset
+
+        # rewrite the file once superseded records dominate it
+        if records > 2 * len(self._spilled) + 100:
+            self._compact_spill_file()
+        logger.info(
+            f"re-indexed {len(self._spilled)} spilled tasks from {self._spill_file}"
+        )
+
+    def _compact_spill_file(self):
+        tasks = [(t, self._read_spilled(t)) for t in self._spilled]
+        temp_file = f"{self._spill_file}.tmp"
+        spilled = OrderedDict()
+        with open(temp_file, "wb") as f:
+            for task_id, task in tasks:
+                if task is None:
+                    continue
+                spilled[task_id] = f.tell()
+                f.write(encode_value(task) + b"\n")
+        os.replace(temp_file, self._spill_file)
+        self._spilled = spilled
 
 
 # Redis state management
+class _RedisSubscription(EventSubscription):
+    def __init__(self, pubsub):
+        self._pubsub = pubsub
+
+    async def get(self, timeout: float = None):
+        message = await self._pubsub.get_message(
+            ignore_subscribe_messages=True, timeout=timeout
+        )
+        if not message:
+            return None
+        return decode_value(message["data"])
+
+    async def close(self):
+        await self._pubsub.unsubscribe()
+        await self._pubsub.aclose()
+
+
 class RedisState(BaseState):
     def __init__(self, host="localhost", port=6379, db=0, password=None):
         import redis
 
         self._redis = redis.StrictRedis(host=host, port=port, db=db, password=password)
+        self._redis_kwargs = {
+            "host": host,
+            "port": port,
+            "db": db,
+            "password": password,
+        }
+        self._async_redis = None
 
     def get_all_tasks(self, page: int, page_size: int):
         start = (page - 1) * page_size
@@ -77,10 +491,7 @@ class RedisState(BaseState):
             if total > start:
                 for key in keys[max(0, start - total):end - total]:
                     task_data = self._redis.hgetall(key)
-                    task = {
-                        k.decode("utf-8"): self._convert_to_original_type(v) for k, v in task_data.items()
-                    }
-                    tasks.append(task)
+                    tasks.append(validate_task(decode_task(task_data)))
                     if len(tasks) >= page_size:
                         break
             if cursor == 0 or len(tasks) >= page_size:
@@ -105,19 +516,42 @@ class RedisState(BaseState):
             **kwargs,
         }
 
-        for field, value in fields.items():
-            self._redis.hset(task_id, field, str(value))
+        # write all fields and notify subscribers in a single round trip
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.hset(task_id, mapping=encode_task(fields))
+        pipe.publish(self._channel(task_id), encode_value(_state_event(fields)))
+        pipe.execute()
+
+    def publish_event(self, task_id: str, event: dict):
+        self._redis.publish(self._channel(task_id), encode_value(event))
+
+    async def subscribe(self, task_id: str) -> EventSubscription:
+        if self._async_redis is None:
+            import redis.asyncio as aioredis
+
+            self._async_redis = aioredis.StrictRedis(**self._redis_kwargs)
+        pubsub = self._async_redis.pubsub()
+        await pubsub.subscribe(self._channel(task_id))
+        return _RedisSubscription(pubsub)
+
+    def request_cancel(self, task_id: str):
+        if self._redis.exists(task_id):
+            self._redis.hset(task_id, "cancel_requested", encode_value(True))
+
+    def is_cancel_requested(self, task_id: str) -> bool:
+        value = self._redis.hget(task_id, "cancel_requested")
+        return bool(value and decode_value(value))
+
+    @staticmethod
+    def _channel(task_id: str) -> str:
+        return f"task_events:{task_id}"
 
     def get_task(self, task_id: str):
         task_data = self._redis.hgetall(task_id)
         if not task_data:
             return None
 
-        task = {
-            key.decode("utf-8"): self._convert_to_original_type(value)
-            for key, value in task_data.items()
-        }
-        return task
+        return validate_task(decode_task(task_data))
 
     def delete_task(self, task_id: str):
         self._redis.delete(task_id)
@@ -126,20 +560,9 @@ class RedisState(BaseState):
     def _convert_to_original_type(value):
         """
         Convert the value from byte string to its original data type.
-        You can extend this method to handle other data types as needed.
+        Kept for records written before the versioned encoding, see decode_task.
         """
-        value_str = value.decode("utf-8")
-
-        try:
-            # try to convert byte string array to list
-            return ast.literal_eval(value_str)
-        except (ValueError, SyntaxError):
-            pass
-
-        if value_str.isdigit():
-            return int(value_str)
-        # Add more conversions here if needed
-        return value_str
+        return _legacy_decode_value(value)
 
 
 # Global state
@@ -148,11 +571,18 @@ _redis_host = config.app.get("redis_host", "localhost")
 _redis_port = config.app.get("redis_port", 6379)
 _redis_db = config.app.get("redis_db", 0)
 _redis_password = config.app.get("redis_password", None)
+_memory_state_max_tasks = config.app.get("memory_state_max_tasks", 1000)
+_memory_state_ttl = config.app.get("memory_state_ttl", 3600)
 
 state = (
     RedisState(
         host=_redis_host, port=_redis_port, db=_redis_db, password=_redis_password
     )
     if _enable_redis
-    else MemoryState()
+    else MemoryState(
+        max_finished_tasks=_memory_state_max_tasks,
+        finished_ttl=_memory_state_ttl,
+        spill_file=os.path.join(utils.storage_dir("state"), "tasks.jsonl"),
+    )
 )
+
@@ -7,6 +7,7 @@ from faster_whisper import WhisperModel
 from loguru import logger
 
 from app.config import config
+from app.services import model_server
 from app.utils import utils
 
 model_size = config.whisper.get("model_size", "large-v3")
@@ -15,7 +16,7 @@ compute_type = config.whisper.get("compute_type", "int8")
 model = None
 
 
-def create(audio_file, subtitle_file: str = ""):
+def load_model():
     global model
     if not model:
         model_path = f"{utils.root_dir()}/models/whisper-{model_size}"
@@ -40,12 +41,19 @@ def create(audio_file, subtitle_file: str = ""):
                 f"********************************************\n\n"
             )
             return None
+    return model
 
-    logger.info(f"start, output file: {subtitle_file}")
-    if not subtitle_file:
-        subtitle_file = f"{audio_file}.srt"
 
-    segments, info = model.transcribe(
+def transcribe(audio_file):
+    """Word-level transcription, by the model server if enabled."""
+    if model_server.available():
+        try:
+            return model_server.transcribe(audio_file)
+        except Exception as e:
+            logger.warning(str(e))
+    if not load_model():
+        raise RuntimeError("whisper model is not available")
+    return model.transcribe(
         audio_file,
         beam_size=5,
         word_timestamps=True,
@@ -53,6 +61,17 @@ def create(audio_file, subtitle_file: str = ""):
         vad_parameters=dict(min_silence_duration_ms=500),
     )
 
+
+def create(audio_file, subtitle_file: str = ""):
+    if not model_server.available() and not load_model():
+        return None
+
+    logger.info(f"start, output file: {subtitle_file}")
+    if not subtitle_file:
+        subtitle_file = f"{audio_file}.srt"
+
+    segments, info = transcribe(audio_file)
+
     logger.info(
         f"detected language: '{info.language}', probability: {info.language_probability:.2f}"
     )
@@ -305,43 +324,15 @@ def create_enhanced_subtitles(audio_file, subtitle_file: str = "", params=None):
     """
     from app.models.schema import WordTiming, EnhancedSubtitle
     
-    global model
-    if not model:
-        model_path = f"{utils.root_dir()}/models/whisper-{model_size}"
-        model_bin_file = f"{model_path}/model.bin"
-        if not os.path.isdir(model_path) or not os.path.isfile(model_bin_file):
-            model_path = model_size
-
-        logger.info(
-            f"loading model: {model_path}, device: {device}, compute_type: {compute_type}"
-        )
-        try:
-            model = WhisperModel(
-                model_size_or_path=model_path, device=device, compute_type=compute_type
-            )
-        except Exception as e:
-            logger.error(
-                f"failed to load model: {e} \n\n"
-                f"********************************************\n"
-                f"this may be caused by network issue. \n"
-                f"please download the model manually and put it in the 'models' folder. \n"
-                f"see [README.md FAQ](https://github.com/harry0703/MoneyPrinterTurbo) for more details.\n"
-                f"********************************************\n\n"
-            )
-            return None
+    if not model_server.available() and not load_model():
+        return None
 
     logger.info(f"start enhanced subtitle generation, output file: {subtitle_file}")
     if not subtitle_file:
         subtitle_file = f"{audio_file}.enhanced.json"
 
     # Generate word-level transcription
-    segments, info = model.transcribe(
-        audio_file,
-        beam_size=5,
-        word_timestamps=True,
-        vad_filter=True,
-        vad_parameters=dict(min_silence_duration_ms=500),
-    )
+    segments, info = transcribe(audio_file)
 
     logger.info(
         f"detected language: '{info.language}', probability: {info.language_probability:.2f}"
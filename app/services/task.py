@@ -1,17 +1,49 @@
+import contextvars
 import math
 import os.path
 import re
+import threading
+import time
 from os import path
 
 from loguru import logger
 
 from app.config import config
 from app.models import const
+from app.models.exception import TaskCancelledError
 from app.models.schema import VideoConcatMode, VideoParams
-from app.services import llm, material, subtitle, video, voice
+from app.services import cancellation, fingerprint, library, llm, material, mezzanine, prefetch, semantic_video, subtitle, video, voice
 from app.services import state as sm
 from app.utils import utils
 
+# top-up waves of material downloads once the real audio duration is known
+MATERIAL_TOP_UP_WAVES = 3
+
+
+def run_stage(task_id, stage, func, *args, **kwargs):
+    """Run one pipeline stage and publish its timing to task event subscribers."""
+    cancellation.check()
+    started = time.time()
+    sm.state.publish_event(
+        task_id, {"type": "stage", "stage": stage, "status": "started", "time": started}
+    )
+    status = "failed"
+    try:
+        result = func(*args, **kwargs)
+        status = "finished"
+        return result
+    finally:
+        sm.state.publish_event(
+            task_id,
+            {
+                "type": "stage",
+                "stage": stage,
+                "status": status,
+                "time": time.time(),
+                "elapsed": round(time.time() - started, 3),
+            },
+        )
+
 
 def generate_script(task_id, params):
     logger.info("\n\n## generating video script")
@@ -157,7 +189,57 @@ def generate_subtitle(task_id, params, video_script, sub_maker, audio_file):
     return subtitle_path
 
 
-def get_video_materials(task_id, params, video_terms, audio_duration):
+def estimate_audio_duration(video_script: str, params: VideoParams) -> float:
+    """Rough speech duration of a script, used until the real audio exists."""
+    words = len(video_script.split())
+    # scripts without spaces (Chinese, Japanese) are measured in characters
+    if words < len(video_script) / 20:
+        seconds = len(re.sub(r"\s", "", video_script)) / 4.0
+    else:
+        seconds = words / 2.5
+    # keep a margin, downloads beyond the real duration are cancelled
+    return seconds / (params.voice_rate or 1.0) * 1.2
+
+
+def _top_up_materials(task_id, params, video_terms, video_paths, required):
+    """
+    Download more clips until `video_paths` cover `required` seconds, in at
+    most MATERIAL_TOP_UP_WAVES waves. The terms with the least footage so far
+    are searched first to keep the terms balanced.
+    """
+    for wave in range(MATERIAL_TOP_UP_WAVES):
+        cancellation.check()
+        deficit = required - material.covered_duration(video_paths, params.video_clip_duration)
+        if deficit <= 0:
+            break
+
+        coverage = {term: 0 for term in video_terms}
+        for metadata in semantic_video.get_video_metadata_list(video_paths):
+            if metadata.get("search_term") in coverage:
+                coverage[metadata["search_term"]] += 1
+        terms = sorted(video_terms, key=lambda term: coverage[term])
+        logger.info(f"material top-up wave {wave + 1}: {deficit:.1f} seconds missing, terms: {terms}")
+
+        new_videos = library.download_videos(
+            task_id=task_id,
+            search_terms=terms,
+            source=params.video_source,
+            video_aspect=params.video_aspect,
+            video_contact_mode=params.video_concat_mode,
+            audio_duration=deficit,
+            max_clip_duration=params.video_clip_duration,
+            video_quality=params.video_quality,
+            seen_fingerprints=[fingerprint.load(v) for v in video_paths],
+            exclude_paths=set(video_paths),
+        )
+        if not new_videos:
+            logger.warning("material top-up found no more footage")
+            break
+        video_paths = video_paths + new_videos
+    return video_paths
+
+
+def get_video_materials(task_id, params, video_terms, audio_duration, prefetcher=None, duration_target=None, duration_known=None):
     if params.video_source == "local":
         logger.info("\n\n## preprocess local materials")
         materials = video.preprocess_video(
@@ -172,15 +254,41 @@ def get_video_materials(task_id, params, video_terms, audio_duration):
         return [material_info.url for material_info in materials]
     else:
         logger.info(f"\n\n## downloading videos from {params.video_source}")
-        downloaded_videos = material.download_videos(
+        # clips prefetched for the video subject count towards the duration
+        prefetched = prefetcher.result(prefetch.result_timeout) if prefetcher else []
+        covered = prefetcher.covered_duration(prefetched) if prefetched else 0.0
+        if prefetched:
+            logger.info(f"using {len(prefetched)} prefetched clips, {covered:.1f} seconds")
+
+        def _remaining():
+            required = duration_target() if duration_target else audio_duration
+            return required * params.video_count - covered
+
+        downloaded_videos = library.download_videos(
             task_id=task_id,
             search_terms=video_terms,
             source=params.video_source,
             video_aspect=params.video_aspect,
             video_contact_mode=params.video_concat_mode,
-            audio_duration=audio_duration * params.video_count,
+            audio_duration=_remaining(),
             max_clip_duration=params.video_clip_duration,
+            duration_target=_remaining,
+            video_quality=params.video_quality,
+            seen_fingerprints=[fingerprint.load(v) for v in prefetched],
         )
+        downloaded_videos = prefetched + [
+            v for v in downloaded_videos if v not in prefetched
+        ]
+
+        # the first wave was sized from an estimate, top it up as soon as the
+        # audio stage publishes the real duration
+        if duration_known is not None:
+            duration_known.wait()
+            required = duration_target() * params.video_count
+            if required > 0:
+                downloaded_videos = _top_up_materials(
+                    task_id, params, video_terms, downloaded_videos, required
+                )
         
         # Download B-roll if enabled
         if getattr(params, 'enable_broll', False):
@@ -222,6 +330,7 @@ def generate_final_videos(
 
     _progress = 50
     for i in range(params.video_count):
+        cancellation.check()
         index = i + 1
         final_video_path = path.join(utils.task_dir(task_id), f"final-{index}.mp4")
         
@@ -232,6 +341,7 @@ def generate_final_videos(
             chunk_files = []
             
             for c_idx in range(total_chunks):
+                cancellation.check()
                 t_start = c_idx * chunk_duration
                 t_end = min((c_idx + 1) * chunk_duration, audio_duration)
                 chunk_logger_info = f"Chapter {c_idx+1}/{total_chunks} ({t_start}s -> {t_end}s)"
@@ -269,7 +379,8 @@ def generate_final_videos(
                         subtitle_path=c_sub,
                         output_file=c_final,
                         params=params,
-                        skip_bgm=True # Important for seamless audio
+                        skip_bgm=True, # Important for seamless audio
+                        task_id=task_id,
                     )
                     chunk_files.append(c_final)
                 except Exception as e:
@@ -322,6 +433,7 @@ def generate_final_videos(
                 subtitle_path=subtitle_path,
                 output_file=final_video_path,
                 params=params,
+                task_id=task_id,
             )
 
             _progress += 50 / params.video_count / 2
@@ -334,14 +446,38 @@ def generate_final_videos(
 
 
 def start(task_id, params: VideoParams, stop_at: str = "video"):
+    token = cancellation.acquire(task_id)
+    context_token = cancellation.activate(token)
+    prefetcher = None
+    try:
+        # leave the queue before looking for a cancel request, so cancel_task
+        # either sees the task queued or the worker sees the request
+        sm.state.update_task(task_id, queued=False)
+        # the task may have been cancelled while it was queued
+        token.raise_if_cancelled()
+        if type(params.video_concat_mode) is str:
+            params.video_concat_mode = VideoConcatMode(params.video_concat_mode)
+        # search and download footage for the subject while the LLM writes
+        if stop_at not in ("script", "terms"):
+            prefetcher = prefetch.start(task_id, params)
+        return _start(task_id, params, stop_at, prefetcher)
+    except TaskCancelledError:
+        logger.warning(f"task {task_id} cancelled")
+        sm.state.update_task(task_id, state=const.TASK_STATE_CANCELLED)
+        return None
+    finally:
+        if prefetcher:
+            prefetcher.cancel()
+        cancellation.deactivate(context_token)
+        cancellation.release(task_id)
+
+
+def _start(task_id, params: VideoParams, stop_at: str = "video", prefetcher=None):
     logger.info(f"start task: {task_id}, stop_at: {stop_at}")
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=5)
 
-    if type(params.video_concat_mode) is str:
-        params.video_concat_mode = VideoConcatMode(params.video_concat_mode)
-
     # 1. Generate script
-    video_script = generate_script(task_id, params)
+    video_script = run_stage(task_id, "script", generate_script, task_id, params)
     if not video_script or "Error: " in video_script:
         sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
         return
@@ -357,7 +493,9 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
     # 2. Generate terms
     video_terms = ""
     if params.video_source != "local":
-        video_terms = generate_terms(task_id, params, video_script)
+        video_terms = run_stage(
+            task_id, "terms", generate_terms, task_id, params, video_script
+        )
         if not video_terms:
             sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
             return
@@ -379,27 +517,39 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
     
     with ThreadPoolExecutor(max_workers=2) as executor:
         # Submit audio generation task
-        audio_future = executor.submit(generate_audio, task_id, params, video_script)
-        
-        # Submit materials fetching task
-        # Note: get_video_materials needs audio_duration, which we don't have yet.
-        # However, we can fetch materials using a placeholder duration or wait for audio to finish.
-        # Actually, let's wait for audio_duration first to be safe with lengths, OR
-        # just fetch enough materials based on an estimate. 
-        # Most scripts are ~150 words per minute.
-        
-        # To make it truly parallel without duration bottleneck:
-        # We can run them in parallel but materials might need to 'over-download' slightly.
-        # Or better: Audio is usually fast. We can run terms generation and audio in parallel if terms weren't stop_at.
-        
-        # Re-evaluating: Let's run audio and materials in parallel. 
-        # We'll use a safe estimate for duration if audio is not yet done.
-        est_duration = len(video_script.split()) * 0.5 + 30 # Rough estimate
-        
-        materials_future = executor.submit(get_video_materials, task_id, params, video_terms, est_duration)
+        audio_future = executor.submit(
+            contextvars.copy_context().run,
+            run_stage, task_id, "audio", generate_audio, task_id, params, video_script
+        )
         
+        # Materials are fetched for an estimated duration while the audio is
+        # generated, the target is corrected as soon as the real duration is
+        # known and downloads beyond it are cancelled.
+        duration = {"target": estimate_audio_duration(video_script, params)}
+        duration_known = threading.Event()
+
+        materials_future = executor.submit(
+            contextvars.copy_context().run,
+            run_stage,
+            task_id,
+            "materials",
+            get_video_materials,
+            task_id,
+            params,
+            video_terms,
+            duration["target"],
+            prefetcher,
+            lambda: duration["target"],
+            duration_known,
+        )
+
         # Wait for results
-        audio_file, audio_duration, sub_maker = audio_future.result()
+        audio_file = None
+        try:
+            audio_file, audio_duration, sub_maker = audio_future.result()
+        finally:
+            duration["target"] = audio_duration if audio_file else 0.0
+            duration_known.set()
         downloaded_videos = materials_future.result()
 
     if not audio_file:
@@ -418,8 +568,15 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
         return {"audio_file": audio_file, "audio_duration": audio_duration}
 
     # 4. Generate subtitle
-    subtitle_path = generate_subtitle(
-        task_id, params, video_script, sub_maker, audio_file
+    subtitle_path = run_stage(
+        task_id,
+        "subtitle",
+        generate_subtitle,
+        task_id,
+        params,
+        video_script,
+        sub_maker,
+        audio_file,
     )
 
     if stop_at == "subtitle":
@@ -448,10 +605,20 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
 
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=50)
 
-    # 6. Generate final videos
-    final_video_paths, combined_video_paths = generate_final_videos(
-        task_id, params, downloaded_videos, audio_file, subtitle_path, video_script, audio_duration
-    )
+    # 6. Generate final videos, the clips are not transcoded while rendering
+    with mezzanine.using(downloaded_videos):
+        final_video_paths, combined_video_paths = run_stage(
+            task_id,
+            "render",
+            generate_final_videos,
+            task_id,
+            params,
+            downloaded_videos,
+            audio_file,
+            subtitle_path,
+            video_script,
+            audio_duration,
+        )
 
     if not final_video_paths:
         sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
@@ -34,7 +34,8 @@ from app.models.schema import (
 )
 from app.services.utils import video_effects
 from app.utils import utils
-from app.services import semantic_video
+from app.services import cancellation, semantic_video, shots
+from app.services import state as sm
 
 # High-quality video encoding settings
 audio_codec = "aac"
@@ -243,6 +244,24 @@ def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
     return ""
 
 
+def _semantic_start(selection: dict, duration: float, length: float, params: VideoParams, used_starts: dict) -> float:
+    """Start of the sub-clip of a semantic selection, on the shot that best matches its segment"""
+    video_path = selection['video_path']
+    shot_list = shots.ensure(video_path, duration)
+    scores = None
+    if shot_list and params and params.enable_image_similarity and selection.get('segment'):
+        try:
+            from app.services import frame_embeddings
+            scores = frame_embeddings.shot_scores(
+                video_path, shot_list, selection['segment'], params.image_similarity_model
+            )
+        except Exception as e:
+            logger.warning(f"failed to score the shots of {os.path.basename(video_path)}: {str(e)}")
+    used = used_starts.setdefault(video_path, set())
+    start_time = shots.choose_start(shot_list, duration, length, scores, used)
+    used.add(start_time)
+    return start_time
+
 def combine_videos(
     combined_video_path: str,
     video_paths: List[str],
@@ -302,15 +321,18 @@ def combine_videos(
             semantic_model=params.semantic_model if params else "all-mpnet-base-v2",
             enable_image_similarity=params.enable_image_similarity if params else False,
             image_similarity_threshold=params.image_similarity_threshold if params else 0.7,
-            image_similarity_model=params.image_similarity_model if params else "clip-vit-base-patch32"
+            image_similarity_model=params.image_similarity_model if params else "clip-vit-base-patch32",
+            video_aspect=aspect
         )
         
         # Process selected videos
         processed_clips = []
         video_duration = 0
         max_reuse_limit = params.max_video_reuse if params and hasattr(params, 'max_video_reuse') and params.max_video_reuse is not None else None
+        used_starts = {}
         
         for i, selection in enumerate(selected_videos):
+            cancellation.check()
             # Don't break early when max_video_reuse=1 to utilize all selected videos
             if video_duration > audio_duration and not (max_reuse_limit and max_reuse_limit == 1):
                 break
@@ -324,9 +346,8 @@ def combine_videos(
                 clip = VideoFileClip(video_path)
                 clip_duration = min(clip.duration, target_duration)
                 
-                # Random start time for variety
-                max_start = max(0, clip.duration - clip_duration)
-                start_time = random.uniform(0, max_start) if max_start > 0 else 0
+                # Start on a shot boundary, the best matching shot if frames are indexed
+                start_time = _semantic_start(selection, clip.duration, clip_duration, params, used_starts)
                 
                 clip = clip.subclipped(start_time, start_time + clip_duration)
                 
@@ -407,13 +428,9 @@ def combine_videos(
             clip_w, clip_h = clip.size
             close_clip(clip)
             
-            start_time = 0
-
-            while start_time < clip_duration:
-                end_time = min(start_time + max_clip_duration, clip_duration)            
-                if clip_duration - start_time >= max_clip_duration:
-                    subclipped_items.append(SubClippedVideoClip(file_path= video_path, start_time=start_time, end_time=end_time, width=clip_w, height=clip_h))
-                start_time = end_time    
+            # sub-clips start on shot boundaries where the footage allows
+            for start_time, end_time in shots.windows(shots.ensure(video_path, clip_duration), clip_duration, max_clip_duration):
+                subclipped_items.append(SubClippedVideoClip(file_path= video_path, start_time=start_time, end_time=end_time, width=clip_w, height=clip_h))
                 if video_concat_mode.value == VideoConcatMode.sequential.value:
                     break
 
@@ -427,6 +444,7 @@ def combine_videos(
         for i, subclipped_item in enumerate(subclipped_items):
             if video_duration > audio_duration:
                 break
+            cancellation.check()
             
             logger.debug(f"processing clip {i+1}: {subclipped_item.width}x{subclipped_item.height}, current duration: {video_duration:.2f}s, remaining: {audio_duration - video_duration:.2f}s")
             
@@ -1011,10 +1029,11 @@ from proglog import ProgressBarLogger
 
 class DetailedProgressLogger(ProgressBarLogger):
     """Custom MoviePy logger that redirects progress to loguru and calculates estimates"""
-    def __init__(self):
+    def __init__(self, task_id: str = ""):
         super().__init__()
         self.last_update = 0
         self.start_time = 0
+        self.task_id = task_id
         
     def callback(self, **kwargs):
         bar = kwargs.get('bar', '??')
@@ -1023,9 +1042,17 @@ class DetailedProgressLogger(ProgressBarLogger):
         
         # Only log every 5% to avoid flooding the UI
         percent = int((index / total) * 100)
+        if percent != self.last_update:
+            # abort the ffmpeg writer as soon as the task is cancelled
+            cancellation.check()
         if percent % 5 == 0 and percent != self.last_update:
             self.last_update = percent
             logger.info(f"🔨 [Render Progress] {bar}: {percent}% ({index}/{total} frames)")
+            if self.task_id:
+                sm.state.publish_event(
+                    self.task_id,
+                    {"type": "render", "bar": bar, "percent": percent, "index": index, "total": total},
+                )
 
 def generate_video(
     video_path: str,
@@ -1034,6 +1061,7 @@ def generate_video(
     output_file: str,
     params: VideoParams,
     skip_bgm: bool = False,
+    task_id: str = "",
 ):
     fps, bitrate, quality_params, video_codec, audio_bitrate = get_quality_params(params)
     aspect = VideoAspect(params.video_aspect)
@@ -1200,7 +1228,7 @@ def generate_video(
         audio_codec=audio_codec,
         temp_audiofile_path=output_dir,
         threads=params.n_threads or 2,
-        logger=DetailedProgressLogger(),
+        logger=DetailedProgressLogger(task_id),
         fps=fps,
         codec=video_codec,
         bitrate=bitrate,
@@ -1212,8 +1240,6 @@ def generate_video(
 
 def concat_videos_ffmpeg(video_paths: List[str], output_path: str):
     """Concatenate multiple videos using FFmpeg demuxer (copy mode)"""
-    import subprocess
-    
     # Create temp list file
     list_path = output_path.replace(".mp4", "_list.txt")
     with open(list_path, "w", encoding="utf-8") as f:
@@ -1228,14 +1254,12 @@ def concat_videos_ffmpeg(video_paths: List[str], output_path: str):
             "ffmpeg", "-y", "-f", "concat", "-safe", "0",
             "-i", list_path, "-c", "copy", output_path
         ]
-        subprocess.run(cmd, check=True, capture_output=True)
+        cancellation.run_process(cmd)
     finally:
         if os.path.exists(list_path):
             os.remove(list_path)
 def add_bgm_to_video(video_path: str, bgm_path: str, bgm_volume: float, output_path: str):
     """Add BGM to a finished video using FFmpeg (more stable for long videos)"""
-    import subprocess
-    
     # Use ffmpeg complex filter to loop and mix audio
     # volume filter for secondary input (bgm)
     cmd = [
@@ -1243,7 +1267,7 @@ def add_bgm_to_video(video_path: str, bgm_path: str, bgm_volume: float, output_p
         "-filter_complex", f"[1:a]volume={bgm_volume}[music];[0:a][music]amix=inputs=2:duration=first[aout]",
         "-map", "0:v", "-map", "[aout]", "-c:v", "copy", "-c:a", "aac", "-shortest", output_path
     ]
-    subprocess.run(cmd, check=True, capture_output=True)
+    cancellation.run_process(cmd)
 
 
 def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
@@ -29,6 +29,7 @@ from loguru import logger
 from moviepy.video.tools import subtitles
 
 from app.config import config
+from app.services import cancellation
 from app.utils import utils
 
 # Import Chatterbox TTS and WhisperX if available
@@ -1254,6 +1255,7 @@ def azure_tts_v1(
                 sub_maker = ensure_submaker_compatibility(edge_tts.SubMaker())
                 with open(voice_file, "wb") as file:
                     async for chunk in communicate.stream():
+                        cancellation.check()
                         if chunk["type"] == "audio":
                             file.write(chunk["data"])
                         elif chunk["type"] == "WordBoundary":
@@ -1888,6 +1890,7 @@ def chatterbox_tts_chunked(
     
     try:
         for i, chunk in enumerate(chunks):
+            cancellation.check()
             logger.info(f"Processing chunk {i+1}/{len(chunks)} ({len(chunk)} chars)")
             
             # Create temporary file for this chunk
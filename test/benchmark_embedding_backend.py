@@ -0,0 +1,53 @@
+"""
+Benchmark of the sentence-transformer backends: load time, throughput and
+cosine parity with the torch backend on this machine.
+
+    python -m test.benchmark_embedding_backend [model_name]
+"""
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from app.services.embedding_backend import BACKENDS, load
+
+
+def main(model_name: str = "all-mpnet-base-v2", count: int = 256, batch_size: int = 32):
+    """Load time, throughput and cosine parity with torch of every backend."""
+    texts = [
+        f"{subject} {action} {place}"
+        for subject in ("a busy city street", "ocean waves", "a quiet forest", "people working in an office")
+        for action in ("at sunrise", "during a storm", "filmed from above", "in slow motion")
+        for place in ("in winter", "in summer", "at night", "with neon lights")
+    ]
+    texts = (texts * (count // len(texts) + 1))[:count]
+    reference = None
+    for name in BACKENDS:
+        started = time.time()
+        model, used = load(model_name, name)
+        load_seconds = time.time() - started
+        if used != name:
+            print(f"{name:10s} unavailable")
+            continue
+        model.encode(texts[:batch_size], batch_size=batch_size, normalize_embeddings=True)
+        started = time.time()
+        embeddings = np.asarray(
+            model.encode(texts, batch_size=batch_size, normalize_embeddings=True, show_progress_bar=False)
+        )
+        seconds = time.time() - started
+        if reference is None:
+            reference = embeddings
+        parity = float(np.min(np.sum(reference * embeddings, axis=1)))
+        print(
+            f"{name:10s} load {load_seconds:6.2f}s  {len(texts) / seconds:8.1f} texts/s  "
+            f"min cosine to torch {parity:.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
@@ -0,0 +1,65 @@
+"""
+Benchmark of the task record round trip: legacy str()/literal_eval vs the
+versioned encoding, plus MemoryState update/get throughput.
+
+    python -m test.benchmark_state
+"""
+
+import sys
+import time
+from pathlib import Path
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from app.models import const
+from app.services.state import (
+    ORJSON_AVAILABLE,
+    MemoryState,
+    _legacy_decode_value,
+    decode_task,
+    encode_task,
+    validate_task,
+)
+
+
+def main():
+    record = {
+        "task_id": "00000000-0000-0000-0000-000000000000",
+        "state": const.TASK_STATE_COMPLETE,
+        "progress": 100,
+        "script": "Money is a medium of exchange. " * 40,
+        "terms": ["money importance", "wealth and society", "financial freedom"],
+        "materials": [f"/storage/cache_videos/vid-{i:032x}.mp4" for i in range(80)],
+        "videos": ["/storage/tasks/00000000/final-1.mp4"],
+        "audio_duration": 182,
+    }
+    rounds = 2000
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        raw = {k.encode("utf-8"): str(v).encode("utf-8") for k, v in record.items()}
+        {k.decode("utf-8"): _legacy_decode_value(v) for k, v in raw.items()}
+    legacy_elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        raw = {k.encode("utf-8"): v for k, v in encode_task(record).items()}
+        validate_task(decode_task(raw))
+    codec_elapsed = time.perf_counter() - started
+
+    memory_state = MemoryState()
+    started = time.perf_counter()
+    for i in range(rounds):
+        memory_state.update_task(record["task_id"], progress=i % 100)
+        memory_state.get_task(record["task_id"])
+    memory_elapsed = time.perf_counter() - started
+
+    print(f"encoder: {'orjson' if ORJSON_AVAILABLE else 'json'}, rounds: {rounds}")
+    print(f"legacy literal_eval round trip: {rounds / legacy_elapsed:,.0f} records/s")
+    print(f"versioned codec round trip:     {rounds / codec_elapsed:,.0f} records/s")
+    print(f"MemoryState update+get:         {rounds / memory_elapsed:,.0f} ops/s")
+
+
+if __name__ == "__main__":
+    main()
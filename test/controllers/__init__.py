@@ -0,0 +1 @@
+# Unit test package for controllers
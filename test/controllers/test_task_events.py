@@ -0,0 +1,213 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.controllers.v1 import video
+from app.models import const
+from app.models.exception import HttpException
+from app.services import state as sm
+
+TASK_ID = "00000000-0000-0000-0000-000000000000"
+
+
+class _FakeSubscription(sm.EventSubscription):
+    def __init__(self, events):
+        self.events = list(events)
+        self.closed = False
+
+    async def get(self, timeout: float = None):
+        if self.events:
+            # None in the script stands for a heartbeat
+            return self.events.pop(0)
+        await asyncio.sleep(0.01)
+        return None
+
+    async def close(self):
+        self.closed = True
+
+
+class _FakeState:
+    """Task store with a scripted event stream instead of the broadcaster."""
+
+    def __init__(self, task: dict, events: list):
+        self.task = task
+        self.events = events
+        self.subscriptions = []
+
+    def get_task(self, task_id: str):
+        return dict(self.task) if task_id == self.task["task_id"] else None
+
+    async def subscribe(self, task_id: str):
+        subscription = _FakeSubscription(self.events)
+        self.subscriptions.append(subscription)
+        return subscription
+
+
+def _state(state: int, progress: int) -> dict:
+    return {"type": "state", "task_id": TASK_ID, "state": state, "progress": progress}
+
+
+def _sse_events(body: str) -> list:
+    events = []
+    for block in body.strip().split("\n\n"):
+        if block.startswith(":"):
+            events.append(None)
+            continue
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+class TestTaskEvents(unittest.TestCase):
+    def setUp(self):
+        app = FastAPI()
+        app.include_router(video.router)
+        app.add_exception_handler(
+            HttpException, lambda request, e: JSONResponse(status_code=e.status_code, content={})
+        )
+        self.client = TestClient(app)
+        self.processing = {"task_id": TASK_ID, "state": const.TASK_STATE_PROCESSING, "progress": 10}
+
+    def _patch_state(self, task: dict, events: list) -> _FakeState:
+        fake = _FakeState(task, events)
+        patch = mock.patch.object(sm, "state", fake)
+        patch.start()
+        self.addCleanup(patch.stop)
+        return fake
+
+    def test_sse_streams_events_until_terminal_state(self):
+        fake = self._patch_state(self.processing, [
+            {"type": "stage", "stage": "audio"},
+            None,
+            _state(const.TASK_STATE_PROCESSING, 60),
+            _state(const.TASK_STATE_COMPLETE, 100),
+            # never delivered, the stream ends with the terminal state
+            {"type": "stage", "stage": "late"},
+        ])
+        response = self.client.get(f"/api/v1/tasks/{TASK_ID}/events")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+
+        events = _sse_events(response.text)
+        self.assertEqual(events[0], ("state", {"type": "state", **self.processing}))
+        self.assertEqual(events[1], ("stage", {"type": "stage", "stage": "audio"}))
+        # heartbeat
+        self.assertIsNone(events[2])
+        self.assertEqual([e[1]["progress"] for e in events[3:]], [60, 100])
+        self.assertTrue(fake.subscriptions[0].closed)
+
+    def test_sse_finished_task_sends_its_state_only(self):
+        task = {"task_id": TASK_ID, "state": const.TASK_STATE_COMPLETE, "progress": 100}
+        self._patch_state(task, [{"type": "stage", "stage": "audio"}])
+        events = _sse_events(self.client.get(f"/api/v1/tasks/{TASK_ID}/events").text)
+        self.assertEqual(events, [("state", {"type": "state", **task})])
+
+    def test_sse_unknown_task(self):
+        self._patch_state(self.processing, [])
+        response = self.client.get("/api/v1/tasks/unknown/events")
+        self.assertEqual(response.status_code, 404)
+
+    def test_websocket_streams_events_and_heartbeats(self):
+        fake = self._patch_state(self.processing, [
+            None,
+            _state(const.TASK_STATE_PROCESSING, 60),
+            _state(const.TASK_STATE_FAILED, 60),
+        ])
+        with self.client.websocket_connect(f"/api/v1/tasks/{TASK_ID}/ws") as ws:
+            self.assertEqual(ws.receive_json()["progress"], 10)
+            self.assertEqual(ws.receive_json(), {"type": "heartbeat"})
+            self.assertEqual(ws.receive_json()["progress"], 60)
+            self.assertEqual(ws.receive_json()["state"], const.TASK_STATE_FAILED)
+            # the server closes the socket after the terminal state
+            with self.assertRaises(WebSocketDisconnect):
+                ws.receive_json()
+        self.assertTrue(fake.subscriptions[0].closed)
+
+    def test_websocket_disconnect_unsubscribes(self):
+        # a task that never finishes, the stream only sends heartbeats
+        fake = self._patch_state(self.processing, [])
+        with self.client.websocket_connect(f"/api/v1/tasks/{TASK_ID}/ws") as ws:
+            ws.receive_json()
+            ws.receive_json()
+        deadline = time.monotonic() + 5
+        while not fake.subscriptions[0].closed and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(fake.subscriptions[0].closed)
+
+
+class TestEventBroadcaster(unittest.TestCase):
+    def test_worker_events_reach_the_subscriber_in_order(self):
+        state = sm.MemoryState()
+        state.update_task(TASK_ID, progress=5)
+
+        async def consume():
+            with mock.patch.object(sm, "state", state):
+                events = video.task_events(TASK_ID, heartbeat=5)
+                snapshot = await events.__anext__()
+                self.assertIn(TASK_ID, state._events._subscribers)
+
+                def worker():
+                    state.publish_event(TASK_ID, {"type": "stage", "stage": "video"})
+                    for progress in (40, 80):
+                        state.update_task(TASK_ID, progress=progress)
+
+                threading.Thread(target=worker).start()
+                received = [await events.__anext__() for _ in range(3)]
+                # the client goes away while the task is still running
+                await events.aclose()
+                return snapshot, received
+
+        snapshot, received = asyncio.run(consume())
+        self.assertEqual(snapshot["progress"], 5)
+        self.assertEqual(received[0], {"type": "stage", "stage": "video"})
+        self.assertEqual([e["progress"] for e in received[1:]], [40, 80])
+        self.assertNotIn(TASK_ID, state._events._subscribers)
+
+    def test_redis_update_publishes_state_event(self):
+        state = sm.RedisState()
+        state._redis = mock.MagicMock()
+        pipe = state._redis.pipeline.return_value
+        state.update_task(TASK_ID, state=const.TASK_STATE_COMPLETE, progress=100, videos=["a.mp4"])
+
+        channel, payload = pipe.publish.call_args.args
+        self.assertEqual(channel, f"task_events:{TASK_ID}")
+        event = sm.decode_value(payload)
+        self.assertEqual(event["type"], "state")
+        self.assertEqual((event["state"], event["progress"], event["videos"]), (const.TASK_STATE_COMPLETE, 100, ["a.mp4"]))
+        pipe.execute.assert_called_once()
+
+    def test_redis_subscription_decodes_messages(self):
+        pubsub = mock.MagicMock()
+        pubsub.get_message = mock.AsyncMock(side_effect=[
+            {"type": "message", "data": sm.encode_value({"type": "stage", "stage": "audio"})},
+            None,
+        ])
+        pubsub.unsubscribe = mock.AsyncMock()
+        pubsub.aclose = mock.AsyncMock()
+        subscription = sm._RedisSubscription(pubsub)
+
+        async def consume():
+            events = [await subscription.get(timeout=1), await subscription.get(timeout=1)]
+            await subscription.close()
+            return events
+
+        self.assertEqual(asyncio.run(consume()), [{"type": "stage", "stage": "audio"}, None])
+        pubsub.unsubscribe.assert_awaited_once()
+        pubsub.aclose.assert_awaited_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
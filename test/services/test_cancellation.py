@@ -0,0 +1,96 @@
+import unittest
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import mock
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.controllers.v1 import video
+from app.models import const
+from app.models.exception import HttpException, TaskCancelledError
+from app.models.schema import VideoParams
+from app.services import cancellation
+from app.services import state as sm
+from app.services import task as tm
+
+
+class TestCancellationService(unittest.TestCase):
+    def setUp(self):
+        self.task_id = "00000000-0000-0000-0000-000000000000"
+        sm.state.update_task(self.task_id, progress=5)
+        self.token = cancellation.acquire(self.task_id)
+        self.context_token = cancellation.activate(self.token)
+
+    def tearDown(self):
+        cancellation.deactivate(self.context_token)
+        cancellation.release(self.task_id)
+        sm.state.delete_task(self.task_id)
+
+    def test_check_raises_after_cancel(self):
+        cancellation.check()
+        cancellation.cancel(self.task_id)
+        with self.assertRaises(TaskCancelledError):
+            cancellation.check()
+        self.assertTrue(sm.state.is_cancel_requested(self.task_id))
+
+    def test_cancel_request_from_state_store(self):
+        # a cancel issued by another process only reaches the state store
+        sm.state.request_cancel(self.task_id)
+        self.assertTrue(self.token.cancelled)
+
+    def test_run_process_is_terminated(self):
+        threading.Timer(0.3, cancellation.cancel, args=(self.task_id,)).start()
+        started = time.monotonic()
+        with self.assertRaises(TaskCancelledError):
+            cancellation.run_process([sys.executable, "-c", "import time; time.sleep(30)"])
+        self.assertLess(time.monotonic() - started, 10)
+
+    def test_run_process_returns_output(self):
+        result = cancellation.run_process([sys.executable, "-c", "print('ok')"])
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout.strip(), b"ok")
+
+    def test_queued_task_never_runs(self):
+        task_id = "00000000-0000-0000-0000-000000000001"
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch.object(sm, "state", sm.MemoryState(
+                    max_finished_tasks=0, spill_file=os.path.join(temp_dir, "tasks.jsonl")
+                )), \
+                mock.patch.object(tm, "_start") as start:
+            sm.state.update_task(task_id, queued=True)
+            task = video.cancel_task(task_id)
+            self.assertEqual(task["state"], const.TASK_STATE_CANCELLED)
+            # the finished task is spilled to disk before the worker dequeues it
+            self.assertNotIn(task_id, sm.state._tasks)
+            self.assertTrue(sm.state.is_cancel_requested(task_id))
+
+            tm.start(task_id, VideoParams(video_subject="money"))
+            start.assert_not_called()
+            self.assertEqual(sm.state.get_task(task_id)["state"], const.TASK_STATE_CANCELLED)
+
+    def test_started_task_without_progress_is_not_queued(self):
+        # the worker dequeued the task but has not reported progress yet
+        sm.state.update_task(self.task_id, queued=False, progress=0)
+        task = video.cancel_task(self.task_id)
+        # the worker reports the cancellation itself once it stops
+        self.assertEqual(task["state"], const.TASK_STATE_PROCESSING)
+        self.assertTrue(self.token.cancelled)
+
+    def test_delete_running_task_returns_without_waiting(self):
+        sm.state.update_task(self.task_id, queued=False, progress=10)
+        request = mock.Mock(headers={})
+        started = time.monotonic()
+        with self.assertRaises(HttpException) as raised:
+            video.delete_video(request, self.task_id)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(raised.exception.status_code, 409)
+        self.assertTrue(self.token.cancelled)
+
+
+if __name__ == "__main__":
+    unittest.main()
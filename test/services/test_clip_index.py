@@ -0,0 +1,128 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.models.schema import VideoAspect
+from app.services import clip_index, embedding_store, semantic_video
+
+DIM = 16
+
+
+def _encode(texts):
+    # a fixed random unit vector per term
+    vectors = np.stack([np.random.default_rng(int(t.split()[-1])).normal(size=DIM) for t in texts])
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+class TestClipIndexService(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.video_dir = os.path.join(self.temp_dir.name, "videos")
+        os.makedirs(self.video_dir)
+        self.patches = [
+            mock.patch.object(clip_index, "index_dir", return_value=self.temp_dir.name),
+            mock.patch.object(clip_index, "backend", "ivf"),
+            mock.patch.object(clip_index, "_index", None),
+            mock.patch.object(clip_index, "_index_key", None),
+            mock.patch.object(semantic_video, "encode_texts", side_effect=_encode),
+            mock.patch.object(semantic_video, "model_key", return_value="test-model"),
+            mock.patch.object(embedding_store, "enabled", False),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.temp_dir.cleanup()
+
+    def _add_clips(self, count):
+        items = []
+        for i in range(count):
+            path = os.path.join(self.video_dir, f"vid-{i}.mp4")
+            open(path, "wb").close()
+            items.append((path, f"term {i}"))
+        clip_index.add_many(items)
+        return items
+
+    def test_ivf_search_finds_nearest_clips(self):
+        items = self._add_clips(600)
+        with mock.patch.object(clip_index, "IVF_MIN_VECTORS", 256):
+            queries = _encode([f"term {i}" for i in (3, 250, 599)])
+            results = clip_index.search(queries, k=5)
+        self.assertIsNotNone(clip_index._index.centroids)
+        for i, row in zip((3, 250, 599), results):
+            self.assertEqual(row[0][0], items[i][0])
+            self.assertAlmostEqual(row[0][1], 1.0, places=2)
+
+    def test_index_is_persisted_and_drops_removed_clips(self):
+        items = self._add_clips(20)
+        clip_index.sync()
+        self.assertEqual(len(clip_index._index), 20)
+
+        os.remove(items[7][0])
+        with mock.patch.object(clip_index, "_index", None):
+            # loaded from disk, only the clips added since are encoded
+            new_path = os.path.join(self.video_dir, "vid-20.mp4")
+            open(new_path, "wb").close()
+            clip_index.add(new_path, "term 20")
+            semantic_video.encode_texts.reset_mock()
+            results = clip_index.search(_encode(["term 7"]), k=3)
+            self.assertEqual(semantic_video.encode_texts.call_args.args[0], ["term 20"])
+            self.assertNotIn(items[7][0], [path for path, _ in results[0]])
+            clip_index.sync()
+            self.assertEqual(len(clip_index._index), 20)
+
+    def test_sync_only_reads_new_rows(self):
+        self._add_clips(20)
+        clip_index.sync()
+        statements = []
+        clip_index._connection().set_trace_callback(statements.append)
+        try:
+            clip_index.sync()
+        finally:
+            clip_index._connection().set_trace_callback(None)
+        selects = [sql for sql in statements if sql.startswith("SELECT")]
+        self.assertTrue(selects)
+        # the entries after the cursor, not the whole table
+        self.assertTrue(all("WHERE seq > 0" in sql or "WHERE id > 20" in sql for sql in selects), selects)
+        self.assertEqual(clip_index._cursor, (20, 0))
+
+    def test_selection_adds_cached_clips(self):
+        items = self._add_clips(40)
+        rng = np.random.default_rng(0)
+        fingerprints = [[f"{int(h):016x}" for h in rng.integers(0, 2**63, 3)] for _ in items]
+        for i, (path, term) in enumerate(items):
+            info = {"rendition": {"width": 1080, "height": 1920}, "fingerprint": fingerprints[i]}
+            if i == 9:
+                # landscape footage, it would be letterboxed in a portrait video
+                info["rendition"] = {"width": 1920, "height": 1080}
+            if i == 11:
+                # the same footage as a pool clip
+                info["fingerprint"] = fingerprints[0]
+            semantic_video.save_video_metadata(path, term, info)
+        pool = [semantic_video.load_video_metadata(path) for path, _ in items[:2]]
+
+        with mock.patch.object(clip_index, "top_k", 3):
+            candidates = semantic_video._index_candidates(
+                ["term 5", "term 9", "term 11"], pool, 4, VideoAspect.portrait
+            )
+        paths = [v["video_path"] for v in candidates]
+        self.assertEqual(paths[:2], [path for path, _ in items[:2]])
+        self.assertIn(items[5][0], paths)
+        self.assertNotIn(items[9][0], paths)
+        self.assertNotIn(items[11][0], paths)
+        # at most k = max(top_k, 2 * 4 needed clips / 3 segments) clips per segment
+        self.assertLessEqual(len(candidates), 2 + 3 * 4)
+        self.assertEqual(len(paths), len(set(paths)))
+
+if __name__ == "__main__":
+    unittest.main()
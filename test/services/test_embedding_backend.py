@@ -0,0 +1,88 @@
+import importlib.util
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services import embedding_backend, embedding_store, model_server, semantic_video
+
+OPTIMUM_AVAILABLE = importlib.util.find_spec("optimum") is not None
+
+SENTENCES = [
+    "Waves crash against the rocks at sunset",
+    "Commuters hurry through a busy train station",
+    "A chef chops vegetables in a restaurant kitchen",
+    "Snow falls quietly over a mountain village",
+]
+
+
+class TestEmbeddingBackendService(unittest.TestCase):
+    def test_falls_back_to_torch(self):
+        with mock.patch.object(embedding_backend, "_load_onnx", side_effect=ImportError("optimum")), \
+                mock.patch.object(embedding_backend, "SentenceTransformer") as model_class:
+            model, used = embedding_backend.load("all-mpnet-base-v2", "onnx-int8")
+        self.assertEqual(used, "torch")
+        model_class.assert_called_once_with("all-mpnet-base-v2", device="cpu")
+
+    def test_embeddings_are_keyed_by_the_backend_used(self):
+        model = mock.Mock()
+        model.encode.side_effect = lambda texts, **kwargs: np.ones((len(texts), 2), dtype=np.float32)
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch.object(embedding_store, "enabled", True), \
+                mock.patch.object(embedding_store, "db_path", return_value=f"{temp_dir}/embeddings.db"), \
+                mock.patch.object(model_server, "enabled", False), \
+                mock.patch.object(embedding_backend, "backend", "onnx-int8"), \
+                mock.patch.object(embedding_backend, "load", return_value=(model, "torch")), \
+                mock.patch.object(semantic_video, "_model", None), \
+                mock.patch.object(semantic_video, "_model_name", "all-mpnet-base-v2"):
+            semantic_video.encode_texts(["ocean"])
+            # the int8 model failed to load, the torch embeddings are not stored as int8 ones
+            self.assertEqual(semantic_video.model_key(), "all-mpnet-base-v2")
+            self.assertIn("ocean", embedding_store.get_many("all-mpnet-base-v2", ["ocean"]))
+            self.assertEqual(embedding_store.get_many("all-mpnet-base-v2@onnx-int8", ["ocean"]), {})
+
+    def test_backend_change_is_retried_once(self):
+        def embed_texts(texts, model_name):
+            return np.ones((len(texts), 2), dtype=np.float32), "torch"
+
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch.object(embedding_store, "enabled", True), \
+                mock.patch.object(embedding_store, "db_path", return_value=f"{temp_dir}/embeddings.db"), \
+                mock.patch.object(model_server, "available", return_value=True), \
+                mock.patch.object(model_server, "text_backend", return_value="onnx"), \
+                mock.patch.object(model_server, "embed_texts", side_effect=embed_texts) as embed, \
+                mock.patch.object(semantic_video, "_model", None), \
+                mock.patch.object(semantic_video, "_model_name", "all-mpnet-base-v2"):
+            # the server keeps reporting onnx but encodes with torch
+            self.assertEqual(semantic_video.encode_texts(["ocean"]).shape, (1, 2))
+            self.assertEqual(embed.call_count, 2)
+            self.assertIn("ocean", embedding_store.get_many("all-mpnet-base-v2", ["ocean"]))
+            self.assertEqual(embedding_store.get_many("all-mpnet-base-v2@onnx", ["ocean"]), {})
+
+    def test_quantized_file_name(self):
+        with mock.patch.object(embedding_backend, "quantization", "avx512_vnni"):
+            self.assertEqual(embedding_backend.onnx_file_name(True), "onnx/model_qint8_avx512_vnni.onnx")
+        self.assertEqual(embedding_backend.onnx_file_name(False), "onnx/model.onnx")
+
+    @unittest.skipUnless(OPTIMUM_AVAILABLE, "optimum[onnxruntime] is not installed")
+    def test_onnx_int8_parity(self):
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch.object(embedding_backend, "models_dir", return_value=temp_dir):
+            reference, _ = embedding_backend.load("all-mpnet-base-v2", "torch")
+            quantized, used = embedding_backend.load("all-mpnet-base-v2", "onnx-int8")
+            self.assertEqual(used, "onnx-int8")
+            a = reference.encode(SENTENCES, normalize_embeddings=True)
+            b = quantized.encode(SENTENCES, normalize_embeddings=True)
+        # every sentence keeps its direction and the pairwise ranking is unchanged
+        self.assertGreater(float(np.min(np.sum(a * b, axis=1))), 0.97)
+        np.testing.assert_array_equal(np.argsort(a @ a.T, axis=1), np.argsort(b @ b.T, axis=1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.models.exception import TaskCancelledError
+from app.services import cancellation, embedding_store, frame_embeddings, image_similarity, material, semantic_video
+
+
+def _sample_frame(video_path, timestamp):
+    # red in the first half of the clip, blue in the second
+    return Image.new("RGB", (8, 8), (255, 0, 0) if timestamp < 2 else (0, 0, 255))
+
+
+def _encode_images(images, model_name):
+    vectors = np.array([np.asarray(image, dtype=np.float32)[0, 0] / 255 for image in images])
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _encode_texts(texts, model_name):
+    colors = {"red": (1.0, 0.0, 0.0), "green": (0.0, 1.0, 0.0), "blue": (0.0, 0.0, 1.0)}
+    return np.array([colors[text.split()[0]] for text in texts], dtype=np.float32)
+
+
+class TestFrameEmbeddingsService(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.video_path = os.path.join(self.temp_dir.name, "vid-1.mp4")
+        with open(self.video_path, "wb") as f:
+            f.write(b"\0" * 64)
+        semantic_video.save_video_metadata(
+            self.video_path, "city", {"thumbnail_url": "https://img/green"}
+        )
+        self.patches = [
+            mock.patch.object(frame_embeddings, "sample_frame", side_effect=_sample_frame),
+            mock.patch.object(frame_embeddings, "samples", 4),
+            mock.patch.object(material, "probe_video", return_value=4.0),
+            mock.patch.object(image_similarity, "encode_clip_images", side_effect=_encode_images),
+            mock.patch.object(image_similarity, "encode_clip_texts", side_effect=_encode_texts),
+            mock.patch.object(image_similarity, "fetch_image"),
+            mock.patch.object(image_similarity, "_image_embedding_cache", image_similarity.EmbeddingLRU(1 << 20)),
+            mock.patch.object(image_similarity, "_text_embedding_cache", image_similarity.EmbeddingLRU(1 << 20)),
+            mock.patch.object(image_similarity, "_persistent_image_cache", False),
+            mock.patch.object(image_similarity, "IMAGE_SIMILARITY_AVAILABLE", True),
+            mock.patch.object(embedding_store, "enabled", True),
+            mock.patch.object(
+                embedding_store, "db_path", return_value=os.path.join(self.temp_dir.name, "embeddings.db")
+            ),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.temp_dir.cleanup()
+
+    def test_index_once_per_clip(self):
+        metadata = semantic_video.load_video_metadata(self.video_path)
+        embeddings = frame_embeddings.index([metadata])
+        self.assertEqual(embeddings[self.video_path].shape, (4, 3))
+        self.assertEqual(frame_embeddings.sample_frame.call_count, 4)
+        # the sampled timestamps are kept in the metadata sidecar
+        self.assertEqual(
+            semantic_video.load_video_metadata(self.video_path)["frame_times"], [0.5, 1.5, 2.5, 3.5]
+        )
+
+        # later tasks load the stored vectors without decoding
+        metadata = semantic_video.load_video_metadata(self.video_path)
+        again = frame_embeddings.index([metadata])
+        np.testing.assert_allclose(again[self.video_path], embeddings[self.video_path], atol=1e-3)
+        self.assertEqual(frame_embeddings.sample_frame.call_count, 4)
+
+    def test_similarity_matrix_uses_frames(self):
+        metadata = semantic_video.load_video_metadata(self.video_path)
+        scores = image_similarity.similarity_matrix(["red car", "green field"], [metadata])
+        # the best frame matches, the thumbnail is never downloaded
+        np.testing.assert_allclose(scores, [[1.0], [0.5]], atol=1e-3)
+        image_similarity.fetch_image.assert_not_called()
+        self.assertAlmostEqual(
+            image_similarity.calculate_video_image_similarity("blue sky", metadata), 1.0, places=3
+        )
+
+    def test_shot_scores(self):
+        metadata = semantic_video.load_video_metadata(self.video_path)
+        metadata["shots"] = [[0.0, 2.0], [2.0, 4.0]]
+        semantic_video.save_video_metadata(self.video_path, "city", metadata)
+        scores = frame_embeddings.shot_scores(self.video_path, metadata["shots"], "blue sky")
+        # one frame in the middle of each shot
+        self.assertEqual(semantic_video.load_video_metadata(self.video_path)["frame_times"], [1.0, 3.0])
+        np.testing.assert_allclose(scores, [0.0, 1.0], atol=1e-3)
+
+    def test_sampling_runs_in_the_task_context(self):
+        token = cancellation.CancellationToken("task-1")
+        token.cancel()
+        context_token = cancellation.activate(token)
+        try:
+            metadata = semantic_video.load_video_metadata(self.video_path)
+            with mock.patch.object(frame_embeddings, "sample_frame", side_effect=lambda *args: cancellation.check()):
+                with self.assertRaises(TaskCancelledError):
+                    frame_embeddings.index([metadata])
+        finally:
+            cancellation.deactivate(context_token)
+
+    def test_frame_vectors_have_their_own_budget(self):
+        metadata = semantic_video.load_video_metadata(self.video_path)
+        frame_embeddings.index([metadata])
+        embedding_store.put_many("all-mpnet-base-v2", ["ocean", "forest"], np.ones((2, 3)))
+        with mock.patch.object(embedding_store, "max_entries", 2), \
+                mock.patch.dict(embedding_store._budgets, {frame_embeddings.MODEL_KEY_PREFIX: 3}):
+            # one of the four frames is evicted, the sentence embeddings are not
+            self.assertEqual(embedding_store.prune(), 1)
+        self.assertEqual(len(embedding_store.get_many("all-mpnet-base-v2", ["ocean", "forest"])), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services import embedding_store, image_similarity
+
+COLORS = {"red": (1.0, 0.0, 0.0), "green": (0.0, 1.0, 0.0), "blue": (0.0, 0.0, 1.0)}
+
+
+def _fetch(url):
+    if "broken" in url:
+        return None
+    return Image.new("RGB", (8, 8), tuple(int(255 * c) for c in COLORS[url.rsplit("/", 1)[-1]]))
+
+
+def _encode_images(images, model_name):
+    vectors = np.array([np.asarray(image, dtype=np.float32)[0, 0] / 255 for image in images])
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _encode_texts(texts, model_name):
+    return np.array([COLORS[text.split()[0]] for text in texts], dtype=np.float32)
+
+
+class TestImageSimilarityService(unittest.TestCase):
+    def setUp(self):
+        self.patches = [
+            mock.patch.object(image_similarity, "fetch_image", side_effect=_fetch),
+            mock.patch.object(image_similarity, "encode_clip_images", side_effect=_encode_images),
+            mock.patch.object(image_similarity, "encode_clip_texts", side_effect=_encode_texts),
+            mock.patch.object(image_similarity, "_image_embedding_cache", image_similarity.EmbeddingLRU(1 << 20)),
+            mock.patch.object(image_similarity, "_text_embedding_cache", image_similarity.EmbeddingLRU(1 << 20)),
+            mock.patch.object(image_similarity, "_persistent_image_cache", False),
+            mock.patch.object(image_similarity, "IMAGE_SIMILARITY_AVAILABLE", True),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def test_similarity_matrix(self):
+        videos = [
+            {"video_path": "a.mp4", "thumbnail_url": "https://img/red"},
+            {"video_path": "b.mp4", "thumbnail_url": "https://img/blue", "preview_images": ["https://img/green"]},
+            {"video_path": "c.mp4", "thumbnail_url": "https://img/broken"},
+            {"video_path": "d.mp4"},
+            {"video_path": "e.mp4", "thumbnail_url": "https://img/red"},
+        ]
+        scores = image_similarity.similarity_matrix(["red sunset", "blue ocean"], videos)
+        np.testing.assert_allclose(
+            scores, [[1.0, 0.5, 0.0, 0.0, 1.0], [0.5, 1.0, 0.0, 0.0, 0.5]], atol=1e-6
+        )
+        # every unique image is fetched and encoded once, in one batch
+        self.assertEqual(image_similarity.fetch_image.call_count, 3)
+        self.assertEqual(image_similarity.encode_clip_images.call_count, 1)
+        self.assertEqual(image_similarity.encode_clip_texts.call_count, 1)
+
+        # the second matrix is served from the embedding caches
+        image_similarity.similarity_matrix(["red sunset"], videos[:2])
+        self.assertEqual(image_similarity.fetch_image.call_count, 3)
+        self.assertEqual(image_similarity.encode_clip_texts.call_count, 1)
+
+    def test_lru_is_bounded_in_bytes(self):
+        vector = np.ones(128, dtype=np.float32)
+        entry = vector.nbytes + len("a") + image_similarity.EmbeddingLRU.ENTRY_OVERHEAD
+        cache = image_similarity.EmbeddingLRU(3 * entry)
+        for key in "abc":
+            cache.put(key, vector)
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("d", vector)
+        # "b" was the least recently used entry
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(len(cache), 3)
+        stats = cache.stats()
+        self.assertLessEqual(stats["bytes"], stats["max_bytes"])
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (1, 1, 1))
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+    def test_persistent_image_tier(self):
+        videos = [{"video_path": "a.mp4", "thumbnail_url": "https://img/red"}]
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch.object(image_similarity, "_persistent_image_cache", True), \
+                mock.patch.object(image_similarity, "_persistent_stats", {"hits": 0, "misses": 0}), \
+                mock.patch.object(embedding_store, "enabled", True), \
+                mock.patch.object(embedding_store, "db_path", return_value=f"{temp_dir}/embeddings.db"):
+            image_similarity.similarity_matrix(["red sunset"], videos)
+            # a new process starts with empty memory caches
+            image_similarity.clear_all_caches()
+            scores = image_similarity.similarity_matrix(["red sunset"], videos)
+            np.testing.assert_allclose(scores, [[1.0]], atol=1e-3)
+            self.assertEqual(image_similarity.fetch_image.call_count, 1)
+            persistent = image_similarity.get_cache_stats()["persistent_image_cache"]
+            self.assertEqual((persistent["hits"], persistent["misses"]), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.models import const
+from app.services import janitor
+from app.services import state as sm
+
+
+def _touch(path, hours_ago=0.0, size=1):
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    mtime = time.time() - hours_ago * 3600
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+class TestJanitorService(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.tasks_dir = os.path.join(self.temp.name, "tasks")
+        self.storage_dir = os.path.join(self.temp.name, "storage")
+        self.cache_dir = os.path.join(self.storage_dir, "cache_videos")
+        os.makedirs(self.tasks_dir)
+        os.makedirs(self.cache_dir)
+        self.state = sm.MemoryState()
+
+        def storage_dir(sub_dir=""):
+            return os.path.join(self.storage_dir, sub_dir)
+
+        patches = [
+            mock.patch.object(janitor.utils, "task_dir", return_value=self.tasks_dir),
+            mock.patch.object(janitor.utils, "storage_dir", side_effect=storage_dir),
+            mock.patch.object(sm, "state", self.state),
+            mock.patch.dict(
+                janitor.retention,
+                {"finals": 168, "intermediates": 1, "metadata": 168, "cache": 720},
+            ),
+            mock.patch.object(janitor, "cache_quota_bytes", 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.temp.cleanup)
+
+    def _task_file(self, task_id, filename, hours_ago):
+        task_path = os.path.join(self.tasks_dir, task_id)
+        os.makedirs(task_path, exist_ok=True)
+        return _touch(os.path.join(task_path, filename), hours_ago)
+
+    def test_classify(self):
+        self.assertEqual(janitor.classify("final-1.mp4"), "finals")
+        self.assertEqual(janitor.classify("combined-2.mp4"), "finals")
+        self.assertEqual(janitor.classify("temp-clip-0.mp4"), "intermediates")
+        self.assertEqual(janitor.classify("final-1.mp4.part"), "intermediates")
+        self.assertEqual(janitor.classify("script.json"), "metadata")
+        self.assertEqual(janitor.classify("audio.mp3"), "metadata")
+
+    def test_retention_classes(self):
+        self.state.update_task("task-1", state=const.TASK_STATE_COMPLETE)
+        temp_clip = self._task_file("task-1", "temp-clip-0.mp4", hours_ago=2)
+        fresh_final = self._task_file("task-1", "final-1.mp4", hours_ago=2)
+        script = self._task_file("task-1", "script.json", hours_ago=2)
+        old_final = self._task_file("task-1", "final-2.mp4", hours_ago=200)
+
+        reclaimed = janitor.run_once()
+
+        self.assertFalse(os.path.exists(temp_clip))
+        self.assertFalse(os.path.exists(old_final))
+        self.assertTrue(os.path.exists(fresh_final))
+        self.assertTrue(os.path.exists(script))
+        self.assertEqual(reclaimed, {"intermediates": 1, "finals": 1})
+
+    def test_expired_task_is_removed(self):
+        self.state.update_task("task-1", state=const.TASK_STATE_COMPLETE)
+        self._task_file("task-1", "final-1.mp4", hours_ago=200)
+        self._task_file("task-1", "script.json", hours_ago=200)
+
+        janitor.run_once()
+
+        self.assertFalse(os.path.exists(os.path.join(self.tasks_dir, "task-1")))
+        self.assertIsNone(self.state.get_task("task-1"))
+
+    def test_processing_task_is_kept(self):
+        self.state.update_task("task-1", state=const.TASK_STATE_PROCESSING, progress=50)
+        temp_clip = self._task_file("task-1", "temp-clip-0.mp4", hours_ago=200)
+        final = self._task_file("task-1", "final-1.mp4", hours_ago=200)
+
+        self.assertEqual(janitor.run_once(), {})
+        self.assertTrue(os.path.exists(temp_clip))
+        self.assertTrue(os.path.exists(final))
+
+    def test_cache_quota_evicts_least_recently_used(self):
+        oldest = _touch(os.path.join(self.cache_dir, "vid-1.mp4"), hours_ago=5, size=100)
+        oldest_sidecar = _touch(os.path.join(self.cache_dir, "vid-1_metadata.json"), hours_ago=5, size=10)
+        older = _touch(os.path.join(self.cache_dir, "vid-2.mp4"), hours_ago=4, size=100)
+        newer = _touch(os.path.join(self.cache_dir, "vid-3.mp4"), hours_ago=3, size=100)
+        # used by a render right now, never evicted even over quota
+        recent = _touch(os.path.join(self.cache_dir, "vid-4.mp4"), hours_ago=0, size=100)
+
+        with mock.patch.object(janitor, "cache_quota_bytes", 250):
+            reclaimed = janitor.run_once()
+
+        self.assertFalse(os.path.exists(oldest))
+        self.assertFalse(os.path.exists(oldest_sidecar))
+        self.assertFalse(os.path.exists(older))
+        self.assertTrue(os.path.exists(newer))
+        self.assertTrue(os.path.exists(recent))
+        self.assertEqual(reclaimed, {"cache": 210})
+        self.assertEqual(janitor.get_stats()["cache_bytes"], 200)
+
+    def test_cache_retention(self):
+        expired = _touch(os.path.join(self.cache_dir, "vid-1.mp4"), hours_ago=800)
+        kept = _touch(os.path.join(self.cache_dir, "vid-2.mp4"), hours_ago=5)
+
+        janitor.run_once()
+
+        self.assertFalse(os.path.exists(expired))
+        self.assertTrue(os.path.exists(kept))
+
+    def test_clip_stem(self):
+        self.assertEqual(janitor._clip_stem("my.clip.mp4"), "my.clip")
+        self.assertEqual(janitor._clip_stem("my.clip_metadata.json"), "my.clip")
+        self.assertEqual(janitor._clip_stem("my.clip.mp4.part"), "my.clip")
+        self.assertEqual(janitor._clip_stem("my.clip.mp4.part.validator"), "my.clip")
+        self.assertEqual(janitor._clip_stem("my.clip.mp4.mezzanine.tmp"), "my.clip")
+        self.assertEqual(janitor._clip_stem("my.clip_metadata.json.12.34.tmp"), "my.clip")
+        # clips that only share a prefix are separate entries
+        self.assertNotEqual(janitor._clip_stem("a_b.mp4"), janitor._clip_stem("a_c.mp4"))
+
+    def test_material_directory_is_opt_in(self):
+        material_directory = os.path.join(self.temp.name, "footage")
+        os.makedirs(material_directory)
+        with mock.patch.dict(janitor.config.app, {"material_directory": material_directory}):
+            self.assertEqual(janitor.cache_dirs(), [self.cache_dir])
+            with mock.patch.object(janitor, "include_material_directory", True):
+                self.assertEqual(janitor.cache_dirs(), [self.cache_dir, material_directory])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.models.schema import VideoAspect, VideoConcatMode
+from app.services import library
+from test.services.test_material import _mp4
+
+
+class TestLibraryService(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.video_dir = os.path.join(self.temp_dir.name, "cache_videos")
+        os.makedirs(self.video_dir)
+        for index, (term, duration) in enumerate(
+            [("ocean waves", 10), ("Ocean Waves", 8), ("city traffic", 12), ("ocean", 3)]
+        ):
+            video_path = os.path.join(self.video_dir, f"vid-{index}.mp4")
+            with open(video_path, "wb") as f:
+                f.write(_mp4(duration=duration))
+            with open(os.path.join(self.video_dir, f"vid-{index}_metadata.json"), "w") as f:
+                json.dump({"video_path": video_path, "search_term": term}, f)
+
+        self.patches = [
+            mock.patch.object(library, "db_path", return_value=os.path.join(self.temp_dir.name, "library.db")),
+            mock.patch.object(library, "library_dirs", return_value=[self.video_dir]),
+            mock.patch.object(library, "semantic_match", False),
+        ]
+        for patch in self.patches:
+            patch.start()
+        library.refresh(force=True)
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.temp_dir.cleanup()
+
+    def test_search_matches_terms(self):
+        items = library.search("ocean waves", 5, VideoAspect.portrait)
+        self.assertEqual(
+            sorted(os.path.basename(item.url) for item in items), ["vid-0.mp4", "vid-1.mp4"]
+        )
+        self.assertEqual(library.search("mountains", 5, VideoAspect.portrait), [])
+
+    def test_refresh_removes_deleted_clips(self):
+        os.remove(os.path.join(self.video_dir, "vid-2.mp4"))
+        library.refresh(force=True)
+        self.assertEqual(library.search("city traffic", 5, VideoAspect.portrait), [])
+
+    def test_download_videos_prefers_library(self):
+        with mock.patch.object(library.material, "download_videos", return_value=[]) as remote:
+            paths = library.download_videos(
+                "test", ["ocean waves", "city traffic"],
+                video_contact_mode=VideoConcatMode.sequential,
+                audio_duration=12, max_clip_duration=5,
+            )
+            remote.assert_not_called()
+            self.assertEqual(len(paths), 3)
+
+            library.download_videos(
+                "test", ["mountains", "ocean waves"],
+                video_contact_mode=VideoConcatMode.sequential,
+                audio_duration=30, max_clip_duration=5,
+            )
+            # only the missing duration is fetched, terms without local footage first
+            kwargs = remote.call_args.kwargs
+            self.assertEqual(kwargs["search_terms"], ["mountains", "ocean waves"])
+            self.assertEqual(kwargs["audio_duration"], 20)
+
+    def test_download_videos_touches_cached_clips_only(self):
+        video_path = os.path.join(self.video_dir, "vid-2.mp4")
+        os.utime(video_path, (1000, 1000))
+        storage_dir = os.path.join(self.temp_dir.name, "storage", "cache_videos")
+        with mock.patch.object(library.material, "download_videos", return_value=[]), \
+                mock.patch.object(library.utils, "storage_dir", return_value=storage_dir) as cache_dir:
+            library.download_videos(
+                "test", ["city traffic"],
+                video_contact_mode=VideoConcatMode.sequential,
+                audio_duration=5, max_clip_duration=5,
+            )
+            # a clip of the user's material directory
+            self.assertEqual(os.path.getmtime(video_path), 1000)
+
+            cache_dir.return_value = self.video_dir
+            library.download_videos(
+                "test", ["city traffic"],
+                video_contact_mode=VideoConcatMode.sequential,
+                audio_duration=5, max_clip_duration=5,
+            )
+            self.assertGreater(os.path.getmtime(video_path), 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,381 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.models.schema import MaterialInfo
+from app.services import fingerprint, material, mezzanine, search_cache, semantic_video
+
+
+def _box(box_type: bytes, payload: bytes) -> bytes:
+    return (len(payload) + 8).to_bytes(4, "big") + box_type + payload
+
+
+def _mp4(duration: int = 10, timescale: int = 1000, fps: int = 25, mdat: bytes = b"\0" * 1024) -> bytes:
+    mvhd = bytes(4) + bytes(8) + timescale.to_bytes(4, "big") + (duration * timescale).to_bytes(4, "big") + bytes(80)
+    tkhd = bytes(76) + (1080 << 16).to_bytes(4, "big") + (1920 << 16).to_bytes(4, "big")
+    mdhd = bytes(4) + bytes(8) + timescale.to_bytes(4, "big") + (duration * timescale).to_bytes(4, "big") + bytes(4)
+    hdlr = bytes(8) + b"vide" + bytes(12)
+    stts = bytes(4) + (1).to_bytes(4, "big") + (duration * fps).to_bytes(4, "big") + (timescale // fps).to_bytes(4, "big")
+    stbl = _box(b"stbl", _box(b"stts", stts))
+    mdia = _box(b"mdia", _box(b"mdhd", mdhd) + _box(b"hdlr", hdlr) + _box(b"minf", stbl))
+    trak = _box(b"trak", _box(b"tkhd", tkhd) + mdia)
+    return _box(b"ftyp", b"isom" + bytes(4)) + _box(b"moov", _box(b"mvhd", mvhd) + trak) + _box(b"mdat", mdat)
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    body = b""
+    etag = '"v1"'
+    requests = []
+    # seconds every response is held back, and the most requests served at once
+    delay = 0.0
+    active = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with _RangeHandler.lock:
+            _RangeHandler.active += 1
+            _RangeHandler.peak = max(_RangeHandler.peak, _RangeHandler.active)
+        try:
+            time.sleep(_RangeHandler.delay)
+            self._respond()
+        finally:
+            with _RangeHandler.lock:
+                _RangeHandler.active -= 1
+
+    def _respond(self):
+        range_header = self.headers.get("Range")
+        _RangeHandler.requests.append(range_header)
+        body = _RangeHandler.body
+        if self.headers.get("If-Range", _RangeHandler.etag) != _RangeHandler.etag:
+            range_header = None
+        if range_header:
+            start = int(range_header.split("=")[1].split("-")[0])
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+            body = body[start:]
+        else:
+            self.send_response(200)
+        self.send_header("ETag", _RangeHandler.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMaterialService(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}/clip.mp4"
+        # the shared session carries the configured proxy, bypass it for the local server
+        material.get_session().trust_env = False
+        material.get_session().proxies.clear()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.temp_dir.name, "vid-test.mp4")
+        _RangeHandler.body = _mp4()
+        _RangeHandler.requests = []
+        _RangeHandler.etag = '"v1"'
+        _RangeHandler.delay = 0.0
+        _RangeHandler.peak = 0
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_download_resumes_part_file(self):
+        with open(f"{self.file_path}.part", "wb") as f:
+            f.write(_RangeHandler.body[:100])
+        with open(f"{self.file_path}.part.validator", "w") as f:
+            f.write('"v1"')
+        size = material.download_file(self.url, self.file_path)
+        self.assertEqual(size, len(_RangeHandler.body))
+        self.assertEqual(_RangeHandler.requests, ["bytes=100-"])
+        self.assertFalse(os.path.exists(f"{self.file_path}.part"))
+        self.assertFalse(os.path.exists(f"{self.file_path}.part.validator"))
+        with open(self.file_path, "rb") as f:
+            self.assertEqual(f.read(), _RangeHandler.body)
+
+    def test_download_restarts_when_remote_file_changed(self):
+        with open(f"{self.file_path}.part", "wb") as f:
+            f.write(b"x" * 100)
+        with open(f"{self.file_path}.part.validator", "w") as f:
+            f.write('"v0"')
+        material.download_file(self.url, self.file_path)
+        # the server ignored the range of the stale part file and sent the whole new file
+        self.assertEqual(_RangeHandler.requests, ["bytes=100-"])
+        with open(self.file_path, "rb") as f:
+            self.assertEqual(f.read(), _RangeHandler.body)
+
+        # a part file without a validator is not resumed at all
+        os.remove(self.file_path)
+        with open(f"{self.file_path}.part", "wb") as f:
+            f.write(b"x" * 100)
+        material.download_file(self.url, self.file_path)
+        self.assertEqual(_RangeHandler.requests[-1], None)
+        with open(self.file_path, "rb") as f:
+            self.assertEqual(f.read(), _RangeHandler.body)
+
+    def test_probe_video(self):
+        with open(self.file_path, "wb") as f:
+            f.write(_RangeHandler.body)
+        self.assertAlmostEqual(material.probe_video(self.file_path), 10.0)
+        self.assertEqual(material.probe_video_info(self.file_path)["fps"], 25)
+        # a clip without a duration is rejected
+        with open(self.file_path, "wb") as f:
+            f.write(_mp4(duration=0))
+        self.assertIsNone(material.probe_video(self.file_path))
+        # a truncated file no longer tiles into complete boxes
+        with open(self.file_path, "wb") as f:
+            f.write(_RangeHandler.body[:-10])
+        self.assertIsNone(material.probe_video(self.file_path))
+
+    def test_search_cache_lookup(self):
+        db_file = os.path.join(self.temp_dir.name, "search.db")
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return {"videos": [len(calls)]}
+
+        with mock.patch.object(search_cache, "db_path", return_value=db_file):
+            params = {"query": "ocean", "orientation": "portrait"}
+            self.assertEqual(search_cache.lookup("pexels", params, fetch), {"videos": [1]})
+            self.assertEqual(search_cache.lookup("pexels", params, fetch), {"videos": [1]})
+            self.assertEqual(len(calls), 1)
+
+            # expired entries are still served when the provider fails
+            def failing_fetch():
+                raise IOError("rate limited")
+
+            with mock.patch.object(search_cache, "ttl", 0), mock.patch.object(search_cache, "stale_ttl", 0):
+                self.assertEqual(search_cache.lookup("pexels", params, failing_fetch), {"videos": [1]})
+
+            search_cache.record_usage("pexels", "key-1", 429, {})
+            search_cache.record_usage("pexels", "key-2", 200, {"X-Ratelimit-Remaining": "10", "X-Ratelimit-Reset": str(int(time.time()) + 60)})
+            self.assertTrue(search_cache.is_exhausted("pexels", "key-1"))
+            self.assertFalse(search_cache.is_exhausted("pexels", "key-2"))
+
+    def test_download_videos_stops_at_duration_target(self):
+        def search(search_term, minimum_duration, video_aspect, **kwargs):
+            items = []
+            for i in range(20):
+                item = MaterialInfo()
+                item.url = f"{self.url}?{search_term}-{i}"
+                item.duration = 10
+                items.append(item)
+            return items
+
+        target = {"seconds": 100}
+
+        def save(video_url, **kwargs):
+            # the real audio turned out much shorter than the estimate
+            target["seconds"] = 12
+            return video_url
+
+        with mock.patch.object(material.get_provider("pexels"), "_search", side_effect=search), \
+                mock.patch.object(material, "save_video", side_effect=save), \
+                mock.patch.object(material, "download_workers", 1):
+            paths = material.download_videos(
+                "test", ["ocean"], audio_duration=100, max_clip_duration=5,
+                duration_target=lambda: target["seconds"],
+            )
+        self.assertEqual(len(paths), 3)
+
+    def test_download_videos_aborts_downloads_in_flight(self):
+        def search(search_term, minimum_duration, video_aspect, **kwargs):
+            items = []
+            for i in range(20):
+                item = MaterialInfo()
+                item.url = f"{self.url}?{i}"
+                item.duration = 10
+                items.append(item)
+            return items
+
+        calls = []
+
+        lock = threading.Lock()
+
+        def save(video_url, abort, **kwargs):
+            with lock:
+                calls.append(video_url)
+                fast = len(calls) <= 2
+            if fast:
+                return video_url
+            # a slow download, stopped once the first two clips cover the audio
+            if not abort.wait(5):
+                return video_url
+            raise InterruptedError(f"download aborted: {video_url}")
+
+        started = time.time()
+        with mock.patch.object(material.get_provider("pexels"), "_search", side_effect=search), \
+                mock.patch.object(material, "save_video", side_effect=save), \
+                mock.patch.object(material, "download_workers", 3):
+            paths = material.download_videos(
+                "test", ["ocean"], audio_duration=100, max_clip_duration=5, duration_target=lambda: 8,
+            )
+        self.assertLess(time.time() - started, 4)
+        self.assertEqual(sorted(paths), sorted(calls[:2]))
+        # no more than the workers plus one refill were ever started
+        self.assertLessEqual(len(calls), 4)
+
+    def test_download_file_limits_connections_per_host(self):
+        _RangeHandler.delay = 0.2
+        paths = [os.path.join(self.temp_dir.name, f"vid-{i}.mp4") for i in range(6)]
+        with mock.patch.object(material, "max_downloads_per_host", 2), \
+                mock.patch.object(material, "_host_semaphores", {}):
+            threads = [threading.Thread(target=material.download_file, args=(self.url, path)) for path in paths]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+        self.assertEqual(_RangeHandler.peak, 2)
+
+    def test_select_rendition(self):
+        renditions = [
+            {"width": 2160, "height": 3840, "size": 90},
+            {"width": 1080, "height": 1920, "size": 30},
+            {"width": 720, "height": 1280, "size": 12},
+            {"width": 360, "height": 640, "size": 3},
+        ]
+        self.assertEqual(material.select_rendition(renditions, 720, 1278)["width"], 720)
+        self.assertEqual(material.select_rendition(renditions, 1080, 1920)["width"], 1080)
+        # a source without the exact output size is still usable
+        self.assertEqual(material.select_rendition(renditions[:1], 1080, 1920)["width"], 2160)
+        self.assertIsNone(material.select_rendition(renditions[2:], 1080, 1920))
+
+    def test_fingerprint_near_duplicates(self):
+        rng = np.random.default_rng(0)
+        frames = [rng.integers(0, 255, (32, 32)).astype(np.float64) for _ in range(5)]
+        other = [rng.integers(0, 255, (32, 32)).astype(np.float64) for _ in range(5)]
+        # the same footage re-encoded: slightly brighter with some noise
+        reencoded = [np.clip(f * 1.1 + rng.normal(0, 3, f.shape), 0, 255) for f in frames]
+
+        fp = [f"{fingerprint.phash(f):016x}" for f in frames]
+        fp_reencoded = [f"{fingerprint.phash(f):016x}" for f in reencoded]
+        fp_other = [f"{fingerprint.phash(f):016x}" for f in other]
+        self.assertTrue(fingerprint.is_duplicate(fp_reencoded, [fp_other, fp]))
+        self.assertFalse(fingerprint.is_duplicate(fp_other, [fp]))
+        self.assertFalse(fingerprint.is_duplicate([], [fp]))
+
+    def test_search_videos_multi(self):
+        def provider(name, count, delay=0.0):
+            def search(search_term, minimum_duration, video_aspect, video_quality):
+                time.sleep(delay)
+                items = []
+                for i in range(count):
+                    item = MaterialInfo()
+                    item.provider = name
+                    item.url = f"https://{name}/{i}"
+                    items.append(item)
+                return items
+            return material.VideoProvider(name, search)
+
+        providers = {
+            "a": provider("a", 3),
+            "b": provider("b", 1),
+            "slow": provider("slow", 5, delay=2),
+        }
+        with mock.patch.object(material, "_providers", providers), \
+                mock.patch.object(material, "provider_timeout", 0.5):
+            items = material.search_videos_multi("ocean", 5)
+        # results are interleaved by rank, the slow provider is left out
+        self.assertEqual([item.url for item in items], ["https://a/0", "https://b/0", "https://a/1", "https://a/2"])
+
+    def test_download_videos_uses_the_provider_of_each_item(self):
+        downloads = []
+
+        def provider(name):
+            def search(search_term, minimum_duration, video_aspect, video_quality):
+                item = MaterialInfo()
+                item.provider = name
+                item.url = f"https://{name}/0"
+                item.duration = 10
+                return [item]
+
+            def download(video_url, **kwargs):
+                downloads.append((name, video_url))
+                return video_url
+            return material.VideoProvider(name, search, download=download)
+
+        with mock.patch.object(material, "_providers", {"a": provider("a"), "b": provider("b")}):
+            paths = material.download_videos("test", ["ocean"], source="multi", audio_duration=10)
+        self.assertEqual(sorted(paths), ["https://a/0", "https://b/0"])
+        self.assertEqual(sorted(downloads), [("a", "https://a/0"), ("b", "https://b/0")])
+
+    @unittest.skipUnless(shutil.which("ffmpeg"), "ffmpeg is not installed")
+    def test_mezzanine_transcode(self):
+        subprocess.run(
+            ["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", "testsrc=duration=1:size=2160x3840:rate=25", self.file_path],
+            check=True,
+        )
+        semantic_video.save_video_metadata(self.file_path, "test pattern")
+        with mock.patch.object(mezzanine, "fps", 24):
+            self.assertTrue(mezzanine.transcode(self.file_path))
+            # marked as done, not transcoded twice
+            self.assertFalse(mezzanine.transcode(self.file_path))
+        info = material.probe_video_info(self.file_path)
+        self.assertEqual((info["width"], info["height"]), (1080, 1920))
+        self.assertEqual(semantic_video.load_video_metadata(self.file_path)["search_term"], "test pattern")
+
+    def test_mezzanine_skips_clips_in_use(self):
+        with open(self.file_path, "wb") as f:
+            f.write(_RangeHandler.body)
+        semantic_video.save_video_metadata(self.file_path, "ocean")
+
+        def ffmpeg(cmd, **kwargs):
+            with open(cmd[-1], "wb") as f:
+                f.write(b"transcoded")
+
+        with mock.patch.object(mezzanine.subprocess, "run", side_effect=ffmpeg), \
+                mock.patch.object(mezzanine, "enqueue") as enqueue:
+            with mezzanine.using([self.file_path]):
+                self.assertFalse(mezzanine.transcode(self.file_path))
+                enqueue.assert_not_called()
+            # released by the render, transcoded now
+            enqueue.assert_called_once_with(os.path.abspath(self.file_path))
+            with open(self.file_path, "rb") as f:
+                self.assertEqual(f.read(), _RangeHandler.body)
+
+            # a render that starts during the transcode keeps the original clip as well
+            def ffmpeg_during_render(cmd, **kwargs):
+                ffmpeg(cmd)
+                render.__enter__()
+
+            render = mezzanine.using([self.file_path])
+            with mock.patch.object(mezzanine.subprocess, "run", side_effect=ffmpeg_during_render):
+                self.assertFalse(mezzanine.transcode(self.file_path))
+            render.__exit__(None, None, None)
+            self.assertFalse(os.path.exists(f"{self.file_path}{mezzanine.TEMP_SUFFIX}"))
+            with open(self.file_path, "rb") as f:
+                self.assertEqual(f.read(), _RangeHandler.body)
+
+            self.assertTrue(mezzanine.transcode(self.file_path))
+            with open(self.file_path, "rb") as f:
+                self.assertEqual(f.read(), b"transcoded")
+
+
+if __name__ == "__main__":
+    unittest.main()
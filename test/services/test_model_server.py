@@ -0,0 +1,120 @@
+import runpy
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services import embedding_store, model_server, semantic_video
+
+
+def _fake_encode(model_name, texts):
+    return np.array([[len(text), 1.0] for text in texts], dtype=np.float32)
+
+
+class TestModelServerService(unittest.TestCase):
+    def test_batcher_merges_concurrent_requests(self):
+        calls = []
+
+        def fn(items):
+            calls.append(list(items))
+            time.sleep(0.05)
+            return np.array(items) * 2
+
+        batcher = model_server.Batcher(fn, batch_size=64, wait_seconds=0.1)
+        results = {}
+
+        def submit(i):
+            results[i] = batcher.submit([i, i + 100])
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLess(len(calls), 8)
+        for i in range(8):
+            np.testing.assert_array_equal(results[i], [2 * i, 2 * (i + 100)])
+
+    def test_services_use_the_server(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), model_server._Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(model_server, "address", f"127.0.0.1:{server.server_address[1]}"), \
+                    mock.patch.object(model_server, "enabled", True), \
+                    mock.patch.object(model_server, "autostart", False), \
+                    mock.patch.object(model_server, "_encode_text", side_effect=_fake_encode), \
+                    mock.patch.object(model_server, "_text_backend", return_value="onnx-int8"), \
+                    mock.patch.object(model_server, "_text_backends", {}), \
+                    mock.patch.object(model_server, "_batchers", {}), \
+                    mock.patch.object(embedding_store, "enabled", True), \
+                    mock.patch.object(embedding_store, "db_path", return_value=f"{temp_dir}/embeddings.db"), \
+                    mock.patch.object(semantic_video, "_model", None), \
+                    mock.patch.object(semantic_video, "embedding_backend") as backend:
+                embeddings = semantic_video.encode_texts(["ocean", "city traffic"])
+                np.testing.assert_array_equal(embeddings, [[5, 1], [12, 1]])
+                # the model is never loaded in this process
+                backend.load.assert_not_called()
+                # embeddings are keyed by the backend the server runs, not the configured one
+                self.assertEqual(semantic_video.model_key(), "all-mpnet-base-v2@onnx-int8")
+                stored = embedding_store.get_many("all-mpnet-base-v2@onnx-int8", ["ocean"])
+                np.testing.assert_array_equal(stored["ocean"], [5, 1])
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def test_server_runs_the_models_in_process(self):
+        model = mock.Mock()
+        model.encode.side_effect = lambda texts, **kwargs: np.array([[len(t), 1.0] for t in texts], dtype=np.float32)
+        # configured like its clients, the server must not forward to itself
+        with mock.patch.object(model_server, "enabled", True), \
+                mock.patch.object(model_server, "address", "127.0.0.1:0"), \
+                mock.patch.object(model_server, "autostart", False), \
+                mock.patch.object(model_server, "REQUEST_TIMEOUT", 10), \
+                mock.patch.object(model_server, "_text_backends", {}), \
+                mock.patch.object(model_server, "_batchers", {}), \
+                mock.patch.object(embedding_store, "enabled", False), \
+                mock.patch.object(semantic_video, "_model", None), \
+                mock.patch.object(semantic_video.embedding_backend, "load", return_value=(model, "torch")):
+            server = model_server.create_server()
+            self.assertFalse(model_server.enabled)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                with mock.patch.object(model_server, "address", f"127.0.0.1:{server.server_address[1]}"):
+                    embeddings, backend = model_server.embed_texts(["ocean", "city traffic"], "all-mpnet-base-v2")
+            finally:
+                server.shutdown()
+                server.server_close()
+        np.testing.assert_array_equal(embeddings, [[5, 1], [12, 1]])
+        self.assertEqual(backend, "torch")
+
+    def test_main_serves_the_imported_module(self):
+        with mock.patch.object(model_server, "serve") as serve:
+            runpy.run_module("app.services.model_server", run_name="__main__")
+        serve.assert_called_once_with()
+
+    def test_unreachable_server_falls_back(self):
+        with mock.patch.object(model_server, "address", "127.0.0.1:9"), \
+                mock.patch.object(model_server, "enabled", True), \
+                mock.patch.object(model_server, "autostart", False), \
+                mock.patch.object(model_server, "_unavailable_until", 0.0):
+            with self.assertRaises(ConnectionError):
+                model_server.embed_texts(["ocean"], "all-mpnet-base-v2")
+            # in-process models are used for a while
+            self.assertFalse(model_server.available())
+
+
+if __name__ == "__main__":
+    unittest.main()
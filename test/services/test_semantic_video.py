@@ -0,0 +1,154 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import zlib
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services import assignment, clip_index, embedding_store, semantic_video
+
+
+class _FakeModel:
+    """Bag-of-words embeddings, counts the encode calls."""
+
+    max_seq_length = 128
+
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, texts, normalize_embeddings=False, **kwargs):
+        self.calls += 1
+        vectors = np.zeros((len(texts), 64), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                vectors[row, zlib.crc32(word.encode()) % 64] += 1.0
+            vectors[row, 63] += 0.1
+        if normalize_embeddings:
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+
+class TestSemanticVideoService(unittest.TestCase):
+    def setUp(self):
+        self.model = _FakeModel()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.patches = [
+            mock.patch.object(semantic_video, "load_model", return_value=self.model),
+            mock.patch.object(
+                embedding_store, "db_path", return_value=os.path.join(self.temp_dir.name, "embeddings.db")
+            ),
+            # selection only from the given clips, not from the local clip cache
+            mock.patch.object(clip_index, "enabled", False),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.temp_dir.cleanup()
+
+    def test_similarity_matrix_matches_pairwise(self):
+        sentences = ["ocean waves crash", "a busy city", "ocean waves crash"]
+        texts = ["ocean waves", "city traffic", "forest", "ocean waves"]
+        matrix = semantic_video.similarity_matrix(sentences, texts)
+        self.assertEqual(matrix.shape, (3, 4))
+        self.assertEqual(self.model.calls, 2)
+        # the pairwise scores below are served by the embedding store
+        for i, sentence in enumerate(sentences):
+            for j, text in enumerate(texts):
+                self.assertAlmostEqual(
+                    float(matrix[i, j]), semantic_video.calculate_similarity(sentence, text), places=5
+                )
+        self.assertEqual(self.model.calls, 2)
+
+    def test_select_videos_encodes_in_two_batches(self):
+        script = "The ocean waves crash on the beach. The city traffic never stops at night."
+        video_metadata = [
+            {"video_path": f"/tmp/vid-{i}.mp4", "search_term": term}
+            for i, term in enumerate(["ocean waves", "city traffic", "forest", "ocean beach"])
+        ]
+        selected = semantic_video.select_videos_for_script(
+            script, video_metadata, audio_duration=20, max_clip_duration=5,
+            min_segment_length=10, max_video_reuse=2,
+        )
+        self.assertEqual(self.model.calls, 2)
+        self.assertEqual(len(selected), 4)
+        self.assertIn(selected[0]["search_term"], ["ocean waves", "ocean beach"])
+        self.assertEqual(selected[1]["search_term"], "city traffic")
+
+    def test_assignment_is_globally_optimal(self):
+        scores = np.array([[0.9, 0.8], [0.85, 0.1]])
+        # greedy picks clip 0 for the first slot and leaves 0.1 for the second
+        self.assertEqual(assignment.assign(scores, max_video_reuse=1), [1, 0])
+        # reusing a clip costs the reuse penalty
+        self.assertEqual(assignment.assign(scores, max_video_reuse=2), [1, 0])
+        self.assertEqual(assignment.assign(np.array([[0.9, 0.1], [0.9, 0.1]]), max_video_reuse=2), [0, 0])
+
+    def test_assignment_avoids_clips_below_threshold(self):
+        scores = np.array([[0.9, 0.45], [0.6, 0.45]])
+        self.assertEqual(assignment.assign(scores, max_video_reuse=2), [0, 1])
+        # reusing the clip above the threshold beats a fresh clip below it
+        self.assertEqual(assignment.assign(scores, max_video_reuse=2, min_score=0.5), [0, 0])
+        # with nothing above the threshold every slot still gets a clip
+        self.assertEqual(assignment.assign(np.array([[0.2, 0.3]]), max_video_reuse=1, min_score=0.5), [1])
+
+    def test_assignment_overflows_reuse_limit_evenly(self):
+        assigned = assignment.assign(np.full((5, 2), 0.5), max_video_reuse=1)
+        self.assertNotIn(-1, assigned)
+        self.assertEqual(sorted([assigned.count(0), assigned.count(1)]), [2, 3])
+
+    def test_embedding_store_evicts_least_recently_used(self):
+        semantic_video.encode_texts(["ocean waves", "city traffic"])
+        with mock.patch.object(embedding_store, "max_entries", 2):
+            semantic_video.encode_texts(["forest"])
+            self.assertEqual(embedding_store.prune(), 1)
+        self.assertEqual(self.model.calls, 2)
+
+        stored = embedding_store.get_many("all-mpnet-base-v2", ["ocean waves", "city traffic", "forest"])
+        self.assertEqual(len(stored), 2)
+        self.assertIn("forest", stored)
+        self.assertEqual(stored["forest"].dtype, np.float32)
+
+        semantic_video.encode_texts(["ocean waves", "city traffic", "forest"])
+        self.assertEqual(self.model.calls, 3)
+
+    def test_concurrent_metadata_updates_are_kept(self):
+        video_path = os.path.join(self.temp_dir.name, "vid-1.mp4")
+        with open(video_path, "wb") as f:
+            f.write(b"x")
+        semantic_video.save_video_metadata(video_path, "ocean")
+        partial_reads = []
+
+        def update(field):
+            for i in range(50):
+                semantic_video.update_video_metadata(video_path, **{field: i})
+
+        def read():
+            for _ in range(200):
+                if semantic_video.load_video_metadata(video_path) is None:
+                    partial_reads.append(1)
+
+        threads = [threading.Thread(target=update, args=(f,)) for f in ("shots", "frame_times", "mezzanine")]
+        threads.append(threading.Thread(target=read))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        metadata = semantic_video.load_video_metadata(video_path)
+        self.assertEqual((metadata["shots"], metadata["frame_times"], metadata["mezzanine"]), (49, 49, 49))
+        self.assertEqual(metadata["search_term"], "ocean")
+        self.assertEqual(partial_reads, [])
+        self.assertEqual(sorted(os.listdir(self.temp_dir.name)), ["vid-1.mp4", "vid-1_metadata.json"])
+
+
+if __name__ == "__main__":
+    unittest.main()
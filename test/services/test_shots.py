@@ -0,0 +1,77 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.services import shots
+
+
+def _frames(*scenes):
+    """Frames of consecutive scenes, each a (color, seconds) pair with some noise and motion."""
+    rng = np.random.default_rng(0)
+    frames = []
+    for color, seconds in scenes:
+        for i in range(int(seconds * shots.SAMPLE_FPS)):
+            frame = np.full((shots.FRAME_HEIGHT, shots.FRAME_WIDTH, 3), color, dtype=np.float64)
+            frame[:, (i * 2) % shots.FRAME_WIDTH] += 40
+            frame += rng.normal(0, 6, frame.shape)
+            frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return np.stack(frames)
+
+
+class TestShotsService(unittest.TestCase):
+    def test_boundaries(self):
+        frames = _frames(((200, 40, 40), 3), ((40, 40, 200), 2), ((40, 180, 60), 4))
+        self.assertEqual(shots.boundaries(frames), [3.0, 5.0])
+        # motion and noise within one scene are not cuts
+        self.assertEqual(shots.boundaries(_frames(((120, 120, 120), 6))), [])
+
+    def test_detect(self):
+        frames = _frames(((200, 40, 40), 3), ((40, 40, 200), 2))
+        with mock.patch.object(shots, "decode_frames", return_value=frames):
+            self.assertEqual(shots.detect("clip.mp4", 5.04), [[0.0, 3.0], [3.0, 5.04]])
+
+    def test_ensure_keeps_shots_of_clips_without_sidecar(self):
+        with tempfile.TemporaryDirectory() as temp:
+            video_path = os.path.join(temp, "clip.mp4")
+            with open(video_path, "wb") as f:
+                f.write(b"x")
+            with mock.patch.object(shots, "detect", return_value=[[0.0, 5.0]]) as detect, \
+                    mock.patch.object(shots, "_memory", shots.OrderedDict()):
+                self.assertEqual(shots.ensure(video_path, 5.0), [[0.0, 5.0]])
+                self.assertEqual(shots.ensure(video_path, 5.0), [[0.0, 5.0]])
+                self.assertEqual(detect.call_count, 1)
+                # a replaced file is detected again
+                with open(video_path, "wb") as f:
+                    f.write(b"xx")
+                shots.ensure(video_path, 5.0)
+                self.assertEqual(detect.call_count, 2)
+
+    def test_windows_start_on_shots(self):
+        shot_list = [[0.0, 2.0], [2.0, 9.0], [9.0, 20.0]]
+        self.assertEqual(
+            shots.windows(shot_list, 20.0, 5), [(0.0, 5.0), (9.0, 14.0), (14.0, 19.0)]
+        )
+        # without shots, the fixed windows of before
+        self.assertEqual(shots.windows([], 12.0, 5), [(0.0, 5.0), (5.0, 10.0)])
+
+    def test_choose_start(self):
+        shot_list = [[0.0, 2.0], [2.0, 9.0], [9.0, 20.0]]
+        self.assertEqual(shots.choose_start(shot_list, 20.0, 5, scores=[0.9, 0.2, 0.4]), 0.0)
+        self.assertEqual(shots.choose_start(shot_list, 20.0, 5, scores=[None, 0.2, 0.4]), 9.0)
+        self.assertEqual(shots.choose_start(shot_list, 20.0, 5, scores=[None, 0.2, 0.4], used={9.0}), 2.0)
+        # without scores, a shot that holds the whole sub-clip
+        self.assertIn(shots.choose_start(shot_list, 20.0, 5), (2.0, 9.0))
+        # the last shot is too late to start a full sub-clip
+        self.assertEqual(shots.choose_start(shot_list, 12.0, 5, scores=[0.1, 0.2, 0.9]), 2.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# add project root to python path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from app.models import const
+from app.models.schema import MaterialInfo, VideoAspect, VideoConcatMode, VideoParams
+from app.services import state as sm
+
+
+class TestStateService(unittest.TestCase):
+    def setUp(self):
+        self.task_id = "00000000-0000-0000-0000-000000000000"
+
+    def tearDown(self):
+        pass
+
+    def test_encode_decode_round_trip(self):
+        fields = {
+            "task_id": self.task_id,
+            "state": const.TASK_STATE_COMPLETE,
+            "progress": 100,
+            "script": "it's a 'quoted' script",
+            "materials": ["/tmp/vid-1.mp4", "/tmp/vid-2.mp4"],
+            "audio_duration": 12,
+        }
+        # simulate redis: keys and values come back as bytes
+        raw = {k.encode("utf-8"): v for k, v in sm.encode_task(fields).items()}
+        task = sm.validate_task(sm.decode_task(raw))
+        self.assertEqual(task, fields)
+
+    def test_nested_models_are_preserved(self):
+        params = VideoParams(video_subject="money")
+        material = MaterialInfo(provider="local", url="/tmp/1.png", duration=3)
+        raw = sm.encode_task({"params": params, "material": material})
+        task = sm.decode_task(raw)
+        self.assertEqual(task["params"]["video_subject"], "money")
+        self.assertEqual(task["params"]["video_aspect"], "9:16")
+        self.assertEqual(task["material"]["url"], "/tmp/1.png")
+
+    def test_enums_are_stored_as_values(self):
+        params = VideoParams(
+            video_subject="money",
+            video_aspect=VideoAspect.landscape,
+            video_concat_mode=VideoConcatMode.sequential,
+        )
+        primitive = sm._to_primitive(params)
+        self.assertIs(type(primitive["video_aspect"]), str)
+        self.assertEqual(primitive["video_aspect"], "16:9")
+        self.assertIs(type(primitive["video_concat_mode"]), str)
+        self.assertEqual(primitive["video_concat_mode"], "sequential")
+
+    def test_decode_legacy_record(self):
+        raw = {
+            b"task_id": self.task_id.encode("utf-8"),
+            b"state": b"1",
+            b"progress": b"100",
+            b"videos": b"['/tmp/final-1.mp4']",
+        }
+        task = sm.validate_task(sm.decode_task(raw))
+        self.assertEqual(task["state"], 1)
+        self.assertEqual(task["progress"], 100)
+        self.assertEqual(task["videos"], ["/tmp/final-1.mp4"])
+
+    def test_memory_state_normalizes_values(self):
+        state = sm.MemoryState()
+        state.update_task(
+            self.task_id,
+            state=const.TASK_STATE_COMPLETE,
+            progress=150,
+            params=VideoParams(video_subject="money"),
+        )
+        task = state.get_task(self.task_id)
+        self.assertEqual(task["progress"], 100)
+        self.assertIsInstance(task["params"], dict)
+
+    def test_memory_state_merges_updates(self):
+        state = sm.MemoryState()
+        state.update_task(self.task_id, progress=10, script="hello")
+        state.update_task(self.task_id, progress=20)
+        task = state.get_task(self.task_id)
+        self.assertEqual(task["progress"], 20)
+        self.assertEqual(task["script"], "hello")
+
+    def test_memory_state_spills_finished_tasks(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            spill_file = os.path.join(temp_dir, "tasks.jsonl")
+            state = sm.MemoryState(max_finished_tasks=2, spill_file=spill_file)
+            for i in range(5):
+                state.update_task(
+                    f"task-{i}", state=const.TASK_STATE_COMPLETE, progress=100, videos=[f"{i}.mp4"]
+                )
+            state.update_task("task-running", progress=50)
+
+            self.assertEqual(len(state._tasks), 3)
+            self.assertEqual(state.get_task("task-0")["videos"], ["0.mp4"])
+            tasks, total = state.get_all_tasks(page=1, page_size=10)
+            self.assertEqual(total, 6)
+            self.assertEqual(len(tasks), 6)
+
+            state.delete_task("task-1")
+            self.assertIsNone(state.get_task("task-1"))
+
+            # a new process re-indexes the spilled records
+            reloaded = sm.MemoryState(spill_file=spill_file)
+            self.assertEqual(reloaded.get_task("task-2")["state"], const.TASK_STATE_COMPLETE)
+            self.assertIsNone(reloaded.get_task("task-1"))
+
+    def test_memory_state_expires_finished_tasks(self):
+        state = sm.MemoryState(finished_ttl=-1)
+        state.update_task(self.task_id, state=const.TASK_STATE_FAILED)
+        self.assertIsNone(state.get_task(self.task_id))
+
+
+if __name__ == "__main__":
+    unittest.main()
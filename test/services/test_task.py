@@ -2,6 +2,7 @@ import unittest
 import os
 import sys
 from pathlib import Path
+from unittest import mock
 
 # add project root to python path
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
@@ -62,5 +63,23 @@ class TestTaskService(unittest.TestCase):
         print(result)
     
 
+    def test_top_up_materials(self):
+        params = VideoParams(video_subject="ocean", video_source="pexels", video_clip_duration=5)
+        downloads = [["c.mp4", "d.mp4"], ["e.mp4"]]
+        with mock.patch.object(tm.material, "covered_duration", side_effect=lambda paths, _: 5 * len(paths)), \
+                mock.patch.object(tm.semantic_video, "get_video_metadata_list",
+                                  return_value=[{"search_term": "waves"}, {"search_term": "waves"}]), \
+                mock.patch.object(tm.fingerprint, "load", return_value=[]), \
+                mock.patch.object(tm.library, "download_videos", side_effect=downloads) as download:
+            paths = tm._top_up_materials("test", params, ["waves", "beach"], ["a.mp4", "b.mp4"], 23)
+
+        self.assertEqual(paths, ["a.mp4", "b.mp4", "c.mp4", "d.mp4", "e.mp4"])
+        first_wave = download.call_args_list[0].kwargs
+        # the term without footage goes first and only the deficit is fetched
+        self.assertEqual(first_wave["search_terms"], ["beach", "waves"])
+        self.assertEqual(first_wave["audio_duration"], 13)
+        self.assertEqual(first_wave["exclude_paths"], {"a.mp4", "b.mp4"})
+
+
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file
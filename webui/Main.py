@@ -571,6 +571,7 @@ with main_tabs[0]:
             video_sources = [
                 (tr("Pexels"), "pexels"),
                 (tr("Pixabay"), "pixabay"),
+                (tr("All sources"), "multi"),
                 (tr("Local file"), "local"),
                 (tr("TikTok"), "douyin"),
                 (tr("Bilibili"), "bilibili"),
@@ -1326,7 +1327,7 @@ with main_tabs[0]:
             scroll_to_bottom()
             st.stop()
 
-        if params.video_source not in ["pexels", "pixabay", "local"]:
+        if params.video_source not in ["pexels", "pixabay", "multi", "local"]:
             st.error(tr("Please Select a Valid Video Source"))
             scroll_to_bottom()
             st.stop()
@@ -1341,6 +1342,13 @@ with main_tabs[0]:
             scroll_to_bottom()
             st.stop()
 
+        if params.video_source == "multi" and not (
+            config.app.get("pexels_api_keys", "") or config.app.get("pixabay_api_keys", "")
+        ):
+            st.error(tr("Please Enter the Pexels or Pixabay API Key"))
+            scroll_to_bottom()
+            st.stop()
+
         if uploaded_files:
             local_videos_dir = utils.storage_dir("local_videos", create=True)
             for file in uploaded_files: